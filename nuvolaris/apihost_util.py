@@ -20,6 +20,7 @@ import logging
 import nuvolaris.config as cfg
 import nuvolaris.kube as kube
 import nuvolaris.util as util
+import nuvolaris.cluster_facts as facts
 import urllib.parse
 import os, os.path
 
@@ -181,7 +182,7 @@ def get_user_static_hostname(runtime, username, apihost):
     inside the cm/config configMap prepending the user_namespace when needed.
     """
     
-    apihost_url = util.get_apihost_from_config_map()
+    apihost_url = facts.get("apihost")
 
     if apihost_url:
         apihost = extract_hostname(apihost_url)
@@ -0,0 +1,155 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module keeps what the operator detects about the cluster:
+# storage class and provisioner, node labels, ingress classes, traefik crds,
+# object storage and apihost; each fact is probed the first time it is asked,
+# then served from memory until it expires (NUVOLARIS_CLUSTER_FACTS_TTL seconds)
+# or the kube cache sees a change of the resources it was derived from
+import os, time, logging, threading
+
+ttl = int(os.environ.get("NUVOLARIS_CLUSTER_FACTS_TTL", "300"))
+
+class Facts:
+    """
+    Cluster facts, probed once and kept until they expire or are invalidated.
+    A probe raising or finding nothing (None) is not cached, the next get probes again.
+    >>> now = [0]; calls = []
+    >>> facts = Facts(60, clock=lambda: now[0])
+    >>> facts.register("storageclass", lambda: calls.append(1) or "standard", ["storageclasses"])
+    >>> facts.get("storageclass"), facts.get("storageclass"), len(calls)
+    ('standard', 'standard', 1)
+    >>> facts.on_event("storageclasses"); _ = facts.get("storageclass"); len(calls)
+    2
+    >>> now[0] = 61; _ = facts.get("storageclass"); len(calls)
+    3
+    >>> facts.register("apihost", lambda: calls.append(1) or None)
+    >>> facts.get("apihost"), facts.get("apihost"), len(calls)
+    (None, None, 5)
+    """
+    def __init__(self, ttl, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.probes = {}
+        self.resources = {}
+        self.values = {}
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def register(self, name, probe, resources=()):
+        self.probes[name] = probe
+        self._locks[name] = threading.Lock()
+        for resource in resources:
+            self.resources.setdefault(resource, []).append(name)
+
+    def _cached(self, name):
+        with self._lock:
+            entry = self.values.get(name)
+        if entry and self.clock() - entry[1] < self.ttl:
+            return entry
+        return None
+
+    def get(self, name):
+        entry = self._cached(name)
+        if entry:
+            return entry[0]
+        # one probe at a time for each fact, the others wait for its value
+        with self._locks[name]:
+            entry = self._cached(name)
+            if entry:
+                return entry[0]
+            value = self.probes[name]()
+            # not found may only mean not there yet, as the apihost before the ingress gets an address
+            if value is not None:
+                with self._lock:
+                    self.values[name] = (value, self.clock())
+            return value
+
+    def invalidate(self, *names):
+        with self._lock:
+            for name in names or list(self.values):
+                self.values.pop(name, None)
+
+    def on_event(self, resource):
+        """
+        forget the facts derived from a resource that changed
+        """
+        names = self.resources.get(resource, [])
+        if names:
+            self.invalidate(*names)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: value for name, (value, _) in self.values.items()}
+
+def _node_labels():
+    import nuvolaris.kube as kube
+    return kube.kubectl("get", "nodes", jsonpath='{.items[].metadata.labels}')
+
+def _ingress_classes():
+    import nuvolaris.kube as kube
+    detected = kube.kubectl("get", "ingressclass", namespace=None, jsonpath=r"{.items[*].metadata.name}", debugresult=False)
+    return [item for item in detected if item]
+
+def _util(fn):
+    def probe():
+        import nuvolaris.util as util
+        return getattr(util, fn)()
+    return probe
+
+facts = Facts(ttl)
+facts.register("storageclass", _util("get_default_storage_class"), ["storageclasses"])
+facts.register("provisioner", _util("get_default_storage_provisioner"), ["storageclasses"])
+facts.register("node_labels", _node_labels, ["nodes"])
+facts.register("ingress_classes", _ingress_classes, ["ingressclasses"])
+facts.register("traefik_middleware_api_version", _util("detect_traefik_middleware_api_version"), ["customresourcedefinitions"])
+facts.register("object_storageclass", _util("get_object_storage_class"), ["storageclasses"])
+facts.register("rgw_service_name", _util("get_object_storage_rgw_srv_name"))
+facts.register("rgw_service_port", _util("get_object_storage_rgw_srv_http_port"))
+facts.register("apihost", _util("get_apihost_from_config_map"))
+
+_watching = set()
+# the cached resources when the listeners were last added
+_tried = None
+
+def _watch(cached):
+    # the informers start after the login, so the listeners are added when they exist;
+    # the resources not cached (as nodes) are tried again only when the cached ones change
+    global _tried
+    import nuvolaris.kube_cache as kube_cache
+    _tried = cached
+    for resource in facts.resources:
+        if resource not in _watching and kube_cache.watch(resource, lambda event, obj, resource=resource: facts.on_event(resource)):
+            _watching.add(resource)
+            logging.debug(f"cluster facts follow the changes of {resource}")
+
+def get(name):
+    """
+    the value of a cluster fact, probed if not known or expired
+    """
+    if len(_watching) < len(facts.resources):
+        import nuvolaris.kube_cache as kube_cache
+        cached = kube_cache.cached()
+        if cached != _tried:
+            _watch(cached)
+    return facts.get(name)
+
+def invalidate(*names):
+    """
+    forget the given facts, or all of them
+    """
+    facts.invalidate(*names)
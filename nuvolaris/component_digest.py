@@ -0,0 +1,151 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module fingerprints what a component deploys
+# while a component is created the configuration keys it reads, the
+# templates it expands, the deploy folders it kustomizes and the objects
+# it applies are recorded; the manifests are a function of the first three,
+# so hashing them again later tells cheaply if the component would change
+import os, hashlib, threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+class Recording:
+    """
+    What a component used while it was created, in the calling thread.
+    >>> with recording() as rec:
+    ...     note("config", "redis.persistence-size"); note("template", "redis-pvc.yaml")
+    >>> rec.used["config"], rec.used["template"], note("config", "ignored")
+    (['redis.persistence-size'], ['redis-pvc.yaml'], None)
+    """
+    def __init__(self):
+        self.used = {"config": [], "template": [], "deploy": []}
+        self.applied = []
+
+    def add(self, kind, name):
+        if name not in self.used[kind]:
+            self.used[kind].append(name)
+
+# record what the calling thread uses, until the block ends
+@contextmanager
+def recording():
+    previous = getattr(_local, "recording", None)
+    _local.recording = rec = Recording()
+    try:
+        yield rec
+    finally:
+        _local.recording = previous
+
+def note(kind, name):
+    """
+    record the use of a config key, a template or a deploy folder, if recording
+    """
+    rec = getattr(_local, "recording", None)
+    if rec is not None:
+        rec.add(kind, name)
+
+def note_applied(digest):
+    rec = getattr(_local, "recording", None)
+    if rec is not None:
+        rec.applied.append(digest)
+
+def recording_active():
+    return getattr(_local, "recording", None) is not None
+
+def _hash_files(h, dir):
+    for root, dirs, files in os.walk(dir):
+        dirs.sort()
+        for name in sorted(files):
+            # the generated files are an output, not an input
+            if name.startswith("__") or name == "kustomization.yaml":
+                continue
+            path = os.path.join(root, name)
+            h.update(os.path.relpath(path, dir).encode("utf-8") + b"\0")
+            with open(path, "rb") as f:
+                h.update(hashlib.sha256(f.read()).digest())
+
+def inputs_digest(used):
+    """
+    the digest of the current value of the inputs in a fingerprint
+    >>> import nuvolaris.config as cfg
+    >>> _ = cfg.configure({"redis": {"persistence-size": 10}})
+    >>> used = {"config": ["redis.persistence-size"], "template": ["test.json"], "deploy": ["test"]}
+    >>> before = inputs_digest(used)
+    >>> before == inputs_digest(used)
+    True
+    >>> _ = cfg.put("redis.persistence-size", 20)
+    >>> before == inputs_digest(used)
+    False
+    >>> import nuvolaris.component_digest as cd
+    >>> with cd.recording() as rec:
+    ...     _ = cfg.getall("redis.")
+    >>> rec.used["config"]
+    ['redis.*']
+    >>> before = inputs_digest(rec.used); _ = cfg.put("redis.prefix", "r1")
+    >>> before == inputs_digest(rec.used)
+    False
+    """
+    import nuvolaris.config as cfg
+    import nuvolaris.template as ntp
+    h = hashlib.sha256()
+    for key in sorted(used.get("config", [])):
+        # a prefix read with getall or keys, every key under it is an input
+        value = cfg.snapshot().getall(key[:-1]) if key.endswith("*") else cfg.peek(key)
+        h.update(f"config:{key}={value!r}\n".encode("utf-8"))
+    for name in sorted(used.get("template", [])):
+        try:
+            source = ntp.env.loader.get_source(ntp.env, name)[0]
+        except Exception:
+            source = None
+        h.update(f"template:{name}={source!r}\n".encode("utf-8"))
+    for where in sorted(used.get("deploy", [])):
+        h.update(f"deploy:{where}\n".encode("utf-8"))
+        _hash_files(h, f"deploy/{where}")
+    return h.hexdigest()[:32]
+
+def fingerprint(rec: Recording, exclude=()):
+    """
+    the fingerprint of a recording, to be stored in the status of the resource;
+    the excluded config keys are the ones written while deploying, not inputs
+    """
+    used = {kind: sorted(n for n in names if kind != "config" or n not in exclude)
+            for kind, names in rec.used.items()}
+    manifest = hashlib.sha256("\n".join(sorted(rec.applied)).encode("utf-8")).hexdigest()[:32]
+    return {**used, "inputs": inputs_digest(used), "manifest": manifest}
+
+def changed(fingerprints, names):
+    """
+    the names, among the given ones, whose inputs changed since they were fingerprinted;
+    the ones never fingerprinted are not reported
+    >>> import nuvolaris.config as cfg
+    >>> _ = cfg.configure({"redis": {"persistence-size": 10}, "couchdb": {"volume-size": 5}})
+    >>> fps = {}
+    >>> for name, key in [("redis", "redis.persistence-size"), ("couchdb", "couchdb.volume-size")]:
+    ...     with recording() as rec:
+    ...         note("config", key)
+    ...     fps[name] = fingerprint(rec)
+    >>> _ = cfg.put("redis.persistence-size", 20)
+    >>> changed(fps, ["redis", "couchdb", "milvus"])
+    ['redis']
+    """
+    res = []
+    for name in names:
+        fp = (fingerprints or {}).get(name)
+        if fp and fp.get("inputs") != inputs_digest(fp):
+            res.append(name)
+    return res
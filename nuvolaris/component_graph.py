@@ -0,0 +1,218 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module runs steps ordered by a dependency graph
+# a graph is a dict from the name of a step to the names of the steps it
+# comes after; each step starts as soon as all of them are done, with at
+# most `workers` steps running at the same time
+import os, time, logging, threading, contextvars
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+
+# how many components are deployed at the same time
+parallelism = int(os.environ.get("NUVOLARIS_DEPLOY_PARALLELISM", "4"))
+
+class StepResult:
+    """
+    The outcome of a step: its value or the exception it raised,
+    when it started and how long it took, relative to the start of the run.
+    Steps not executed because the run was aborted are skipped.
+    """
+    def __init__(self, name, value=None, error=None, start=0.0, elapsed=0.0, skipped=False):
+        self.name = name
+        self.value = value
+        self.error = error
+        self.start = start
+        self.elapsed = elapsed
+        self.skipped = skipped
+
+    @property
+    def ok(self):
+        return self.error is None and not self.skipped
+
+    def __repr__(self):
+        status = "skipped" if self.skipped else "ok" if self.ok else f"error={self.error!r}"
+        return f"StepResult({self.name}, {status}, {self.elapsed:.3f}s)"
+
+def prune(graph):
+    """
+    drop the dependencies on steps not in the graph, as disabled components
+    >>> prune({"a": [], "b": ["a", "x"]})
+    {'a': [], 'b': ['a']}
+    """
+    return {name: [d for d in after if d in graph] for name, after in graph.items()}
+
+def order(graph):
+    """
+    a topological order of the graph, ties broken by declaration order
+    >>> order({"openwhisk": ["couchdb"], "couchdb": [], "redis": []})
+    ['couchdb', 'openwhisk', 'redis']
+    >>> order({"a": ["b"], "b": ["a"]})
+    Traceback (most recent call last):
+    ...
+    ValueError: dependency cycle among a, b
+    """
+    graph = prune(graph)
+    res, done = [], set()
+    while len(res) < len(graph):
+        ready = [n for n in graph if n not in done and all(d in done for d in graph[n])]
+        if not ready:
+            raise ValueError(f"dependency cycle among {', '.join(n for n in graph if n not in done)}")
+        res.append(ready[0])
+        done.add(ready[0])
+    return res
+
+def reverse(graph):
+    """
+    the graph with the dependencies reversed, to undo what the graph does
+    >>> reverse({"couchdb": [], "openwhisk": ["couchdb"], "endpoint": ["openwhisk"]})
+    {'couchdb': ['openwhisk'], 'openwhisk': ['endpoint'], 'endpoint': []}
+    """
+    graph = prune(graph)
+    return {name: [n for n, after in graph.items() if name in after] for name in graph}
+
+def critical_path(graph, results):
+    """
+    the longest chain of dependent steps by elapsed time, with its duration
+    >>> g = {"couchdb": [], "redis": [], "openwhisk": ["couchdb"]}
+    >>> r = {"couchdb": StepResult("couchdb", elapsed=3), "redis": StepResult("redis", elapsed=4),
+    ...      "openwhisk": StepResult("openwhisk", elapsed=2)}
+    >>> critical_path(g, r)
+    (['couchdb', 'openwhisk'], 5)
+    """
+    graph = prune(graph)
+    best = {}
+    for name in order(graph):
+        elapsed = results[name].elapsed if name in results else 0
+        prev = max((best[d] for d in graph[name]), key=lambda p: p[1], default=([], 0))
+        best[name] = (prev[0] + [name], prev[1] + elapsed)
+    return max(best.values(), key=lambda p: p[1], default=([], 0))
+
+def run(graph, step, workers=None, abort_on_error=True, deadline=None):
+    """
+    execute step(name) for every step of the graph after its dependencies,
+    returning a dict of StepResult by name;
+    when a step raises and abort_on_error is set no more steps are started
+    and the ones not started are skipped, otherwise the run continues;
+    a step running longer than deadline seconds fails with a TimeoutError,
+    it is left running in background and the steps after it are started
+    >>> lock = threading.Lock(); log = []
+    >>> def step(name):
+    ...     with lock: log.append(name)
+    ...     return name.upper()
+    >>> res = run({"couchdb": [], "openwhisk": ["couchdb"], "redis": []}, step, workers=2)
+    >>> [res[n].value for n in ["couchdb", "redis", "openwhisk"]], log[-1]
+    (['COUCHDB', 'REDIS', 'OPENWHISK'], 'openwhisk')
+    >>> def fail(name):
+    ...     if name == "couchdb": raise Exception("boom")
+    >>> res = run({"couchdb": [], "openwhisk": ["couchdb"]}, fail, workers=1)
+    >>> res["couchdb"].error, res["openwhisk"].skipped
+    (Exception('boom'), True)
+    >>> def slow(name):
+    ...     time.sleep(1 if name == "couchdb" else 0)
+    >>> res = run({"couchdb": [], "openwhisk": ["couchdb"]}, slow, deadline=0.1, abort_on_error=False)
+    >>> res["couchdb"].error, res["openwhisk"].ok
+    (TimeoutError('couchdb not completed in 0.1s'), True)
+    """
+    graph = prune(graph)
+    order(graph)
+    workers = max(1, workers or parallelism)
+    origin = time.monotonic()
+    results = {}
+
+    def execute(name, future):
+        start = time.monotonic()
+        try:
+            value, error = step(name), None
+        except Exception as e:
+            value, error = None, e
+        future.set_result(StepResult(name, value, error, start - origin, time.monotonic() - start))
+
+    def launch(name):
+        # a thread per step, so a step past its deadline does not hold a worker
+        # the step runs in the context of the caller, with its configuration and trace
+        future = Future()
+        threading.Thread(target=contextvars.copy_context().run, args=(execute, name, future), name=f"step-{name}", daemon=True).start()
+        return future
+
+    pending = dict(graph)
+    running = {}
+    started = {}
+    aborted = False
+    while pending or running:
+        if not aborted:
+            for name in [n for n, after in pending.items() if all(d in results for d in after)]:
+                if len(running) >= workers:
+                    break
+                del pending[name]
+                started[name] = time.monotonic()
+                running[launch(name)] = name
+        if not running:
+            break
+        timeout = None
+        if deadline:
+            timeout = max(0, min(started[n] for n in running.values()) + deadline - time.monotonic())
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            res = future.result()
+            results[running.pop(future)] = res
+            if res.error is not None:
+                logging.warning(f"step {res.name} failed: {res.error}")
+                aborted = aborted or abort_on_error
+        if deadline:
+            now = time.monotonic()
+            for future, name in list(running.items()):
+                if now - started[name] >= deadline:
+                    del running[future]
+                    error = TimeoutError(f"{name} not completed in {deadline}s")
+                    results[name] = StepResult(name, error=error, start=started[name] - origin, elapsed=now - started[name])
+                    logging.warning(f"step {name} abandoned: {error}")
+                    aborted = aborted or abort_on_error
+    for name in pending:
+        results[name] = StepResult(name, skipped=True)
+    return results
+
+def summary(results):
+    """
+    a table of the steps in the order they started, with their outcome and duration
+    >>> print(summary({"redis": StepResult("redis", "ok", start=0.5, elapsed=1.25),
+    ...                "couchdb": StepResult("couchdb", error=TimeoutError("late"), elapsed=3),
+    ...                "milvus": StepResult("milvus", skipped=True)}))
+    couchdb   timeout    3.0s late
+    redis     done       1.2s
+    milvus    skipped    0.0s
+    """
+    lines = []
+    width = max((len(name) for name in results), default=0) + 2
+    for res in sorted(results.values(), key=lambda r: (r.skipped, r.start)):
+        if res.skipped:
+            status = "skipped"
+        elif isinstance(res.error, TimeoutError):
+            status = "timeout"
+        else:
+            status = "done" if res.ok else "error"
+        line = f"{res.name:{width}} {status:10} {res.elapsed:.1f}s"
+        if res.error is not None:
+            line += f" {res.error}"
+        lines.append(line)
+    return "\n".join(lines)
+
+def first_error(results):
+    """
+    the exception of the earliest failed step, if any
+    """
+    failed = sorted((r for r in results.values() if r.error is not None), key=lambda r: r.start)
+    return failed[0].error if failed else None
@@ -0,0 +1,137 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module imports the component modules only when they are used
+# the handlers refer to lazy modules, so the operator starts without importing
+# the clients of the components (minio, psycopg, ...) the Whisk does not enable;
+# the time spent importing each component is recorded and can be reported
+#
+#   python3 -m nuvolaris.component_registry
+#
+# imports every registered component and prints the report
+import sys, time, logging, importlib, threading
+
+_lock = threading.RLock()
+_modules = {}
+_imports = []
+
+class LazyModule:
+    """
+    A module imported the first time one of its attributes is used.
+    >>> m = lazy("nuvolaris.testutil", "test")
+    >>> m.loaded, callable(m.grep), m.loaded
+    (False, True, True)
+    """
+    def __init__(self, name, component):
+        self.__dict__["_name"] = name
+        self.__dict__["_component"] = component
+        self.__dict__["_module"] = None
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def _load(self):
+        if self._module is None:
+            with _lock:
+                if self._module is None:
+                    before = set(sys.modules)
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    elapsed = time.perf_counter() - start
+                    _imports.append((self._component, self._name, elapsed, sorted(set(sys.modules) - before)))
+                    logging.debug(f"component {self._component} imported {self._name} in {elapsed * 1000:.1f}ms")
+                    self.__dict__["_module"] = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        # tests patch functions of the modules
+        setattr(self._load(), attr, value)
+
+    def deferred(self, attr):
+        """
+        a function calling the attribute of the module, without importing it now
+        """
+        def call(*args, **kwargs):
+            return getattr(self._load(), attr)(*args, **kwargs)
+        call.__name__ = attr
+        call.__qualname__ = f"{self._name}.{attr}"
+        return call
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}' of {self._component}{'' if self.loaded else ', not loaded'}>"
+
+def lazy(name, component=None) -> LazyModule:
+    """
+    the lazy module with the given name, one per module;
+    component groups the modules in the import report
+    """
+    with _lock:
+        if name not in _modules:
+            _modules[name] = LazyModule(name, component or name.rsplit(".", 1)[-1])
+        return _modules[name]
+
+def _packages(modules):
+    """
+    the top level packages of a list of modules, with the number of modules of each
+    >>> _packages(["minio", "minio.api", "urllib3", "nuvolaris.minio_util"])
+    {'minio': 2, 'nuvolaris': 1, 'urllib3': 1}
+    """
+    res = {}
+    for m in modules:
+        top = m.split(".", 1)[0]
+        res[top] = res.get(top, 0) + 1
+    return dict(sorted(res.items(), key=lambda kv: (-kv[1], kv[0])))
+
+def imports():
+    """
+    the imports done so far by component: {component: (seconds, modules, packages)},
+    a module imported by an earlier component is not counted again
+    """
+    res = {}
+    with _lock:
+        for component, name, elapsed, modules in _imports:
+            seconds, count, packages = res.get(component, (0.0, 0, {}))
+            for pkg, n in _packages(modules).items():
+                packages[pkg] = packages.get(pkg, 0) + n
+            res[component] = (seconds + elapsed, count + len(modules), packages)
+    return res
+
+def report():
+    """
+    a table of the import time of each component, slowest first,
+    with the packages it brought in
+    """
+    lines = []
+    for component, (seconds, count, packages) in sorted(imports().items(), key=lambda kv: -kv[1][0]):
+        top = ", ".join(f"{p}({n})" for p, n in list(packages.items())[:5])
+        lines.append(f"{component:20} {seconds * 1000:8.1f}ms {count:5d} modules  {top}")
+    return "\n".join(lines)
+
+def load_all():
+    for module in list(_modules.values()):
+        module._load()
+
+if __name__ == "__main__":
+    # the registry used by the handlers is the imported module, not __main__
+    import nuvolaris.component_registry as registry
+    import nuvolaris.main, nuvolaris.user_handlers
+    registry.load_all()
+    print(registry.report())
@@ -16,34 +16,190 @@
 # under the License.
 #
 import flatdict, json, os
-import logging
+import bisect, logging, threading, functools, contextvars
+from contextlib import contextmanager
+from types import MappingProxyType
+import nuvolaris.component_digest as digests
 
-_config = {}
+class Snapshot:
+    """
+    An immutable flattened configuration; the keys are kept sorted,
+    so the ones with a prefix are found without scanning them all.
+    >>> s = Snapshot({"redis.enabled": True, "couchdb.port": 5984, "couchdb.host": "couchdb"})
+    >>> s.keys("couchdb.")
+    ['couchdb.host', 'couchdb.port']
+    >>> s.with_value("redis.enabled", False).getall("redis")
+    {'redis.enabled': False}
+    >>> s.getall("redis"), s.without("redis.enabled").keys()
+    ({'redis.enabled': True}, ['couchdb.host', 'couchdb.port'])
+    """
+    __slots__ = ("values", "_sorted")
+
+    def __init__(self, values=None):
+        self.values = MappingProxyType(dict(values or {}))
+        self._sorted = None
+
+    def _keys(self):
+        # built on the first prefix lookup, the same for every thread
+        if self._sorted is None:
+            self._sorted = sorted(self.values)
+        return self._sorted
+
+    def keys(self, prefix=""):
+        keys = self._keys()
+        if not prefix:
+            return list(keys)
+        return keys[bisect.bisect_left(keys, prefix):bisect.bisect_left(keys, prefix + "\U0010ffff")]
+
+    def getall(self, prefix=""):
+        return {key: self.values[key] for key in self.keys(prefix)}
+
+    def with_value(self, key, value):
+        return Snapshot({**self.values, key: value})
+
+    def without(self, key):
+        return Snapshot({k: v for k, v in self.values.items() if k != key})
+
+class _Config:
+    # a configuration being built: changes replace the snapshot, never modify it;
+    # in a batch they go to a draft, turned in a snapshot once at the end
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot or Snapshot()
+        self.configured = False
+        self.lock = threading.Lock()
+        self.draft = None
+
+    def update(self, change):
+        with self.lock:
+            self.snapshot = change(self.snapshot)
+
+    def values(self):
+        return self.draft if self.draft is not None else self.snapshot.values
+
+    def current(self) -> Snapshot:
+        return Snapshot(self.draft) if self.draft is not None else self.snapshot
+
+    def replace(self, values):
+        if self.draft is not None:
+            self.draft = dict(values)
+        else:
+            self.update(lambda _: Snapshot(values))
+
+    def set(self, key, value):
+        if self.draft is not None:
+            self.draft[key] = value
+        else:
+            self.update(lambda s: s.with_value(key, value))
+
+    def remove(self, key):
+        if self.draft is not None:
+            self.draft.pop(key, None)
+        else:
+            self.update(lambda s: s.without(key))
+
+# the configuration shared by the process, the last one published by a handler
+_shared = _Config()
+
+# the configuration of the handler running in the current context, if isolated
+_current = contextvars.ContextVar("nuvolaris_config", default=None)
+
+def _active() -> _Config:
+    return _current.get() or _shared
+
+def snapshot() -> Snapshot:
+    """
+    the current configuration, it does not change when the configuration is changed
+    """
+    return _active().current()
+
+@contextmanager
+def batch():
+    """
+    collect the changes of the block in a single new snapshot, built when the block ends;
+    inside the block the changes are visible, outside only when it completes
+    >>> _ = configure({"redis": {"persistence-size": 10}})
+    >>> before = snapshot()
+    >>> with batch():
+    ...     _ = put("redis.persistence-size", 20); _ = put("redis.prefix", "r")
+    ...     get("redis.persistence-size"), snapshot() is before
+    (20, False)
+    >>> getall("redis."), before.getall("redis.")
+    ({'redis.persistence-size': 20, 'redis.prefix': 'r'}, {'redis.persistence-size': 10})
+    """
+    config = _active()
+    if config.draft is not None:
+        yield
+        return
+    config.draft = dict(config.snapshot.values)
+    try:
+        yield
+        draft = config.draft
+        config.update(lambda _: Snapshot(draft))
+    finally:
+        config.draft = None
 
 # define a configuration 
 # the configuration is a map, followed by a list of labels 
 # the map can be a serialized json and will be flattened to a map of values.
 # you can have only a configuration active at a time
 # if you want to set a new configuration you have to clean it
+# in an isolated handler the configuration is visible only to the handler until published
 def configure(spec: dict):
-    global _config
-    _config = dict(flatdict.FlatDict(spec, delimiter="."))
+    values = dict(flatdict.FlatDict(spec, delimiter="."))
 
     #forces autodetect of kube if not provided
-    if not exists('nuvolaris.kube'):
-        put('nuvolaris.kube','auto')
+    if 'nuvolaris.kube' not in values:
+        values['nuvolaris.kube'] = 'auto'
 
+    config = _active()
+    config.replace(values)
+    config.configured = True
     return True
 
 def clean():
-    global _config
-    _config = {}
+    _active().replace({})
+
+def publish():
+    """
+    make the configuration built by an isolated handler the one shared by the process
+    """
+    config = _current.get()
+    if config is not None and config.configured:
+        snap = config.snapshot
+        _shared.update(lambda _: snap)
+
+def isolated(handler):
+    """
+    a decorator running a kopf handler with its own configuration, starting from the shared one:
+    the handler sees its own changes only, and a configuration it defines is published when it succeeds;
+    the threads running for the handler must be started in its context (contextvars.copy_context)
+    >>> _ = configure({"redis": {"persistence-size": 10}})
+    >>> @isolated
+    ... def handler():
+    ...     _ = put("redis.persistence-size", 20)
+    ...     return get("redis.persistence-size")
+    >>> handler(), get("redis.persistence-size")
+    (20, 10)
+    """
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        token = _current.set(_Config(_shared.snapshot))
+        try:
+            res = handler(*args, **kwargs)
+            # a handler failing half way must not leave its configuration to the others
+            publish()
+            return res
+        finally:
+            _current.reset(token)
+    return wrapper
 
 def exists(key):
-    return key in _config
+    digests.note("config", key)
+    return key in _active().values()
 
 def get(key, envvar=None, defval=None):
-    val = _config.get(key)
+    digests.note("config", key)
+    val = _active().values().get(key)
 
     if envvar and envvar in os.environ:
         val = os.environ[envvar]
@@ -53,40 +209,38 @@ def get(key, envvar=None, defval=None):
     
     return defval
 
+# the raw value of a key, without recording its use
+def peek(key):
+    return _active().values().get(key)
+
 def put(key, value):
-    _config[key] = value
+    _active().set(key, value)
     return True
 
 def delete(key):
-    if key in _config:
-        del _config[key]
+    if exists(key):
+        _active().remove(key)
         return True
 
+# the keys with a prefix are recorded as prefix*, all of them are inputs
 def getall(prefix=""):
-    res = {}
-    for key in _config.keys():
-        if key.startswith(prefix):
-            res[key] = _config[key]
-    return res
+    digests.note("config", prefix + "*")
+    return _active().current().getall(prefix)
 
 def keys(prefix=""):
-    res = []
-    if _config:
-        for key in _config.keys():
-            if key.startswith(prefix):
-                res.append(key)
-    return res
+    digests.note("config", prefix + "*")
+    return _active().current().keys(prefix)
 
 def detect_labels(labels=None):    
-    # skip autodetection of nuvolaris.kube if already available in _config
+    # skip autodetection of nuvolaris.kube if already configured
     if exists('nuvolaris.kube') and get('nuvolaris.kube') != 'auto':
         logging.info(f"*** configuration provided already a nuvolaris.kube={get('nuvolaris.kube')}")
         return {}
 
     # read labels if not available
     if not labels:
-        import nuvolaris.kube as kube
-        labels = kube.kubectl("get", "nodes", jsonpath='{.items[].metadata.labels}')        
+        import nuvolaris.cluster_facts as facts
+        labels = facts.get("node_labels")
     
     res = {}
     kube = None
@@ -95,7 +249,7 @@ def detect_labels(labels=None):
             if j.startswith("nuvolaris.io/"):
                 key = f"nuvolaris.{j[13:]}"
                 res[key] = i[j]
-                _config[key] = i[j]
+                put(key, i[j])
 
     for i in labels:
         for j in list(i.keys()):
@@ -128,12 +282,12 @@ def detect_labels(labels=None):
         
     if kube:
         res["nuvolaris.kube"] = kube 
-        _config["nuvolaris.kube"] = kube
+        put("nuvolaris.kube", kube)
         return res
 
     # defaults to generic if it is not yet detected
     if exists('nuvolaris.kube') and get('nuvolaris.kube') == 'auto':
-        _config["nuvolaris.kube"] = "generic"
+        put("nuvolaris.kube", "generic")
         res["nuvolaris.kube"] = "generic"
 
     return res
@@ -141,7 +295,7 @@ def detect_labels(labels=None):
 def detect_storage(storages=None):
     res = {}
     if not storages:
-        import nuvolaris.util as util
+        import nuvolaris.cluster_facts as facts
 
         try:
             detect_storageclass = True
@@ -160,16 +314,16 @@ def detect_storage(storages=None):
                 return res    
 
             if detect_storageclass:
-                storage_class = util.get_default_storage_class()
+                storage_class = facts.get("storageclass")
                 if storage_class:
                     res['nuvolaris.storageclass'] = storage_class
-                    _config['nuvolaris.storageclass'] = storage_class
+                    put('nuvolaris.storageclass', storage_class)
             
             if detect_provisioner:
-                provisioner = util.get_default_storage_provisioner()
+                provisioner = facts.get("provisioner")
                 if(provisioner):
                     res['nuvolaris.provisioner'] = provisioner
-                    _config['nuvolaris.provisioner'] = provisioner
+                    put('nuvolaris.provisioner', provisioner)
         except:
             pass
     return res
@@ -180,7 +334,7 @@ def detect_object_storage(object_storages=None):
     """
     res = {}
     if not object_storages:
-        import nuvolaris.util as util
+        import nuvolaris.cluster_facts as facts
 
         try:
             detect_object_store = True
@@ -209,40 +363,40 @@ def detect_object_storage(object_storages=None):
                 return res    
 
             if detect_object_store:
-                storage_class = util.get_object_storage_class()
+                storage_class = facts.get("object_storageclass")
                 if storage_class:
                     res['cosi.bucket_storageclass'] = storage_class
-                    _config['cosi.bucket_storageclass'] = storage_class
+                    put('cosi.bucket_storageclass', storage_class)
             
             if detect_object_store_rgw_srv_name:
-                rgwsrv = util.get_object_storage_rgw_srv_name()
+                rgwsrv = facts.get("rgw_service_name")
                 if(rgwsrv):
                     res['cosi.rgwservice_name'] = rgwsrv
-                    _config['cosi.rgwservice_name'] = rgwsrv
+                    put('cosi.rgwservice_name', rgwsrv)
 
             if detect_object_store_rgw_srv_port:
-                rgwport = util.get_object_storage_rgw_srv_http_port()
+                rgwport = facts.get("rgw_service_port")
                 if(rgwport):
                     res['cosi.rgwservice_port'] = rgwport
-                    _config['cosi.rgwservice_port'] = rgwport                   
+                    put('cosi.rgwservice_port', rgwport)                   
         except:
             pass
     return res  
 
 def detect_env():
-    _config['operator.image'] = os.environ.get("OPERATOR_IMAGE", "missing-OPERATOR_IMAGE")
-    _config['operator.tag'] = os.environ.get("OPERATOR_TAG", "missing-OPERATOR_TAG")
+    put('operator.image', os.environ.get("OPERATOR_IMAGE", "missing-OPERATOR_IMAGE"))
+    put('operator.tag', os.environ.get("OPERATOR_TAG", "missing-OPERATOR_TAG"))
 
     # skip autodetection of controller.image if already configure into whisk.yaml
     if not exists('controller.image'):
-        _config['controller.image'] = os.environ.get("CONTROLLER_IMAGE", "missing-CONTROLLER_IMAGE")
-        _config['controller.tag'] = os.environ.get("CONTROLLER_TAG", "missing-CONTROLLER_TAG")
+        put('controller.image', os.environ.get("CONTROLLER_IMAGE", "missing-CONTROLLER_IMAGE"))
+        put('controller.tag', os.environ.get("CONTROLLER_TAG", "missing-CONTROLLER_TAG"))
     else:
         logging.warn(f"OW controller image detection skipped. Using {get('controller.image')}")
 
     if not exists('invoker.image'):
-        _config['invoker.image'] = os.environ.get("INVOKER_IMAGE", "missing-INVOKER_IMAGE")
-        _config['invoker.tag'] = os.environ.get("INVOKER_TAG", "missing-INVOKER_TAG")
+        put('invoker.image', os.environ.get("INVOKER_IMAGE", "missing-INVOKER_IMAGE"))
+        put('invoker.tag', os.environ.get("INVOKER_TAG", "missing-INVOKER_TAG"))
     else:
         logging.warn(f"OW invoker image detection skipped. Using {get('invoker.image')}")
 
@@ -30,9 +30,12 @@ from jinja2 import Environment, FileSystemLoader
 loader = FileSystemLoader(["./nuvolaris/templates", "./nuvolaris/files"])
 env = Environment(loader=loader)
 
-def update_templated_doc(db, database, template, data):
+def render_templated_doc(template, data):
     tpl = env.get_template(template)
-    doc = json.loads(tpl.render(data))
+    return json.loads(tpl.render(data))
+
+def update_templated_doc(db, database, template, data):
+    doc = render_templated_doc(template, data)
     return db.update_doc(database, doc)
 
 def create(owner=None):
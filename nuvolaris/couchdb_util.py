@@ -18,6 +18,15 @@
 import os, json, time, sys, logging
 import requests as req
 import nuvolaris.config as cfg
+import nuvolaris.tracing as tracing
+
+# each request is a span of the current trace
+class _Session(req.Session):
+  def request(self, method, url, *args, **kwargs):
+    with tracing.span(method, "couchdb", url=url) as span:
+      res = super().request(method, url, *args, **kwargs)
+      span.set(status=res.status_code)
+      return res
 
 class CouchDB:
   def __init__(self):
@@ -30,14 +39,14 @@ class CouchDB:
     self.db_auth = req.auth.HTTPBasicAuth(self.db_username,self.db_password)
     self.db_url = f"{self.db_protocol}://{self.db_host}:{self.db_port}"
     self.db_base = f"{self.db_url}/{self.db_prefix}"
-    self.db_session = req.Session()
+    self.db_session = _Session()
     self.db_session.auth = self.db_auth
 
   def wait_db_ready(self, max_seconds):
       logging.info("entering CouchDB.wait_db_ready()")
       start = time.time()
       delta = 0
-      session = req.Session()
+      session = _Session()
       while delta < max_seconds:
         try:
           r = session.get(f"{self.db_url}/_utils", timeout=5)
@@ -82,7 +91,7 @@ class CouchDB:
 
   def get_doc(self, database, id, user=None, password="", no_auth=False):
     url = f"{self.db_base}{database}/{id}"
-    session = req.Session()
+    session = _Session()
     if no_auth:
       db_auth=None
     elif user:
@@ -107,6 +116,23 @@ class CouchDB:
       return r.status_code in [200,201]
     return False
 
+  # create or update many documents with two requests, return the outcome by id
+  def bulk_update_docs(self, database, docs):
+    docs = [doc for doc in docs if '_id' in doc]
+    if not docs:
+      return {}
+    r = self.db_session.post(f"{self.db_base}{database}/_all_docs", json={"keys": [doc['_id'] for doc in docs]})
+    if r.status_code != 200:
+      return {doc['_id']: False for doc in docs}
+    revs = {row['key']: row['value']['rev'] for row in r.json().get('rows', []) if 'value' in row and not row['value'].get('deleted')}
+    for doc in docs:
+      if doc['_id'] in revs:
+        doc['_rev'] = revs[doc['_id']]
+    r = self.db_session.post(f"{self.db_base}{database}/_bulk_docs", json={"docs": docs})
+    if r.status_code not in [200, 201]:
+      return {doc['_id']: False for doc in docs}
+    return {row['id']: 'error' not in row for row in r.json()}
+
   def delete_doc(self, database, id):
     cur = self.get_doc(database, id)
     if cur and '_rev' in cur:
@@ -152,7 +178,7 @@ class CouchDB:
   def find_doc(self, database, selector, user=None, password="", no_auth=False):
     url = f"{self.db_base}{database}/_find"
     headers = {'Content-Type': 'application/json'}
-    session = req.Session()
+    session = _Session()
 
     if no_auth:
       db_auth=None
@@ -59,9 +59,7 @@ def deploy_info_route(apihost,namespace):
     os.remove(path_to_template_yaml)        
     return res 
 
-def deploy_api_routes(apihost,namespace,should_create_www=False):
-    logging.info(f"**** configuring openshift route based endpoint for apihost {apihost}")
-
+def _api_routes(apihost, namespace, should_create_www=False):
     api = RouteData(apihost)
     api.with_route_name(api_route_name(namespace,"apihost"))
     api.with_service_name("controller-ip")
@@ -78,15 +76,7 @@ def deploy_api_routes(apihost,namespace,should_create_www=False):
     my.with_context_path("/api/my")
     my.with_rewrite_target(f"/api/v1/web/namespace/{namespace}")  
 
-    logging.info(f"*** configuring route for apihost")
-    path_to_template_yaml =  api.render_template(namespace)
-    res = kube.kubectl("apply", "-f",path_to_template_yaml)
-    os.remove(path_to_template_yaml)
-
-    logging.info(f"*** configuring route for apihost-my")
-    path_to_template_yaml =  my.render_template(namespace)
-    res += kube.kubectl("apply", "-f",path_to_template_yaml)
-    os.remove(path_to_template_yaml) 
+    routes = [("apihost", api), ("apihost-my", my)]
 
     if should_create_www:
             www_my = RouteData(apihost_util.append_prefix_to_url(apihost,"www"))
@@ -96,11 +86,18 @@ def deploy_api_routes(apihost,namespace,should_create_www=False):
             www_my.with_service_port("8080")
             www_my.with_context_path("/api/my")
             www_my.with_rewrite_target(f"/api/v1/web/namespace/{namespace}") 
+            routes.append(("apihost-www-my", www_my))
 
-            logging.info(f"*** configuring route for apihost-www-my")
-            path_to_template_yaml =  www_my.render_template(namespace)
-            res += kube.kubectl("apply", "-f",path_to_template_yaml)
-            os.remove(path_to_template_yaml) 
+    return routes
+
+def deploy_api_routes(apihost,namespace,should_create_www=False):
+    logging.info(f"**** configuring openshift route based endpoint for apihost {apihost}")
+    res = ""
+    for name, route in _api_routes(apihost, namespace, should_create_www):
+        logging.info(f"*** configuring route for {name}")
+        path_to_template_yaml =  route.render_template(namespace)
+        res += kube.kubectl("apply", "-f",path_to_template_yaml)
+        os.remove(path_to_template_yaml)
         
     return res
 
@@ -130,9 +127,7 @@ def deploy_info_ingress(apihost, namespace):
     return res     
     
 
-def deploy_api_ingresses(apihost, namespace,should_create_www=False):
-    logging.info(f"**** configuring ingresses based endpoint for apihost {apihost}")
-    res = ""   
+def _api_ingresses(apihost, namespace, should_create_www=False):
     api = IngressData(apihost)
     api.with_ingress_name(api_ingress_name(namespace,"apihost"))
     api.with_secret_name(api_secret_name(namespace))
@@ -153,27 +148,7 @@ def deploy_api_ingresses(apihost, namespace,should_create_www=False):
     my.with_service_port("3233")
     my.with_middleware_ingress_name(api_middleware_ingress_name(namespace,"apihost-my"))
 
-    if api.requires_traefik_middleware():
-        logging.info("*** configuring traefik middleware for apihost ingress")
-        path_to_template_yaml = api.render_traefik_middleware_template(namespace)
-        res += kube.kubectl("apply", "-f",path_to_template_yaml)
-        os.remove(path_to_template_yaml)
-
-    if my.requires_traefik_middleware():
-        logging.info("*** configuring traefik middleware for apihost-my ingress")
-        path_to_template_yaml = my.render_traefik_middleware_template(namespace)
-        res += kube.kubectl("apply", "-f",path_to_template_yaml)
-        os.remove(path_to_template_yaml)        
-
-    logging.info(f"*** configuring static ingress for apihost")
-    path_to_template_yaml = api.render_template(namespace)
-    res += kube.kubectl("apply", "-f",path_to_template_yaml)
-    os.remove(path_to_template_yaml)
-
-    logging.info(f"*** configuring static ingress for apihost-my")
-    path_to_template_yaml = my.render_template(namespace)
-    res += kube.kubectl("apply", "-f",path_to_template_yaml)
-    os.remove(path_to_template_yaml)
+    ingresses = [("apihost", api), ("apihost-my", my)]
 
     if should_create_www:
         www_my = IngressData(apihost_util.append_prefix_to_url(apihost,"www"))
@@ -185,19 +160,29 @@ def deploy_api_ingresses(apihost, namespace,should_create_www=False):
         www_my.with_service_name("controller")
         www_my.with_service_port("3233")
         www_my.with_middleware_ingress_name(api_middleware_ingress_name(namespace,"apihost-www-my"))
+        ingresses.append(("apihost-www-my", www_my))
+
+    return ingresses
+
+def deploy_api_ingresses(apihost, namespace,should_create_www=False):
+    logging.info(f"**** configuring ingresses based endpoint for apihost {apihost}")
+    res = ""   
+    ingresses = _api_ingresses(apihost, namespace, should_create_www)
 
-        if www_my.requires_traefik_middleware():
-            logging.info("*** configuring traefik middleware for apihost-www-my ingress")
-            path_to_template_yaml = www_my.render_traefik_middleware_template(namespace)
+    for name, ingress in ingresses:
+        if ingress.requires_traefik_middleware():
+            logging.info(f"*** configuring traefik middleware for {name} ingress")
+            path_to_template_yaml = ingress.render_traefik_middleware_template(namespace)
             res += kube.kubectl("apply", "-f",path_to_template_yaml)
             os.remove(path_to_template_yaml)
 
-        logging.info(f"*** configuring static ingress for apihost-www-my")
-        path_to_template_yaml = www_my.render_template(namespace)
+    for name, ingress in ingresses:
+        logging.info(f"*** configuring static ingress for {name}")
+        path_to_template_yaml = ingress.render_template(namespace)
         res += kube.kubectl("apply", "-f",path_to_template_yaml)
-        os.remove(path_to_template_yaml)                     
+        os.remove(path_to_template_yaml)
 
-    return res 
+    return res
 
 def create(owner=None):
     runtime = cfg.get('nuvolaris.kube')
@@ -304,6 +289,34 @@ def create_ow_api_endpoint(ucfg, user_metadata: UserMetadata, owner=None):
         logging.warn(e)       
         return False
 
+def _read(path_to_template_yaml):
+    with open(path_to_template_yaml) as f:
+        res = f.read()
+    os.remove(path_to_template_yaml)
+    return res
+
+def api_endpoint_manifests(ucfg, user_metadata: UserMetadata):
+    """
+    the manifests of the api endpoint of a user, rendered but not applied,
+    to deploy the endpoints of many users in one pass
+    """
+    runtime = cfg.get('nuvolaris.kube')
+    namespace = ucfg.get("namespace")
+    apihost = ucfg.get("apihost") or "auto"
+    hostname = apihost_util.get_user_static_hostname(runtime, namespace, apihost)
+
+    apihost_url = apihost_util.get_user_static_url(runtime, hostname)
+    my_url = apihost_util.get_user_api_url(runtime, hostname,"api/my")
+    user_metadata.add_metadata("USER_REST_API_URL",my_url)
+    user_metadata.add_metadata("USER_V1_API_URL",apihost_url)
+
+    if runtime == 'openshift':
+        return [_read(route.render_template(namespace)) for _, route in _api_routes(apihost_url, namespace)]
+
+    ingresses = _api_ingresses(apihost_url, namespace)
+    res = [_read(ingress.render_traefik_middleware_template(namespace)) for _, ingress in ingresses if ingress.requires_traefik_middleware()]
+    return res + [_read(ingress.render_template(namespace)) for _, ingress in ingresses]
+
 def delete_ow_api_endpoint(ucfg):
     """
     undeploy the ingresses
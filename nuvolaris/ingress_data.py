@@ -111,8 +111,7 @@ class IngressData:
         uses the given template to render a final ingress template and returns the path to the template
         """
         logging.info(f"*** Rendering ingress template using host {self._data['hostname']} endpoint for {self._data['ingress_name']} via template {tpl}")  
-        out = f"/tmp/__{namespace}_{tpl}"
-        file = ntp.spool_template(tpl, out, self._data)
+        file = ntp.spool_temp_template(tpl, namespace, self._data)
         return os.path.abspath(file)
 
     def render_traefik_middleware_template(self, namespace,tpl="traefik-middleware-tpl.yaml"):
@@ -120,6 +119,5 @@ class IngressData:
         uses the given template policy to render a final ingress template. By default renders an addPrefix middleware.
         """  
         logging.info(f"*** Rendering traefik middleware template using host {self._data['hostname']} endpoint for {self._data['ingress_name']} via template {tpl}")
-        out = f"/tmp/__{namespace}_{tpl}"
-        file = ntp.spool_template(tpl, out, self._data)
+        file = ntp.spool_temp_template(tpl, namespace, self._data)
         return os.path.abspath(file)
@@ -18,6 +18,7 @@
 import kopf, logging, json
 import nuvolaris.kube as kube
 import nuvolaris.kustomize as kus
+import nuvolaris.template as ntp
 import nuvolaris.config as cfg
 import nuvolaris.operator_util as operator_util
 
@@ -49,8 +50,7 @@ def create(owner=None):
         "runtime": runtime
     }
     
-    kust = kus.patchTemplate("issuer", "cluster-issuer.yaml", data)
-    spec = "deploy/issuer/__cluster-issuer.yaml"
+    spec = ntp.spool_template("cluster-issuer.yaml", "deploy/issuer/__cluster-issuer.yaml", data)
 
     cfg.put("state.issuer.spec", spec)
     res = kube.kubectl("apply", "-f", spec,namespace=None)
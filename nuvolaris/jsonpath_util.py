@@ -0,0 +1,210 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module evaluates the subset of the kubectl jsonpath syntax
+# used by the operator, returning the same list of results
+# that kubectl prints with -o jsonpath-as-json
+import re
+import json
+
+class UnsupportedJsonPath(Exception):
+    pass
+
+_FILTER = re.compile(r"^@((?:\.(?:\\.|[^.=!<>\s])+)*)\s*(?:(==|!=|<=|>=|<|>)\s*(.+?))?\s*$")
+
+def _split_fields(path):
+    r"""
+    split a dotted path honouring the \. and \/ escapes
+    >>> _split_fields(r".metadata.annotations.storageclass\.kubernetes\.io\/is-default-class")
+    ['metadata', 'annotations', 'storageclass.kubernetes.io/is-default-class']
+    """
+    fields = []
+    current = ""
+    i = 0
+    while i < len(path):
+        c = path[i]
+        if c == "\\" and i+1 < len(path):
+            current += path[i+1]
+            i += 2
+            continue
+        if c == ".":
+            if current:
+                fields.append(current)
+            current = ""
+        else:
+            current += c
+        i += 1
+    if current:
+        fields.append(current)
+    return fields
+
+def _literal(value):
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+        return value[1:-1]
+    try:
+        return json.loads(value)
+    except Exception:
+        raise UnsupportedJsonPath(f"unsupported literal {value}")
+
+def _compare(left, op, right):
+    if op == "==":
+        return left == right or str(left) == str(right)
+    if op == "!=":
+        return not (left == right or str(left) == str(right))
+    try:
+        if op == "<":  return left < right
+        if op == ">":  return left > right
+        if op == "<=": return left <= right
+        if op == ">=": return left >= right
+    except TypeError:
+        return False
+    raise UnsupportedJsonPath(f"unsupported operator {op}")
+
+def _tokenize(expr):
+    """
+    split an expression into field and bracket tokens
+    >>> _tokenize(".items[?(@.metadata.labels.name == 'redis')].metadata.name")
+    [('field', 'items'), ('filter', "@.metadata.labels.name == 'redis'"), ('field', 'metadata'), ('field', 'name')]
+    >>> _tokenize(".items[*].spec.ports[0]")
+    [('field', 'items'), ('all', None), ('field', 'spec'), ('field', 'ports'), ('index', 0)]
+    """
+    tokens = []
+    i = 0
+    while i < len(expr):
+        c = expr[i]
+        if c == "[":
+            depth = 0
+            quote = None
+            j = i
+            while j < len(expr):
+                d = expr[j]
+                if quote:
+                    if d == quote:
+                        quote = None
+                elif d in "'\"":
+                    quote = d
+                elif d == "[":
+                    depth += 1
+                elif d == "]":
+                    depth -= 1
+                    if depth == 0:
+                        break
+                j += 1
+            if j >= len(expr):
+                raise UnsupportedJsonPath(f"unbalanced brackets in {expr}")
+            inner = expr[i+1:j].strip()
+            if inner in ["", "*"]:
+                tokens.append(("all", None))
+            elif inner.startswith("?(") and inner.endswith(")"):
+                tokens.append(("filter", inner[2:-1].strip()))
+            elif re.match(r"^-?\d+$", inner):
+                tokens.append(("index", int(inner)))
+            elif len(inner) >= 2 and inner[0] == inner[-1] and inner[0] in "'\"":
+                tokens.append(("field", inner[1:-1]))
+            else:
+                raise UnsupportedJsonPath(f"unsupported subscript [{inner}]")
+            i = j + 1
+        else:
+            j = i
+            while j < len(expr) and expr[j] != "[":
+                if expr[j] == "\\":
+                    j += 1
+                j += 1
+            for field in _split_fields(expr[i:j]):
+                if field == "*":
+                    tokens.append(("all", None))
+                else:
+                    tokens.append(("field", field))
+            i = j
+    return tokens
+
+def _step(values, token):
+    kind, arg = token
+    res = []
+    for value in values:
+        if kind == "field":
+            if isinstance(value, dict) and arg in value:
+                res.append(value[arg])
+        elif kind == "index":
+            if isinstance(value, list) and -len(value) <= arg < len(value):
+                res.append(value[arg])
+        elif kind == "all":
+            if isinstance(value, list):
+                res.extend(value)
+            elif isinstance(value, dict):
+                res.extend(value.values())
+        elif kind == "filter":
+            if not isinstance(value, list):
+                continue
+            m = _FILTER.match(arg)
+            if not m:
+                raise UnsupportedJsonPath(f"unsupported filter {arg}")
+            fields, op, literal = m.groups()
+            path = [("field", f) for f in _split_fields(fields or "")]
+            for item in value:
+                found = _walk([item], path)
+                if op is None:
+                    if found:
+                        res.append(item)
+                elif found and _compare(found[0], op, _literal(literal)):
+                    res.append(item)
+    return res
+
+def _walk(values, tokens):
+    for token in tokens:
+        values = _step(values, token)
+    return values
+
+def evaluate(obj, jsonpath):
+    r"""
+    evaluate a kubectl jsonpath against an object, returning the list of matches
+    as printed by `kubectl -o jsonpath-as-json`
+    >>> pods = {"kind": "List", "items": [
+    ...   {"metadata": {"name": "redis-0", "labels": {"name": "redis"}}, "spec": {"replicas": 1}},
+    ...   {"metadata": {"name": "couchdb-0", "labels": {"name": "couchdb"},
+    ...                 "annotations": {"whisks.nuvolaris.org/annotate-version": "true"}}}]}
+    >>> evaluate(pods, "{.items[?(@.metadata.labels.name == 'redis')].metadata.name}")
+    ['redis-0']
+    >>> evaluate(pods, "{.items[*].metadata.name}")
+    ['redis-0', 'couchdb-0']
+    >>> evaluate(pods, "{.items[].metadata.labels}")
+    [{'name': 'redis'}, {'name': 'couchdb'}]
+    >>> [p["metadata"]["name"] for p in evaluate(pods, r"{.items[?(@.metadata.annotations.whisks\.nuvolaris\.org\/annotate-version)]}")]
+    ['couchdb-0']
+    >>> evaluate(pods, "{.items[0].spec.replicas}")
+    [1]
+    >>> evaluate(pods, "{.items[1].spec.replicas}")
+    []
+    >>> evaluate({"a": 1}, "{@}")
+    [{'a': 1}]
+    >>> svc = {"spec": {"ports": [{"name": "http", "port": 80}, {"name": "https", "port": 443}]}}
+    >>> evaluate(svc, "{.spec.ports[?(@.name=='http')].port}")
+    [80]
+    >>> evaluate(svc, "{.spec.ports[?(@.port > 100)].name}")
+    ['https']
+    """
+    expr = jsonpath.strip()
+    if expr.startswith("{") and expr.endswith("}"):
+        expr = expr[1:-1].strip()
+    if "{" in expr or "}" in expr or ".." in expr or "range" in expr:
+        raise UnsupportedJsonPath(f"unsupported jsonpath {jsonpath}")
+    if expr.startswith("$"):
+        expr = expr[1:]
+    if expr.startswith("@"):
+        expr = expr[1:]
+    return _walk([obj], _tokenize(expr))
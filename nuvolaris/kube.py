@@ -18,12 +18,27 @@
 # this module wraps kubectl
 import nuvolaris.testutil as tu
 import nuvolaris.template as tpl
+import nuvolaris.kube_api as kube_api
+import nuvolaris.jsonpath_util as jsonpath_util
+import nuvolaris.kube_cache as kube_cache
+import nuvolaris.component_digest as digests
+import nuvolaris.tracing as tracing
+import nuvolaris.metrics as metrics
 import subprocess
 import json
+import hashlib
 import logging
+import os
+import threading
+import contextvars
+import time
 import yaml
+import requests
+from concurrent.futures import ThreadPoolExecutor
 
 
+# results of the last call, kept for compatibility
+# prefer the KubeResult returned by run() when calls can be concurrent
 output = ""
 error = ""
 returncode = -1
@@ -32,51 +47,284 @@ dry_run = False
 
 mocker = tu.MockKube()
 
-# execute kubectl commands
-# default namespace is nuvolaris, you can change with keyword arg namespace
-# default output is text
-# if you specify jsonpath it will filter and parse the json output
-# returns exceptions if errors
-def kubectl(*args, namespace="nuvolaris", input=None, jsonpath=None, debugresult=True, timeout=None):
-    # support for mocked requests
-    mres = mocker.invoke(*args)
-    if mres:
-        mocker.save(input)
-        return mres
+# in-process api server backend, when None every call forks kubectl
+backend = None
+
+# maximum number of kubectl processes or api requests in flight at the same time
+max_inflight = int(os.environ.get("NUVOLARIS_KUBE_MAX_INFLIGHT", "8"))
+_inflight = threading.BoundedSemaphore(max_inflight)
+# waits last until a condition is met, they have their own bound and do not hold up the others
+max_waiting = int(os.environ.get("NUVOLARIS_KUBE_MAX_WAITING", "16"))
+_waiting = threading.BoundedSemaphore(max_waiting)
+# seconds a call waits for a free slot before giving up
+slot_timeout = float(os.environ.get("NUVOLARIS_KUBE_SLOT_TIMEOUT", "120"))
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+class KubeResult:
+    """
+    The outcome of a single kube call.
+    >>> r = KubeResult(["get", "ns"], returncode=0, output="ok", value="ok")
+    >>> r.ok, r.result()
+    (True, 'ok')
+    >>> import nuvolaris.testutil as tu
+    >>> tu.catch(KubeResult(["error"], returncode=1, error="boom").result)
+    <class 'Exception'> boom
+    """
+    def __init__(self, args, returncode=-1, output="", error="", value=None, elapsed=0.0, cancelled=False, timed_out=False):
+        self.args = list(args)
+        self.returncode = returncode
+        self.output = output
+        self.error = error
+        self.value = value
+        self.elapsed = elapsed
+        self.cancelled = cancelled
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def result(self):
+        if self.timed_out:
+            raise subprocess.TimeoutExpired(self.args, self.elapsed, self.output, self.error)
+        if not self.ok:
+            raise Exception(self.error)
+        return self.value
+
+    def __repr__(self):
+        return f"KubeResult({' '.join(self.args)!r}, returncode={self.returncode})"
+
+class KubeCall:
+    """
+    A kube call submitted to the worker pool, that can be awaited or cancelled.
+    """
+    def __init__(self, future, cancel_event):
+        self.future = future
+        self.cancel_event = cancel_event
+
+    def result(self, timeout=None) -> KubeResult:
+        return self.future.result(timeout)
+
+    def done(self):
+        return self.future.done()
+
+    def cancel(self):
+        self.cancel_event.set()
+        return self.future.cancel()
+
+# resize the executor, waiting calls are not affected
+def configure_executor(inflight):
+    global max_inflight, _inflight, _pool
+    with _pool_lock:
+        max_inflight = inflight
+        _inflight = threading.BoundedSemaphore(inflight)
+        old, _pool = _pool, None
+    if old:
+        old.shutdown(wait=False)
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix="kube")
+        return _pool
+
+# select the backend used to talk to the api server
+# pass None to go back to forking kubectl
+def set_backend(api):
+    global backend
+    backend = api
+    logging.info("kube backend: %s", api and f"in-process api {api.server}" or "kubectl")
+
+# enable the in-process backend using the credentials kopf logged in with
+# set NUVOLARIS_KUBE_BACKEND=kubectl to keep forking kubectl
+def configure_backend(credentials):
+    if os.environ.get("NUVOLARIS_KUBE_BACKEND", "api") == "kubectl":
+        set_backend(None)
+        return
+    try:
+        set_backend(kube_api.KubeApi.from_kopf(credentials))
+    except Exception as e:
+        logging.warning(f"cannot configure the in-process kube backend, using kubectl: {e}")
+        set_backend(None)
+        return
+    try:
+        kube_cache.start(backend)
+    except Exception as e:
+        logging.warning(f"cannot start the kube cache: {e}")
+
+# try to serve the request with the in-process backend
+# returns None if the kubectl fallback must be used: unauthorized, a jsonpath
+# the backend cannot evaluate, or the api server not reachable
+def _run_backend(args, namespace, input, jsonpath, debugresult, timeout):
+    try:
+        cached = kube_cache.answer(backend, list(args), namespace, jsonpath)
+        if cached is not NotImplemented:
+            return KubeResult(args, returncode=0, output=cached[1], value=cached[0])
+    except kube_api.KubeApiError as e:
+        return KubeResult(args, returncode=1, error=str(e))
+    except jsonpath_util.UnsupportedJsonPath:
+        return None
+    try:
+        res = backend.invoke(list(args), namespace=namespace, input=input, jsonpath=jsonpath, timeout=timeout)
+    except kube_api.KubeApiUnauthorized:
+        logging.warning("kube backend unauthorized, falling back to kubectl")
+        return None
+    except kube_api.KubeApiError as e:
+        logging.info(f"Error: kube api {list(args)} input='{input}' error='{e}'")
+        return KubeResult(args, returncode=1, error=str(e))
+    except jsonpath_util.UnsupportedJsonPath as e:
+        logging.debug(f"kube backend cannot evaluate {jsonpath}, falling back to kubectl: {e}")
+        return None
+    except requests.Timeout as e:
+        # the request may have reached the server, repeating it with kubectl is not safe
+        logging.info(f"Error: kube api {list(args)} timed out: {e}")
+        return KubeResult(args, returncode=-1, error=str(e), timed_out=True, elapsed=timeout)
+    except requests.RequestException as e:
+        logging.warning(f"kube backend {list(args)} failed, falling back to kubectl: {e}")
+        return None
+    if res is NotImplemented:
+        return None
+    if jsonpath and debugresult:
+        logging.debug("result: %s", json.dumps(res, indent=2))
+    out = res if isinstance(res, str) else json.dumps(res)
+    return KubeResult(args, returncode=0, output=out, value=res)
 
+def _run_kubectl(args, namespace, input, jsonpath, debugresult, timeout, cancel):
     cmd = namespace and ["kubectl", "-n", namespace] or ["kubectl"]
     cmd += list(args)
     if jsonpath:
         cmd += ["-o", "jsonpath-as-json=%s" % jsonpath]
 
+    # objects are serialized only here, when they must cross a process boundary
+    if isinstance(input, (dict, list)):
+        input = json.dumps(input)
     # if is a string, convert input in bytes
     try: input = input.encode('utf-8')
     except: pass
-        
+
     # executing
     logging.debug(cmd)
-    res = subprocess.run(cmd, capture_output=True, input=input, timeout=timeout)
-
-    global returncode, output, error
-    returncode = res.returncode
-    output = res.stdout.decode()
-    error = res.stderr.decode()
+    deadline = timeout and time.monotonic() + timeout
+    proc = subprocess.Popen(cmd, stdin=input is not None and subprocess.PIPE or subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    pending = input
+    while True:
+        wait = 0.5 if cancel else None
+        if deadline:
+            wait = max(0, min(wait or timeout, deadline - time.monotonic()))
+        try:
+            stdout, stderr = proc.communicate(input=pending, timeout=wait)
+            break
+        except subprocess.TimeoutExpired:
+            pending = None
+            if cancel and cancel.is_set():
+                proc.kill()
+                stdout, stderr = proc.communicate()
+                return KubeResult(args, returncode=-1, output=stdout.decode(), error="cancelled", cancelled=True)
+            if deadline and time.monotonic() >= deadline:
+                proc.kill()
+                stdout, stderr = proc.communicate()
+                return KubeResult(args, returncode=-1, output=stdout.decode(), error=stderr.decode(), timed_out=True, elapsed=timeout)
 
+    res = KubeResult(args, returncode=proc.returncode, output=stdout.decode(), error=stderr.decode())
     if res.returncode == 0:
+        res.value = res.output
         if jsonpath:
-                try:
-                    parsed = json.loads(output)
-                    if debugresult:
-                        logging.debug("result: %s", json.dumps(parsed, indent=2))
-                    return parsed
-                except Exception as e:
-                    logging.info(output)
-                    logging.info(e)
-                    return e
+            try:
+                res.value = json.loads(res.output)
+                if debugresult:
+                    logging.debug("result: %s", json.dumps(res.value, indent=2))
+            except Exception as e:
+                logging.info(res.output)
+                logging.info(e)
+                res.value = e
+    else:
+        logging.info(f"Error: kubectl f{cmd} input='{input}' output='{res.output}' error='{res.error}'")
+    return res
+
+# the semaphore bounding the call: waits and rollout status have their own
+def _slot(args):
+    """
+    >>> _slot(["wait", "pod/x", "--for=condition=ready"]) is _waiting, _slot(["rollout", "status", "sts/x"]) is _waiting
+    (True, True)
+    >>> _slot(["get", "pods"]) is _inflight, _slot(["rollout", "restart", "sts/x"]) is _inflight
+    (True, True)
+    """
+    if args and (args[0] == "wait" or list(args[:2]) == ["rollout", "status"]):
+        return _waiting
+    return _inflight
+
+# execute a kube call returning its own KubeResult, never raising for kubectl errors
+# input can be a text or the objects themselves, passed as they are to the backend
+# at most max_inflight calls (max_waiting waits) are executed at the same time,
+# a call not finding a slot within slot_timeout seconds (or its timeout) times out
+# timeout is in seconds, cancel is an optional threading.Event aborting the call
+def run(*args, namespace="nuvolaris", input=None, jsonpath=None, debugresult=True, timeout=None, cancel=None) -> KubeResult:
+    # support for mocked requests
+    mres = mocker.invoke(*args)
+    if mres:
+        mocker.save(input)
+        return KubeResult(args, returncode=0, output=mres, value=mres)
+
+    if cancel and cancel.is_set():
+        return KubeResult(args, error="cancelled", cancelled=True)
+
+    start = time.monotonic()
+    used = "api"
+    with tracing.span(args and args[0] or "kubectl", "kube", args=args, namespace=namespace) as span:
+        slot = _slot(args)
+        if not slot.acquire(timeout=min(timeout or slot_timeout, slot_timeout)):
+            logging.warning(f"no free slot for kube call {list(args)}")
+            res = KubeResult(args, error="no free slot for the kube call", timed_out=True)
         else:
-            return output
-    logging.info(f"Error: kubectl f{cmd} input='{input}' output='{output}' error='{error}'")
-    raise Exception(error)
+            try:
+                res = None
+                if backend:
+                    res = _run_backend(args, namespace, input, jsonpath, debugresult, timeout)
+                if res is None:
+                    used = "kubectl"
+                    span.set(kubectl=True)
+                    res = _run_kubectl(args, namespace, input, jsonpath, debugresult, timeout, cancel)
+            finally:
+                slot.release()
+        span.set(returncode=res.returncode)
+    res.elapsed = time.monotonic() - start
+    metrics.observe_kube(args and args[0] or "", used, res.elapsed, res.ok or res.cancelled)
+    return res
+
+# submit a kube call to the worker pool, returns a KubeCall
+def submit(*args, **kwargs) -> KubeCall:
+    cancel = kwargs.pop("cancel", None) or threading.Event()
+    future = _executor().submit(contextvars.copy_context().run, run, *args, cancel=cancel, **kwargs)
+    return KubeCall(future, cancel)
+
+# the last result of the calling thread
+def last_result():
+    return getattr(_local, "result", None)
+
+def _remember(res: KubeResult):
+    global returncode, output, error
+    _local.result = res
+    returncode, output, error = res.returncode, res.output, res.error
+
+# execute kubectl commands
+# default namespace is nuvolaris, you can change with keyword arg namespace
+# default output is text
+# if you specify jsonpath it will filter and parse the json output
+# returns exceptions if errors
+def kubectl(*args, namespace="nuvolaris", input=None, jsonpath=None, debugresult=True, timeout=None):
+    # support for mocked requests
+    mres = mocker.invoke(*args)
+    if mres:
+        mocker.save(input)
+        return mres
+
+    res = run(*args, namespace=namespace, input=input, jsonpath=jsonpath, debugresult=debugresult, timeout=timeout)
+    _remember(res)
+    return res.result()
 
 # create a configmap from keyword arguments
 def configMap(name, **kwargs):
@@ -103,6 +351,7 @@ data: {}
 # delete an object
 def delete(obj, namespace="nuvolaris"):
     # tested with apply
+    forget(obj, namespace)
     if not isinstance(obj, str):
         obj = json.dumps(obj)
     return kubectl("delete", "-f", "-", namespace=namespace, input=obj)
@@ -115,16 +364,223 @@ def ctl(arg, jsonpath='{@}', flatten=False):
         return dict(flatdict.FlatterDict(data, delimiter="."))
     return data
 
-# apply an object
-def apply(obj, namespace="nuvolaris"):
-    if not isinstance(obj, str):
-        obj = json.dumps(obj)
-    return kubectl("apply", "-f", "-", namespace=namespace, input=obj)
+# annotation holding the hash of the applied spec
+SPEC_HASH = "nuvolaris.org/spec-hash"
+_SPEC_HASH_JSONPATH = r"{.metadata.annotations.nuvolaris\.org\/spec-hash}"
+
+# skip the objects whose spec did not change since the last apply
+skip_unchanged = os.environ.get("NUVOLARIS_SKIP_UNCHANGED", "on") != "off"
+
+# seconds an object is trusted unchanged after its last apply, then it is applied again
+# to correct any drift of the live object
+applied_max_age = float(os.environ.get("NUVOLARIS_APPLIED_MAX_AGE", "3600"))
+
+# (hash, time) of the last applied spec, by (apiVersion, kind, namespace, name)
+_applied = {}
+_applied_lock = threading.Lock()
+# the hash annotation of the live objects is trusted until a forced apply
+_live_trusted = True
+
+def spec_hash(obj):
+    """
+    hash of an object as rendered, ignoring its own hash annotation
+    >>> a = {"kind": "ConfigMap", "metadata": {"name": "a"}, "data": {"x": "1", "y": "2"}}
+    >>> b = {"data": {"y": "2", "x": "1"}, "metadata": {"name": "a", "annotations": {SPEC_HASH: "old"}}, "kind": "ConfigMap"}
+    >>> spec_hash(a) == spec_hash(b)
+    True
+    >>> spec_hash(a) == spec_hash({**a, "data": {"x": "2"}})
+    False
+    """
+    meta = dict(obj.get("metadata", {}))
+    annotations = {k: v for k, v in meta.get("annotations", {}).items() if k != SPEC_HASH}
+    if annotations:
+        meta["annotations"] = annotations
+    else:
+        meta.pop("annotations", None)
+    data = json.dumps({**obj, "metadata": meta}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+def _stamped(obj, digest):
+    """
+    a copy of the object annotated with its hash, sharing everything but the metadata
+    >>> a = {"kind": "ConfigMap", "metadata": {"name": "a"}, "data": {"x": "1"}}
+    >>> b = _stamped(a, "h")
+    >>> b["metadata"]["annotations"][SPEC_HASH], "annotations" in a["metadata"], b["data"] is a["data"]
+    ('h', False, True)
+    """
+    meta = dict(obj.get("metadata", {}))
+    meta["annotations"] = {**meta.get("annotations", {}), SPEC_HASH: digest}
+    return {**obj, "metadata": meta}
+
+def _key(obj, namespace):
+    meta = obj.get("metadata", {})
+    return (obj.get("apiVersion"), obj.get("kind"), meta.get("namespace") or namespace, meta.get("name"))
+
+def _live_hash(obj, namespace):
+    api_version, kind, ns, name = _key(obj, namespace)
+    if backend:
+        try:
+            resource = backend.resolve_kind(api_version, kind)
+            inf = kube_cache.informer(resource.plural)
+            if inf and inf.covers(ns) and inf.consistent(0):
+                cached = inf.get(name, ns)
+                return cached and cached["metadata"].get("annotations", {}).get(SPEC_HASH)
+        except Exception:
+            pass
+    res = run("get", _display(obj), namespace=ns, jsonpath=_SPEC_HASH_JSONPATH, debugresult=False)
+    return res.ok and res.value and res.value[0] or None
+
+def _display(obj):
+    group = obj["apiVersion"].split("/")[0] if "/" in obj["apiVersion"] else ""
+    kind = obj["kind"].lower()
+    return f"{kind}.{group}/{obj['metadata']['name']}" if group else f"{kind}/{obj['metadata']['name']}"
+
+def _unchanged(obj, namespace, digest):
+    """
+    true if the object was applied with the same hash recently; an object not
+    in the index (after a restart) is compared with the hash of the live one
+    >>> obj = {"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": "unchanged-doctest"}}
+    >>> _record([(obj, "h1")], "nuvolaris"); _unchanged(obj, "nuvolaris", "h1"), _unchanged(obj, "nuvolaris", "h2")
+    (True, False)
+    >>> with _applied_lock: _applied[_key(obj, "nuvolaris")] = ("h1", time.monotonic() - applied_max_age)
+    >>> _unchanged(obj, "nuvolaris", "h1")
+    False
+    >>> forget(obj)
+    """
+    with _applied_lock:
+        known = _applied.get(_key(obj, namespace))
+    if known:
+        digest_applied, at = known
+        return digest_applied == digest and time.monotonic() - at < applied_max_age
+    return _live_trusted and _live_hash(obj, namespace) == digest
+
+def forget(obj, namespace="nuvolaris"):
+    """
+    drop the given objects from the applied hash index
+    """
+    try:
+        items = kube_api.load_objects(obj)
+    except Exception:
+        return
+    with _applied_lock:
+        for item in items:
+            _applied.pop(_key(item, namespace), None)
+
+def force_apply():
+    """
+    clear the applied hash index and stop trusting the live hashes:
+    the next apply of every object reaches the api server
+    """
+    global _live_trusted
+    with _applied_lock:
+        _applied.clear()
+        _live_trusted = False
+
+# field manager owning the fields we apply server side
+FIELD_MANAGER = "nuvolaris-operator"
+
+# apply server side, sending the objects concurrently, instead of a kubectl client side apply
+server_side_apply = os.environ.get("NUVOLARIS_SERVER_SIDE_APPLY", "off") == "on"
+
+# kinds applied before the others, as the following ones may depend on them
+_APPLY_PHASES = [
+    ["Namespace", "CustomResourceDefinition"],
+    ["ServiceAccount", "Secret", "ConfigMap", "StorageClass", "PersistentVolume", "PersistentVolumeClaim",
+     "ClusterRole", "ClusterRoleBinding", "Role", "RoleBinding", "IngressClass", "PriorityClass"],
+]
+
+def _apply_phase(kind):
+    """
+    >>> _apply_phase("Namespace"), _apply_phase("ConfigMap"), _apply_phase("StatefulSet")
+    (0, 1, 2)
+    """
+    for n, kinds in enumerate(_APPLY_PHASES):
+        if kind in kinds:
+            return n
+    return len(_APPLY_PHASES)
+
+def _record(applied, namespace):
+    with _applied_lock:
+        for item, digest in applied:
+            if digest:
+                _applied[_key(item, namespace)] = (digest, time.monotonic())
+
+# server side apply of each object in its own request, at most max_inflight at a time
+# phases are applied in order, errors are collected and raised together at the end
+def _apply_server_side(todo, namespace):
+    results = [None] * len(todo)
+    for phase in sorted({_apply_phase(item["kind"]) for item, _ in todo}):
+        calls = [(n, submit("apply", "--server-side", f"--field-manager={FIELD_MANAGER}", "--force-conflicts",
+                            "-f", "-", namespace=namespace, input=item))
+                 for n, (item, _) in enumerate(todo) if _apply_phase(item["kind"]) == phase]
+        for n, call in calls:
+            results[n] = call.result()
+
+    _record([pair for pair, res in zip(todo, results) if res.ok], namespace)
+    out = "".join(res.output for res in results if res.ok)
+    errors = [f"{_display(item)}: {res.error.strip()}" for (item, _), res in zip(todo, results) if not res.ok]
+    _remember(KubeResult(["apply", "--server-side"], returncode=1 if errors else 0,
+                         output=out, error="\n".join(errors), value=out))
+    if errors:
+        logging.warning(f"server side apply failed for {len(errors)} of {len(todo)} objects")
+        raise Exception("\n".join(errors))
+    return out
+
+# remember what a component applies, for its fingerprint
+def _note_applied(obj):
+    try:
+        for item in kube_api.load_objects(obj):
+            digests.note_applied(spec_hash(item))
+    except Exception as e:
+        logging.debug(f"cannot fingerprint applied objects: {e}")
+
+# apply an object, a List of objects or a yaml/json text
+# objects are stamped with the hash of their spec, the ones
+# already applied with the same hash less than applied_max_age ago are skipped
+# with server_side the objects are applied concurrently with server side apply
+def apply(obj, namespace="nuvolaris", server_side=None):
+    server_side = server_side_apply if server_side is None else server_side
+    if digests.recording_active():
+        _note_applied(obj)
+    if mocker.enabled or not (skip_unchanged or server_side):
+        if not isinstance(obj, str):
+            obj = json.dumps(obj)
+        return kubectl("apply", "-f", "-", namespace=namespace, input=obj)
+
+    try:
+        items = kube_api.load_objects(obj)
+        for item in items:
+            item["metadata"]["name"]
+    except Exception:
+        # not something we can parse, let kubectl deal with it
+        return kubectl("apply", "-f", "-", namespace=namespace, input=obj)
+
+    out = ""
+    todo = []
+    for item in items:
+        digest = None
+        if skip_unchanged:
+            digest = spec_hash(item)
+            if _unchanged(item, namespace, digest):
+                out += f"{_display(item)} unchanged\n"
+                continue
+            item = _stamped(item, digest)
+        todo.append((item, digest))
+
+    if todo and server_side:
+        out += _apply_server_side(todo, namespace)
+    elif todo:
+        spec = {"apiVersion": "v1", "kind": "List", "items": [item for item, _ in todo]}
+        out += kubectl("apply", "-f", "-", namespace=namespace, input=spec)
+        _record(todo, namespace)
+
+    logging.debug(f"applied {len(todo)} objects, skipped {len(items) - len(todo)} unchanged")
+    return out
 
 # apply an expanded template
 def applyTemplate(name, data, namespace="nuvolaris"):
     obj = tpl.expand_template(name, data)
-    return kubectl("apply", "-f", "-", namespace=namespace, input=obj)
+    return apply(obj, namespace=namespace)
 
 # delete an expanded template
 def deleteTemplate(name, data, namespace="nuvolaris"):
@@ -0,0 +1,717 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module talks to the kubernetes api server in-process
+# it understands the subset of kubectl command lines used by the operator
+# and returns NotImplemented for everything else, so that nuvolaris.kube
+# can fall back to forking kubectl
+import os, json, time, logging, tempfile, threading
+import datetime
+from collections import namedtuple
+
+import yaml
+import requests
+from requests.adapters import HTTPAdapter
+
+import nuvolaris.jsonpath_util as jpu
+
+LAST_APPLIED = "kubectl.kubernetes.io/last-applied-configuration"
+
+# seconds before a group version already discovered is asked again on a miss
+REDISCOVERY_INTERVAL = 5
+
+_SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+Resource = namedtuple("Resource", ["group_version", "plural", "kind", "namespaced"])
+
+# well known resources, so that most calls do not need api discovery
+_WELL_KNOWN = [
+    ("v1", "pods", "Pod", True, ["pod", "po"]),
+    ("v1", "services", "Service", True, ["service", "svc"]),
+    ("v1", "configmaps", "ConfigMap", True, ["configmap", "cm"]),
+    ("v1", "secrets", "Secret", True, ["secret"]),
+    ("v1", "persistentvolumeclaims", "PersistentVolumeClaim", True, ["persistentvolumeclaim", "pvc"]),
+    ("v1", "persistentvolumes", "PersistentVolume", False, ["persistentvolume", "pv"]),
+    ("v1", "serviceaccounts", "ServiceAccount", True, ["serviceaccount", "sa"]),
+    ("v1", "endpoints", "Endpoints", True, ["ep"]),
+    ("v1", "namespaces", "Namespace", False, ["namespace", "ns"]),
+    ("v1", "nodes", "Node", False, ["node", "no"]),
+    ("apps/v1", "deployments", "Deployment", True, ["deployment", "deploy"]),
+    ("apps/v1", "statefulsets", "StatefulSet", True, ["statefulset", "sts"]),
+    ("apps/v1", "daemonsets", "DaemonSet", True, ["daemonset", "ds"]),
+    ("apps/v1", "replicasets", "ReplicaSet", True, ["replicaset", "rs"]),
+    ("batch/v1", "jobs", "Job", True, ["job"]),
+    ("batch/v1", "cronjobs", "CronJob", True, ["cronjob", "cj"]),
+    ("networking.k8s.io/v1", "ingresses", "Ingress", True, ["ingress", "ing"]),
+    ("networking.k8s.io/v1", "ingressclasses", "IngressClass", False, ["ingressclass"]),
+    ("storage.k8s.io/v1", "storageclasses", "StorageClass", False, ["storageclass", "sc"]),
+    ("apiextensions.k8s.io/v1", "customresourcedefinitions", "CustomResourceDefinition", False, ["customresourcedefinition", "crd", "crds"]),
+    ("rbac.authorization.k8s.io/v1", "roles", "Role", True, ["role"]),
+    ("rbac.authorization.k8s.io/v1", "rolebindings", "RoleBinding", True, ["rolebinding"]),
+    ("rbac.authorization.k8s.io/v1", "clusterroles", "ClusterRole", False, ["clusterrole"]),
+    ("rbac.authorization.k8s.io/v1", "clusterrolebindings", "ClusterRoleBinding", False, ["clusterrolebinding"]),
+    ("policy/v1", "poddisruptionbudgets", "PodDisruptionBudget", True, ["poddisruptionbudget", "pdb"]),
+    ("nuvolaris.org/v1", "whisks", "Whisk", True, ["whisk", "wsk"]),
+    ("nuvolaris.org/v1", "whisksusers", "WhiskUser", True, ["whiskuser", "wsku"]),
+    ("nuvolaris.org/v1", "workflows", "Workflow", True, ["workflow"]),
+]
+
+class KubeApiError(Exception):
+    def __init__(self, message, code=None, reason=None):
+        super().__init__(message)
+        self.code = code
+        self.reason = reason
+
+class KubeApiUnauthorized(KubeApiError):
+    pass
+
+def _group(group_version):
+    """
+    >>> _group("apps/v1"), _group("v1")
+    ('apps', '')
+    """
+    return group_version.split("/")[0] if "/" in group_version else ""
+
+def display_name(resource: Resource):
+    """
+    the resource name kubectl prints in its messages
+    >>> display_name(Resource("apps/v1", "statefulsets", "StatefulSet", True))
+    'statefulset.apps'
+    >>> display_name(Resource("v1", "configmaps", "ConfigMap", True))
+    'configmap'
+    """
+    group = _group(resource.group_version)
+    kind = resource.kind.lower()
+    return f"{kind}.{group}" if group else kind
+
+def contains(current, desired):
+    """
+    true if the current value already contains everything the desired value asks for;
+    extra fields in current (usually server side defaults) are ignored
+    >>> contains({"a": 1, "b": {"c": 2, "d": 3}}, {"b": {"c": 2}})
+    True
+    >>> contains([{"name": "x", "imagePullPolicy": "Always"}], [{"name": "x"}])
+    True
+    >>> contains([{"name": "x"}], [{"name": "x"}, {"name": "y"}])
+    False
+    >>> contains({"a": "1"}, {"a": 1})
+    False
+    """
+    if isinstance(desired, dict):
+        if not isinstance(current, dict):
+            return False
+        return all(k in current and contains(current[k], v) for k, v in desired.items())
+    if isinstance(desired, list):
+        if not isinstance(current, list) or len(current) != len(desired):
+            return False
+        return all(contains(c, d) for c, d in zip(current, desired))
+    return type(current) == type(desired) and current == desired
+
+# the merge keys of the lists of the built-in kinds merged by a strategic merge patch,
+# the same of kustomize_engine; ports are merged by containerPort in a pod, by port in a service
+MERGE_KEYS = {
+    "containers": "name", "initContainers": "name", "ephemeralContainers": "name",
+    "env": "name", "volumes": "name", "volumeMounts": "mountPath", "volumeDevices": "devicePath",
+    "imagePullSecrets": "name", "hostAliases": "ip", "topologySpreadConstraints": "topologyKey",
+}
+
+def _merge_key(field, items):
+    """
+    >>> _merge_key("ports", [{"containerPort": 80}]), _merge_key("ports", [{"port": 80}]), _merge_key("args", ["-v"])
+    ('containerPort', 'port', None)
+    """
+    key = MERGE_KEYS.get(field)
+    if field == "ports":
+        key = "containerPort" if any(isinstance(i, dict) and "containerPort" in i for i in items) else "port"
+    return key if key and all(isinstance(i, dict) and key in i for i in items) else None
+
+def builtin(resource: Resource):
+    """
+    true for the kinds served by kubernetes itself, that accept a strategic merge patch;
+    the groups of custom resources always contain a dot and are not under k8s.io
+    >>> builtin(Resource("apps/v1", "statefulsets", "StatefulSet", True))
+    True
+    >>> builtin(Resource("rbac.authorization.k8s.io/v1", "roles", "Role", True))
+    True
+    >>> builtin(Resource("nuvolaris.org/v1", "whisks", "Whisk", True))
+    False
+    """
+    group = _group(resource.group_version)
+    return "." not in group or group.endswith(".k8s.io")
+
+def _strategic_list(key, original, modified, current):
+    # the items added or changed, each one patched against its current version, then
+    # the deletions of the items removed from the last applied configuration
+    by_key = lambda items: {i.get(key): i for i in items or [] if isinstance(i, dict)}
+    before, now = by_key(original), by_key(current)
+    res = []
+    for item in modified:
+        if item[key] not in now:
+            res.append(item)
+        else:
+            sub = three_way_merge_patch(before.get(item[key]), item, now[item[key]], True)
+            if sub:
+                res.append({key: item[key], **sub})
+    wanted = {item[key] for item in modified}
+    res += [{key: k, "$patch": "delete"} for k in before if k not in wanted and k in now]
+    return res
+
+def three_way_merge_patch(original, modified, current, strategic=False):
+    """
+    compute a json merge patch moving current towards modified,
+    removing the fields that were in the last applied configuration (original)
+    and are no longer in the modified one; a strategic patch merges the lists
+    of MERGE_KEYS by their key, deletes the items removed from them and keeps
+    the order of the items with $setElementOrder, as kubectl does
+    >>> orig = {"metadata": {"labels": {"a": "1", "b": "2"}}, "data": {"x": "1"}}
+    >>> mod = {"metadata": {"labels": {"a": "1"}}, "data": {"x": "2"}}
+    >>> cur = {"metadata": {"labels": {"a": "1", "b": "2", "c": "3"}, "uid": "u"}, "data": {"x": "1"}}
+    >>> three_way_merge_patch(orig, mod, cur)
+    {'metadata': {'labels': {'b': None}}, 'data': {'x': '2'}}
+    >>> three_way_merge_patch(mod, mod, cur | {"data": {"x": "2"}, "metadata": {"labels": {"a": "1"}}})
+    {}
+    >>> orig = {"spec": {"containers": [{"name": "a", "image": "a:1"}, {"name": "b", "image": "b:1"}]}}
+    >>> mod = {"spec": {"containers": [{"name": "a", "image": "a:2"}]}}
+    >>> three_way_merge_patch(orig, mod, orig, strategic=True)
+    {'spec': {'containers': [{'name': 'a', 'image': 'a:2'}, {'name': 'b', '$patch': 'delete'}], '$setElementOrder/containers': [{'name': 'a'}]}}
+    >>> orig = {"containers": [{"name": "a", "volumeMounts": [{"mountPath": "/a", "name": "a"}, {"mountPath": "/b", "name": "b"}],
+    ...                         "ports": [{"containerPort": 80}, {"containerPort": 81}]}]}
+    >>> mod = {"containers": [{"name": "a", "volumeMounts": [{"mountPath": "/a", "name": "a"}], "ports": [{"containerPort": 80}]}]}
+    >>> three_way_merge_patch(orig, mod, orig, strategic=True)["containers"]
+    [{'name': 'a', 'volumeMounts': [{'mountPath': '/b', '$patch': 'delete'}], '$setElementOrder/volumeMounts': [{'mountPath': '/a'}], 'ports': [{'containerPort': 81, '$patch': 'delete'}], '$setElementOrder/ports': [{'containerPort': 80}]}]
+    """
+    original = original if isinstance(original, dict) else {}
+    patch = {}
+    for key in original:
+        if key not in modified and key in current:
+            patch[key] = None
+    for key, value in modified.items():
+        if key in current and isinstance(value, dict) and isinstance(current[key], dict):
+            sub = three_way_merge_patch(original.get(key), value, current[key], strategic)
+            if sub:
+                patch[key] = sub
+        elif strategic and isinstance(value, list) and isinstance(current.get(key), list) and _merge_key(key, value + current[key]):
+            merge_key = _merge_key(key, value + current[key])
+            items = _strategic_list(merge_key, original.get(key), value, current[key])
+            if items:
+                patch[key] = items
+                patch[f"$setElementOrder/{key}"] = [{merge_key: i[merge_key]} for i in value]
+        elif key not in current or not contains(current[key], value):
+            patch[key] = value
+    return patch
+
+def _with_annotations(obj, annotations):
+    """
+    a shallow copy of the object with the given annotations, the object is not modified
+    >>> obj = {"kind": "Pod", "metadata": {"name": "p", "annotations": {"a": "1"}}}
+    >>> _with_annotations(obj, {"b": "2"}), obj["metadata"]["annotations"]
+    ({'kind': 'Pod', 'metadata': {'name': 'p', 'annotations': {'b': '2'}}}, {'a': '1'})
+    """
+    meta = {k: v for k, v in obj.get("metadata", {}).items() if k != "annotations"}
+    if annotations:
+        meta["annotations"] = annotations
+    return {**obj, "metadata": meta}
+
+def _flatten(objs):
+    res = []
+    for obj in objs:
+        if not obj:
+            continue
+        if obj.get("kind") == "List" or (obj.get("kind", "").endswith("List") and "items" in obj):
+            res.extend(_flatten(obj.get("items", [])))
+        else:
+            res.append(obj)
+    return res
+
+def load_objects(input):
+    """
+    parse a json or (multi document) yaml input into a flat list of objects
+    >>> [o["kind"] for o in load_objects('{"kind":"List","items":[{"kind":"Pod"},{"kind":"Service"}]}')]
+    ['Pod', 'Service']
+    >>> [o["kind"] for o in load_objects(b"kind: A\\n---\\nkind: B\\n")]
+    ['A', 'B']
+    """
+    if isinstance(input, (dict, list)):
+        objs = input if isinstance(input, list) else [input]
+    else:
+        if isinstance(input, bytes):
+            input = input.decode("utf-8")
+        objs = list(yaml.load_all(input, _SafeLoader))
+    return _flatten(objs)
+
+def parse_args(args, flags_with_value=()):
+    """
+    split a kubectl command line in positional arguments and flags
+    >>> parse_args(["get", "pods", "-l", "name=redis", "-ojson"], ["-l"])
+    (['get', 'pods'], {'-l': 'name=redis', '-o': 'json'})
+    >>> parse_args(["scale", "sts/x", "--replicas=2"])
+    (['scale', 'sts/x'], {'--replicas': '2'})
+    """
+    positional = []
+    flags = {}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith("--") and "=" in arg:
+            k, v = arg.split("=", 1)
+            flags[k] = v
+        elif arg.startswith("-o") and len(arg) > 2:
+            flags["-o"] = arg[2:]
+        elif arg in flags_with_value and i+1 < len(args):
+            flags[arg] = args[i+1]
+            i += 1
+        elif arg.startswith("-") and arg != "-":
+            flags[arg] = True
+        else:
+            positional.append(arg)
+        i += 1
+    return positional, flags
+
+class KubeApi:
+    """
+    A persistent, pooled connection to the api server.
+    """
+    def __init__(self, server, session: requests.Session, default_namespace="nuvolaris", timeout=30):
+        self.server = server.rstrip("/")
+        self.session = session
+        self.default_namespace = default_namespace
+        self.timeout = timeout
+        self._by_name = {}
+        self._by_kind = {}
+        # the group versions discovered, with the time
+        self._discovered = {}
+        self._lock = threading.Lock()
+        # callables(resource, obj) invoked after every successful write
+        self.write_listeners = []
+        for gv, plural, kind, namespaced, names in _WELL_KNOWN:
+            self._register(Resource(gv, plural, kind, namespaced), names)
+
+    @staticmethod
+    def _mount(session, pool_size):
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @classmethod
+    def from_kopf(cls, credentials, pool_size=None):
+        """
+        builds a client from the kopf.ConnectionInfo returned by the login handler
+        """
+        pool_size = pool_size or int(os.environ.get("NUVOLARIS_KUBE_POOL_SIZE", "16"))
+        session = cls._mount(requests.Session(), pool_size)
+
+        def spool(data, suffix):
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            f = tempfile.NamedTemporaryFile(prefix="nuv-kube-", suffix=suffix, delete=False)
+            f.write(data)
+            f.close()
+            return f.name
+
+        ca_path = getattr(credentials, "ca_path", None)
+        ca_data = getattr(credentials, "ca_data", None)
+        if getattr(credentials, "insecure", False):
+            session.verify = False
+        elif ca_path:
+            session.verify = str(ca_path)
+        elif ca_data:
+            session.verify = spool(ca_data, ".crt")
+
+        cert = getattr(credentials, "certificate_path", None)
+        key = getattr(credentials, "private_key_path", None)
+        if getattr(credentials, "certificate_data", None):
+            cert = spool(credentials.certificate_data, ".crt")
+        if getattr(credentials, "private_key_data", None):
+            key = spool(credentials.private_key_data, ".key")
+        if cert and key:
+            session.cert = (str(cert), str(key))
+
+        username = getattr(credentials, "username", None)
+        password = getattr(credentials, "password", None)
+        scheme = getattr(credentials, "scheme", None)
+        token = getattr(credentials, "token", None)
+        if username and password:
+            session.auth = (username, password)
+        elif token:
+            session.headers["Authorization"] = f"{scheme or 'Bearer'} {token}"
+
+        namespace = getattr(credentials, "default_namespace", None) or "nuvolaris"
+        return cls(credentials.server, session, default_namespace=namespace)
+
+    @classmethod
+    def from_pykube(cls, pool_size=None):
+        """
+        builds a client from the service account or the local kubeconfig using pykube
+        """
+        import pykube
+        pool_size = pool_size or int(os.environ.get("NUVOLARIS_KUBE_POOL_SIZE", "16"))
+        config = pykube.KubeConfig.from_env()
+        client = pykube.HTTPClient(config, http_adapter=HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+        return cls(client.url, client.session)
+
+    # low level http access
+    def request(self, method, path, params=None, body=None, content_type="application/json", timeout=None, stream=False):
+        headers = {"Accept": "application/json"}
+        data = None
+        if body is not None:
+            headers["Content-Type"] = content_type
+            data = body if isinstance(body, (str, bytes)) else json.dumps(body)
+        r = self.session.request(method, f"{self.server}{path}", params=params, data=data,
+                                 headers=headers, timeout=timeout or self.timeout, stream=stream)
+        if stream and r.status_code < 400:
+            return r
+        if r.status_code == 401:
+            raise KubeApiUnauthorized("Unauthorized", 401, "Unauthorized")
+        if r.status_code >= 400:
+            try:
+                status = r.json()
+                reason = status.get("reason", r.reason)
+                message = status.get("message", r.text)
+            except Exception:
+                reason, message = r.reason, r.text
+            raise KubeApiError(f"Error from server ({reason}): {message}", r.status_code, reason)
+        if not r.content:
+            return {}
+        return r.json()
+
+    def _written(self, resource, obj):
+        for listener in list(self.write_listeners):
+            try:
+                listener(resource, obj)
+            except Exception as e:
+                logging.warning(f"write listener failed: {e}")
+        return obj
+
+    # resource discovery
+    def _register(self, resource: Resource, names=()):
+        group = _group(resource.group_version)
+        for name in [resource.plural, resource.kind.lower(), *names]:
+            self._by_name.setdefault(name, resource)
+            if group:
+                self._by_name.setdefault(f"{name}.{group}", resource)
+        self._by_kind.setdefault((resource.group_version, resource.kind), resource)
+        self._by_kind.setdefault((group, resource.kind), resource)
+
+    def _discover_group_version(self, gv):
+        # discovered only on a miss: a group version missing now (a crd not installed yet)
+        # is looked up again, one found is not asked again for a few seconds
+        when = self._discovered.get(gv)
+        if when is not None and time.monotonic() - when < REDISCOVERY_INTERVAL:
+            return
+        path = f"/api/{gv}" if "/" not in gv else f"/apis/{gv}"
+        try:
+            res = self.request("GET", path)
+        except KubeApiError:
+            return
+        with self._lock:
+            for r in res.get("resources", []):
+                if "/" in r["name"]:
+                    continue
+                resource = Resource(gv, r["name"], r["kind"], r.get("namespaced", True))
+                self._register(resource, [r.get("singularName") or "", *r.get("shortNames", [])])
+            self._discovered[gv] = time.monotonic()
+
+    def _discover_all(self):
+        for group in self.request("GET", "/apis").get("groups", []):
+            self._discover_group_version(group["preferredVersion"]["groupVersion"])
+
+    def resolve(self, name):
+        """
+        resolve a kubectl resource name (plural, singular, short name, or name.group)
+        """
+        name = name.lower()
+        if name not in self._by_name:
+            if "." in name:
+                group = name.split(".", 1)[1]
+                for g in self.request("GET", "/apis").get("groups", []):
+                    if g["name"] == group:
+                        self._discover_group_version(g["preferredVersion"]["groupVersion"])
+            else:
+                self._discover_all()
+        if name not in self._by_name:
+            raise KubeApiError(f'error: the server doesn\'t have a resource type "{name}"', 404, "NotFound")
+        return self._by_name[name]
+
+    def resolve_kind(self, api_version, kind):
+        """
+        the resource of a kind, discovered when not known; a group missing
+        on a lookup (its crd not installed yet) is found on a later one
+        >>> api = KubeApi("https://kube", None); groups = {}
+        >>> def request(method, path, **kw):
+        ...     if path not in groups: raise KubeApiError("not found", 404, "NotFound")
+        ...     return groups[path]
+        >>> api.request = request
+        >>> try: api.resolve_kind("kubegres.reactive-tech.io/v1", "Kubegres")
+        ... except KubeApiError as e: print(e.code, e)
+        404 error: resource mapping not found for kind "Kubegres" in version "kubegres.reactive-tech.io/v1"
+        >>> groups["/apis/kubegres.reactive-tech.io/v1"] = {"resources": [{"name": "kubegres", "kind": "Kubegres", "namespaced": True}]}
+        >>> groups["/apis"] = {"groups": [{"name": "kubegres.reactive-tech.io", "preferredVersion": {"groupVersion": "kubegres.reactive-tech.io/v1"}}]}
+        >>> api.resolve_kind("kubegres.reactive-tech.io/v1", "Kubegres").plural, api.resolve("kubegres").kind
+        ('kubegres', 'Kubegres')
+        """
+        key = (api_version, kind)
+        if key not in self._by_kind:
+            self._discover_group_version(api_version)
+        if key not in self._by_kind:
+            raise KubeApiError(f'error: resource mapping not found for kind "{kind}" in version "{api_version}"', 404, "NotFound")
+        return self._by_kind[key]
+
+    def path(self, resource: Resource, namespace=None, name=None, subresource=None):
+        gv = resource.group_version
+        path = f"/api/{gv}" if "/" not in gv else f"/apis/{gv}"
+        if resource.namespaced:
+            path += f"/namespaces/{namespace or self.default_namespace}"
+        path += f"/{resource.plural}"
+        if name:
+            path += f"/{name}"
+        if subresource:
+            path += f"/{subresource}"
+        return path
+
+    # verbs
+    def get_object(self, resource, name, namespace=None, timeout=None):
+        return self.request("GET", self.path(resource, namespace, name), timeout=timeout)
+
+    def list_objects(self, resource, namespace=None, selector=None, timeout=None):
+        params = {"labelSelector": selector} if selector else None
+        res = self.request("GET", self.path(resource, namespace), params=params, timeout=timeout)
+        for item in res.get("items", []):
+            item.setdefault("apiVersion", resource.group_version)
+            item.setdefault("kind", resource.kind)
+        return {"apiVersion": "v1", "kind": "List", "items": res.get("items", []),
+                "metadata": {"resourceVersion": res.get("metadata", {}).get("resourceVersion", "")}}
+
+    def patch_object(self, resource, name, patch, namespace=None, tpe="merge", subresource=None, timeout=None):
+        content_type = {
+            "merge": "application/merge-patch+json",
+            "json": "application/json-patch+json",
+            "strategic": "application/strategic-merge-patch+json",
+        }[tpe]
+        res = self.request("PATCH", self.path(resource, namespace, name, subresource), body=patch,
+                           content_type=content_type, timeout=timeout)
+        return self._written(resource, res)
+
+    def delete_object(self, resource, name, namespace=None, timeout=None):
+        res = self.request("DELETE", self.path(resource, namespace, name), timeout=timeout)
+        return self._written(resource, res)
+
+    def apply_object(self, obj, namespace=None, timeout=None):
+        """
+        client side apply of a single object, the same way kubectl does it:
+        create when missing, otherwise three way merge with the last applied configuration,
+        sent as a strategic merge patch to the built-in kinds and as a merge patch to the others
+        """
+        resource = self.resolve_kind(obj["apiVersion"], obj["kind"])
+        name = obj["metadata"]["name"]
+        ns = obj["metadata"].get("namespace") or namespace
+        modified = _with_annotations(obj, {k: v for k, v in obj["metadata"].get("annotations", {}).items() if k != LAST_APPLIED})
+        last_applied = json.dumps(modified, separators=(",", ":"), sort_keys=True) + "\n"
+        desired = _with_annotations(modified, {**modified["metadata"].get("annotations", {}), LAST_APPLIED: last_applied})
+        what = f"{display_name(resource)}/{name}"
+        try:
+            current = self.get_object(resource, name, ns, timeout=timeout)
+        except KubeApiError as e:
+            if e.code != 404:
+                raise
+            res = self.request("POST", self.path(resource, ns), body=desired, timeout=timeout)
+            self._written(resource, res)
+            return f"{what} created"
+        try:
+            original = json.loads(current.get("metadata", {}).get("annotations", {}).get(LAST_APPLIED, "{}"))
+        except Exception:
+            original = {}
+        strategic = builtin(resource)
+        patch = three_way_merge_patch(original, desired, current, strategic)
+        if not patch:
+            return f"{what} unchanged"
+        self.patch_object(resource, name, patch, ns, tpe=strategic and "strategic" or "merge", timeout=timeout)
+        return f"{what} configured"
+
+    def server_side_apply_object(self, obj, namespace=None, field_manager="kubectl", force=False, timeout=None):
+        """
+        server side apply of a single object: the api server merges the fields
+        owned by the field manager, no last applied annotation is stored
+        """
+        resource = self.resolve_kind(obj["apiVersion"], obj["kind"])
+        name = obj["metadata"]["name"]
+        ns = obj["metadata"].get("namespace") or namespace
+        desired = _with_annotations(obj, {k: v for k, v in obj["metadata"].get("annotations", {}).items() if k != LAST_APPLIED})
+        desired["metadata"].pop("managedFields", None)
+        desired["metadata"].pop("resourceVersion", None)
+        params = {"fieldManager": field_manager}
+        if force:
+            params["force"] = "true"
+        # json is valid yaml, so the body can be sent as an apply patch as is
+        res = self.request("PATCH", self.path(resource, ns, name), params=params, body=desired,
+                           content_type="application/apply-patch+yaml", timeout=timeout)
+        self._written(resource, res)
+        return f"{display_name(resource)}/{name} serverside-applied"
+
+    # kubectl facade
+    def _target(self, positional):
+        # accepts "kind/name", "kind name..." and "kind"
+        if "/" in positional[0]:
+            kind, name = positional[0].split("/", 1)
+            return self.resolve(kind), [name]
+        return self.resolve(positional[0]), positional[1:]
+
+    def _objects_from(self, flags, input):
+        src = flags.get("-f")
+        if src == "-":
+            return load_objects(input or "")
+        if isinstance(src, str) and os.path.isfile(src):
+            with open(src) as f:
+                return load_objects(f.read())
+        return None
+
+    def invoke(self, args, namespace=None, input=None, jsonpath=None, timeout=None):
+        """
+        execute a kubectl command line in process, or return NotImplemented
+        """
+        if not args:
+            return NotImplemented
+        verb = args[0]
+        handler = getattr(self, f"_kubectl_{verb}", None)
+        if not handler:
+            return NotImplemented
+        return handler(args[1:], namespace or self.default_namespace, input, jsonpath, timeout)
+
+    def _kubectl_get(self, args, namespace, input, jsonpath, timeout):
+        positional, flags = parse_args(args, ["-l", "--selector", "-o", "--output"])
+        output = flags.pop("-o", None) or flags.pop("--output", None)
+        selector = flags.pop("-l", None) or flags.pop("--selector", None)
+        if flags or not positional or "," in positional[0]:
+            return NotImplemented
+        if not jsonpath and output != "json":
+            return NotImplemented
+        resource, names = self._target(positional)
+        if len(names) > 1:
+            return NotImplemented
+        if names:
+            obj = self.get_object(resource, names[0], namespace, timeout=timeout)
+        else:
+            obj = self.list_objects(resource, namespace, selector, timeout=timeout)
+        if jsonpath:
+            return jpu.evaluate(obj, jsonpath)
+        return json.dumps(obj, indent=4)
+
+    def _kubectl_apply(self, args, namespace, input, jsonpath, timeout):
+        positional, flags = parse_args(args, ["-f"])
+        objs = self._objects_from(flags, input)
+        server_side = flags.pop("--server-side", False) in [True, "true"]
+        field_manager = flags.pop("--field-manager", "kubectl")
+        force = flags.pop("--force-conflicts", False) in [True, "true"]
+        if positional or set(flags.keys()) != {"-f"} or objs is None:
+            return NotImplemented
+        if server_side:
+            return "".join(f"{self.server_side_apply_object(obj, namespace, field_manager, force, timeout=timeout)}\n" for obj in objs)
+        if force or field_manager != "kubectl":
+            return NotImplemented
+        return "".join(f"{self.apply_object(obj, namespace, timeout=timeout)}\n" for obj in objs)
+
+    def _kubectl_delete(self, args, namespace, input, jsonpath, timeout):
+        positional, flags = parse_args(args, ["-f", "-l", "--selector"])
+        selector = flags.pop("-l", None) or flags.pop("--selector", None)
+        ignore = flags.pop("--ignore-not-found", False)
+        out, errors = "", []
+        if "-f" in flags:
+            objs = self._objects_from(flags, input)
+            if objs is None or positional or len(flags) > 1:
+                return NotImplemented
+            targets = []
+            for obj in objs:
+                resource = self.resolve_kind(obj["apiVersion"], obj["kind"])
+                targets.append((resource, obj["metadata"]["name"], obj["metadata"].get("namespace") or namespace))
+        elif flags or not positional:
+            return NotImplemented
+        else:
+            resource, names = self._target(positional)
+            if selector:
+                if names:
+                    return NotImplemented
+                names = [i["metadata"]["name"] for i in self.list_objects(resource, namespace, selector, timeout=timeout)["items"]]
+            elif not names:
+                return NotImplemented
+            targets = [(resource, name, namespace) for name in names]
+        for resource, name, ns in targets:
+            try:
+                self.delete_object(resource, name, ns, timeout=timeout)
+                out += f'{display_name(resource)} "{name}" deleted\n'
+            except KubeApiError as e:
+                if e.code == 404 and ignore:
+                    continue
+                errors.append(str(e))
+        if errors:
+            raise KubeApiError("\n".join(errors), 404 if len(errors) == len(targets) else 500)
+        return out
+
+    def _kubectl_patch(self, args, namespace, input, jsonpath, timeout):
+        positional, flags = parse_args(args, ["--type", "-p", "--patch", "--subresource"])
+        tpe = flags.pop("--type", "strategic")
+        data = flags.pop("-p", None) or flags.pop("--patch", None)
+        subresource = flags.pop("--subresource", None)
+        if flags or not positional or data is None or tpe not in ["merge", "json", "strategic"]:
+            return NotImplemented
+        resource, names = self._target(positional)
+        if len(names) != 1:
+            return NotImplemented
+        self.patch_object(resource, names[0], json.loads(data), namespace, tpe=tpe, subresource=subresource, timeout=timeout)
+        return f"{display_name(resource)}/{names[0]} patched\n"
+
+    def _kubectl_annotate(self, args, namespace, input, jsonpath, timeout):
+        positional, flags = parse_args(args)
+        flags.pop("--overwrite", None)
+        if flags or not positional:
+            return NotImplemented
+        values = [p for p in positional if "=" in p or p.endswith("-")]
+        resource, names = self._target([p for p in positional if p not in values])
+        if len(names) != 1 or not values:
+            return NotImplemented
+        annotations = {}
+        for value in values:
+            if "=" in value:
+                k, v = value.split("=", 1)
+                annotations[k] = v
+            else:
+                annotations[value[:-1]] = None
+        self.patch_object(resource, names[0], {"metadata": {"annotations": annotations}}, namespace, timeout=timeout)
+        return f"{display_name(resource)}/{names[0]} annotated\n"
+
+    def _kubectl_scale(self, args, namespace, input, jsonpath, timeout):
+        positional, flags = parse_args(args)
+        replicas = flags.pop("--replicas", None)
+        if flags or not positional or replicas is None:
+            return NotImplemented
+        resource, names = self._target(positional)
+        if len(names) != 1:
+            return NotImplemented
+        self.patch_object(resource, names[0], {"spec": {"replicas": int(replicas)}}, namespace,
+                          subresource="scale", timeout=timeout)
+        return f"{display_name(resource)}/{names[0]} scaled\n"
+
+    def _kubectl_rollout(self, args, namespace, input, jsonpath, timeout):
+        positional, flags = parse_args(args)
+        if flags or len(positional) < 2 or positional[0] != "restart":
+            return NotImplemented
+        resource, names = self._target(positional[1:])
+        if len(names) != 1:
+            return NotImplemented
+        now = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        patch = {"spec": {"template": {"metadata": {"annotations": {"kubectl.kubernetes.io/restartedAt": now}}}}}
+        self.patch_object(resource, names[0], patch, namespace, timeout=timeout)
+        return f"{display_name(resource)}/{names[0]} restarted\n"
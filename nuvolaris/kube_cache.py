@@ -0,0 +1,371 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module keeps a local copy of frequently read resources
+# each informer lists a resource once, then follows a watch to stay current
+# so that lookups are answered from memory instead of the api server
+import os, re, json, copy, time, logging, threading
+
+import nuvolaris.kube_api as kube_api
+import nuvolaris.jsonpath_util as jpu
+
+# resources cached by default, namespaced ones are watched in the operator namespace only
+DEFAULT_RESOURCES = ["pods", "services", "storageclasses", "ingressclasses", "customresourcedefinitions"]
+
+# how long a lookup waits for the watch to catch up with our own writes
+CONSISTENCY_WAIT = 2.0
+
+_informers = {}
+_lock = threading.Lock()
+
+def _parse_selector(selector):
+    """
+    parse a label selector in a list of (key, operator, values)
+    >>> _parse_selector("app=redis,tier!=cache,!legacy,env in (dev, prod)")
+    [('app', '=', ['redis']), ('tier', '!=', ['cache']), ('legacy', '!', []), ('env', 'in', ['dev', 'prod'])]
+    """
+    res = []
+    for part in re.findall(r"(?:[^,(]|\([^)]*\))+", selector or ""):
+        part = part.strip()
+        m = re.match(r"^([\w./-]+)\s+(in|notin)\s+\((.*)\)$", part)
+        if m:
+            res.append((m.group(1), m.group(2), [v.strip() for v in m.group(3).split(",") if v.strip()]))
+        elif "!=" in part:
+            k, v = part.split("!=", 1)
+            res.append((k.strip(), "!=", [v.strip()]))
+        elif "=" in part:
+            k, v = re.split(r"==?", part, 1)
+            res.append((k.strip(), "=", [v.strip()]))
+        elif part.startswith("!"):
+            res.append((part[1:].strip(), "!", []))
+        elif part:
+            res.append((part, "exists", []))
+    return res
+
+def matches(labels, selector):
+    """
+    check if a set of labels matches a label selector
+    >>> matches({"name": "redis", "app": "db"}, "name=redis")
+    True
+    >>> matches({"name": "redis"}, "name in (couchdb, redis),!legacy")
+    True
+    >>> matches({"name": "redis"}, "name!=redis")
+    False
+    """
+    labels = labels or {}
+    for key, op, values in _parse_selector(selector):
+        value = labels.get(key)
+        if op == "=" and value != values[0]: return False
+        if op == "!=" and value == values[0]: return False
+        if op == "in" and value not in values: return False
+        if op == "notin" and value in values: return False
+        if op == "exists" and key not in labels: return False
+        if op == "!" and key in labels: return False
+    return True
+
+class Informer(threading.Thread):
+    """
+    Keeps the objects of one resource in memory, following a list and a watch.
+    Resource versions are opaque: a write is seen when the watch delivers the same version.
+    >>> import types
+    >>> items = [{"metadata": {"name": "a", "resourceVersion": "x1"}}, {"metadata": {"name": "b", "resourceVersion": "x2"}}]
+    >>> api = types.SimpleNamespace(list_objects=lambda r, ns: {"items": items, "metadata": {"resourceVersion": "l1"}})
+    >>> inf = Informer(api, kube_api.Resource("v1", "configmaps", "ConfigMap", False))
+    >>> events = []; inf.listeners.append(lambda e, o: events.append((e, o["metadata"]["name"])))
+    >>> inf._list(); inf.consistent(0)
+    True
+    >>> inf.note_write({"metadata": {"name": "a", "resourceVersion": "x1"}}); inf.consistent(0)
+    True
+    >>> inf.note_write({"metadata": {"name": "a", "resourceVersion": "x3"}}); inf.consistent(0)
+    False
+    >>> inf._apply("MODIFIED", {"metadata": {"name": "a", "resourceVersion": "x3"}}); inf.consistent(0)
+    True
+    >>> items = items[:1]; events.clear(); inf._list(); events
+    [('SYNCED', 'a'), ('DELETED', 'b')]
+    """
+    def __init__(self, api: kube_api.KubeApi, resource: kube_api.Resource, namespace=None):
+        super().__init__(name=f"informer-{resource.plural}", daemon=True)
+        self.api = api
+        self.resource = resource
+        self.namespace = namespace if resource.namespaced else None
+        self.objects = {}
+        self.resource_version = None
+        # the versions of our own writes not yet seen by the watch, by key, with a deadline
+        self.pending = {}
+        self.synced = threading.Event()
+        self.stopped = threading.Event()
+        self.changed = threading.Condition()
+        self.listeners = []
+
+    def _key(self, obj):
+        meta = obj.get("metadata", {})
+        return (meta.get("namespace") or "", meta.get("name"))
+
+    def _notify(self, event, obj):
+        for listener in list(self.listeners):
+            try:
+                listener(event, obj)
+            except Exception as e:
+                logging.warning(f"informer {self.resource.plural} listener failed: {e}")
+
+    def _list(self):
+        res = self.api.list_objects(self.resource, self.namespace)
+        with self.changed:
+            objects = {self._key(o): o for o in res["items"]}
+            dropped = [o for k, o in self.objects.items() if k not in objects]
+            self.objects = objects
+            self.resource_version = res["metadata"]["resourceVersion"]
+            # a list is a consistent read, it already includes our writes
+            self.pending.clear()
+            self.changed.notify_all()
+        self.synced.set()
+        for obj in res["items"]:
+            self._notify("SYNCED", obj)
+        # the objects deleted while the watch was down
+        for obj in dropped:
+            self._notify("DELETED", obj)
+
+    def _apply(self, tpe, obj):
+        key = self._key(obj)
+        rv = obj.get("metadata", {}).get("resourceVersion")
+        with self.changed:
+            if tpe in ["ADDED", "MODIFIED"]:
+                obj.setdefault("apiVersion", self.resource.group_version)
+                obj.setdefault("kind", self.resource.kind)
+                self.objects[key] = obj
+            elif tpe == "DELETED":
+                self.objects.pop(key, None)
+            if key in self.pending and (tpe == "DELETED" or self.pending[key][0] == rv):
+                del self.pending[key]
+            self.resource_version = rv or self.resource_version
+            self.changed.notify_all()
+
+    def _watch(self):
+        params = {"watch": "1", "resourceVersion": self.resource_version,
+                  "allowWatchBookmarks": "true", "timeoutSeconds": "300"}
+        path = self.api.path(self.resource, self.namespace)
+        r = self.api.request("GET", path, params=params, timeout=330, stream=True)
+        try:
+            for line in r.iter_lines():
+                if self.stopped.is_set():
+                    return
+                if not line:
+                    continue
+                event = json.loads(line)
+                tpe, obj = event.get("type"), event.get("object", {})
+                if tpe == "ERROR":
+                    # typically 410 Gone: our resourceVersion is too old, list again
+                    logging.info(f"informer {self.resource.plural} watch expired: {obj.get('message')}")
+                    self.synced.clear()
+                    self.resource_version = None
+                    return
+                self._apply(tpe, obj)
+                if tpe != "BOOKMARK":
+                    self._notify(tpe, obj)
+        finally:
+            r.close()
+
+    def run(self):
+        backoff = 1
+        while not self.stopped.is_set():
+            try:
+                if self.resource_version is None:
+                    self._list()
+                self._watch()
+                backoff = 1
+            except Exception as e:
+                logging.warning(f"informer {self.resource.plural} failed: {e}")
+                self.synced.clear()
+                self.resource_version = None
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, 30)
+
+    def stop(self):
+        self.stopped.set()
+
+    def note_write(self, obj, wait=CONSISTENCY_WAIT):
+        """
+        remember the resourceVersion of an object we wrote,
+        lookups will wait (at most wait seconds) for the watch to deliver it
+        """
+        meta = obj.get("metadata", {})
+        rv, key = meta.get("resourceVersion"), self._key(obj)
+        if not rv or not self.covers(meta.get("namespace") or self.namespace):
+            return
+        with self.changed:
+            current = self.objects.get(key)
+            # a write that changed nothing has no event to wait for
+            if current is None or current.get("metadata", {}).get("resourceVersion") != rv:
+                self.pending[key] = (rv, time.monotonic() + wait)
+
+    def consistent(self, wait=CONSISTENCY_WAIT):
+        if not self.synced.is_set():
+            return False
+        deadline = time.monotonic() + wait
+        with self.changed:
+            while True:
+                now = time.monotonic()
+                for key in [k for k, (_, until) in self.pending.items() if until <= now]:
+                    del self.pending[key]
+                if not self.pending:
+                    return True
+                remaining = deadline - now
+                if remaining <= 0:
+                    return False
+                self.changed.wait(min(remaining, min(until for _, until in self.pending.values()) - now))
+
+    def covers(self, namespace):
+        return not self.resource.namespaced or namespace == self.namespace
+
+    def get(self, name, namespace=None):
+        with self.changed:
+            obj = self.objects.get(((namespace or "") if self.resource.namespaced else "", name))
+            return copy.deepcopy(obj) if obj else None
+
+    def list(self, namespace=None, selector=None):
+        with self.changed:
+            items = [o for k, o in sorted(self.objects.items())
+                     if (not self.resource.namespaced or k[0] == namespace)
+                     and (not selector or matches(o.get("metadata", {}).get("labels"), selector))]
+            return {"apiVersion": "v1", "kind": "List", "items": copy.deepcopy(items),
+                    "metadata": {"resourceVersion": self.resource_version or ""}}
+
+def informer(resource_name):
+    return _informers.get(resource_name)
+
+def active():
+    return len(_informers) > 0
+
+def cached():
+    """
+    the names of the cached resources
+    """
+    return frozenset(_informers)
+
+def _on_write(resource, obj):
+    inf = _informers.get(resource.plural)
+    if inf and isinstance(obj, dict):
+        inf.note_write(obj)
+
+# start the informers for the given resources
+# namespaced resources are watched in the given namespace
+def start(api: kube_api.KubeApi, namespace="nuvolaris", resources=None, wait=10):
+    stop()
+    if os.environ.get("NUVOLARIS_KUBE_CACHE", "on") == "off":
+        logging.info("kube cache disabled")
+        return
+    names = resources or DEFAULT_RESOURCES
+    api.write_listeners.append(_on_write)
+    with _lock:
+        for name in names:
+            try:
+                resource = api.resolve(name)
+            except Exception as e:
+                logging.warning(f"cannot cache {name}: {e}")
+                continue
+            inf = Informer(api, resource, namespace)
+            _informers[resource.plural] = inf
+            inf.start()
+    deadline = time.monotonic() + wait
+    for inf in list(_informers.values()):
+        inf.synced.wait(max(0, deadline - time.monotonic()))
+    logging.info(f"kube cache started for {', '.join(_informers.keys())}")
+
+# start caching one more resource, if the cache is running
+# returns the informer or None
+def ensure(resource_name, wait=10):
+    with _lock:
+        if not _informers:
+            return None
+        api = next(iter(_informers.values())).api
+        namespace = next((i.namespace for i in _informers.values() if i.namespace), "nuvolaris")
+        try:
+            resource = api.resolve(resource_name)
+        except Exception as e:
+            logging.warning(f"cannot cache {resource_name}: {e}")
+            return None
+        inf = _informers.get(resource.plural)
+        if not inf:
+            inf = Informer(api, resource, namespace)
+            _informers[resource.plural] = inf
+            inf.start()
+    inf.synced.wait(wait)
+    return inf
+
+def stop():
+    with _lock:
+        for inf in _informers.values():
+            inf.stop()
+            try:
+                inf.api.write_listeners.remove(_on_write)
+            except ValueError:
+                pass
+        _informers.clear()
+
+def watch(resource_name, listener):
+    """
+    register a listener(event, obj) called for every change of a cached resource
+    returns False if the resource is not cached
+    """
+    inf = _informers.get(resource_name)
+    if not inf:
+        return False
+    inf.listeners.append(listener)
+    return True
+
+def unwatch(resource_name, listener):
+    inf = _informers.get(resource_name)
+    if inf and listener in inf.listeners:
+        inf.listeners.remove(listener)
+
+def answer(api: kube_api.KubeApi, args, namespace, jsonpath):
+    """
+    answer a kubectl get from memory, returning (value, output)
+    or NotImplemented when the cache cannot serve it;
+    raises KubeApiError NotFound for missing named objects
+    """
+    if not _informers or not args or args[0] != "get":
+        return NotImplemented
+    positional, flags = kube_api.parse_args(args[1:], ["-l", "--selector", "-o", "--output"])
+    output = flags.pop("-o", None) or flags.pop("--output", None)
+    selector = flags.pop("-l", None) or flags.pop("--selector", None)
+    if flags or not positional or (not jsonpath and output != "json"):
+        return NotImplemented
+    kind, names = positional[0], positional[1:]
+    if "/" in kind:
+        kind, name = kind.split("/", 1)
+        names = [name]
+    if len(names) > 1 or (names and selector):
+        return NotImplemented
+    try:
+        resource = api.resolve(kind)
+    except Exception:
+        return NotImplemented
+    inf = _informers.get(resource.plural)
+    if not inf or inf.resource != resource or not inf.covers(namespace) or not inf.consistent():
+        return NotImplemented
+    if names:
+        obj = inf.get(names[0], namespace)
+        if obj is None:
+            raise kube_api.KubeApiError(f'Error from server (NotFound): {resource.plural} "{names[0]}" not found', 404, "NotFound")
+    else:
+        obj = inf.list(namespace, selector)
+    if jsonpath:
+        value = jpu.evaluate(obj, jsonpath)
+        return value, json.dumps(value)
+    out = json.dumps(obj, indent=4)
+    return out, out
@@ -17,18 +17,186 @@
 #
 # this module wraps generation of kustomizations
 
-import os, io, yaml, subprocess
+import os, yaml, shutil, logging, tempfile, threading, subprocess
 import nuvolaris.kube as kube
 import nuvolaris.kustomize as nku
+import nuvolaris.kustomize_engine as kze
+import nuvolaris.component_digest as digests
+import nuvolaris.render_cache as rc
 import nuvolaris.template as ntp
+import nuvolaris.tracing as tracing
+import nuvolaris.metrics as metrics
 
-def _build(dir):
+# kustomizations are built in process unless NUVOLARIS_KUSTOMIZE=binary
+# the ones using features the engine does not support are built with the binary
+engine = os.environ.get("NUVOLARIS_KUSTOMIZE", "builtin")
+
+# the libyaml parser, when available, is several times faster
+_SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+def load_all(text):
+    """
+    parse a (multi document) yaml text, skipping empty documents
+    >>> load_all("a: 1\\n---\\n---\\nb: [x]\\n")
+    [{'a': 1}, {'b': ['x']}]
+    """
+    return [doc for doc in yaml.load_all(text, _SafeLoader) if doc is not None]
+
+def _build_binary(dir):
     res = subprocess.run(["kustomize", "build", dir], capture_output=True)
     if res.returncode != 0:
         error = res.stderr.decode("utf-8")
         raise Exception(error)
     return res.stdout.decode("utf-8")
 
+# build with the engine, returns None when the binary is needed
+def _build_engine(dir, files):
+    if engine == "binary":
+        return None
+    try:
+        return kze.build(kze.Source(dir, files))
+    except kze.UnsupportedKustomization as e:
+        logging.info(f"building {dir} with the kustomize binary: {e}")
+    except kze.KustomizeError as e:
+        raise Exception(str(e))
+    return None
+
+def _build(dir, files=None):
+    objs = _build_engine(dir, files)
+    if objs is not None:
+        return kze.dump(objs)
+    return _build_files(dir, files)
+
+def _build_files(dir, files):
+    if not files:
+        return _build_binary(dir)
+    # the binary needs the generated files on disk, in a private copy of the folder
+    with tempfile.TemporaryDirectory(prefix="kustomize-") as tmp:
+        tgt = f"{tmp}/{os.path.basename(dir)}"
+        shutil.copytree(dir, tgt, ignore=shutil.ignore_patterns("kustomization.yaml", "__*"))
+        for name, content in files.items():
+            with open(f"{tgt}/{name}", "w") as f:
+                f.write(content)
+        return _build_binary(tgt)
+
+# the objects of a kustomization: the ones built by the engine are
+# returned as they are, only the output of the binary is parsed
+def _build_objects(dir, files=None):
+    objs = _build_engine(dir, files)
+    if objs is not None:
+        return objs
+    return load_all(_build_files(dir, files))
+
+class Workspace:
+    """
+    The files generated to kustomize a folder under "deploy", kept in memory:
+    the deploy tree is never written, so renders can run in parallel.
+    >>> ws = Workspace("test")
+    >>> ws.spool("test.json", "__test.json", {"item": "value"})
+    '__test.json'
+    >>> "__test.json" in ws.listdir() and "pod.yaml" in ws.listdir()
+    True
+    >>> os.path.exists("deploy/test/__test.json")
+    False
+    """
+    def __init__(self, where):
+        self.where = where
+        self.dir = f"deploy/{where}"
+        self.files = {}
+
+    def spool(self, template, name, data):
+        self.files[name] = ntp.expand_template(template, data)
+        return name
+
+    def listdir(self):
+        return sorted(set(os.listdir(self.dir)) | set(self.files.keys()))
+
+    def build(self, kustomization):
+        return _build(self.dir, {**self.files, "kustomization.yaml": kustomization})
+
+    def objects(self, kustomization):
+        return _build_objects(self.dir, {**self.files, "kustomization.yaml": kustomization})
+
+# the workspaces of the kustomizations being prepared by each thread
+_local = threading.local()
+
+# the last kustomization built for each folder, expanded again by build()
+_last = {}
+_last_lock = threading.Lock()
+
+# the workspace of the calling thread for the given folder
+# helpers add files to it, the next kustomize of the folder consumes it
+def workspace(where) -> Workspace:
+    spaces = _local.__dict__.setdefault("spaces", {})
+    if where not in spaces:
+        spaces[where] = Workspace(where)
+    return spaces[where]
+
+def _release(where):
+    return _local.__dict__.setdefault("spaces", {}).pop(where, None) or Workspace(where)
+
+# parsed kustomizations by digest of their inputs, NUVOLARIS_RENDER_CACHE_DIR persists them
+cache = rc.RenderCache(int(os.environ.get("NUVOLARIS_RENDER_CACHE_SIZE", "64")),
+                       os.environ.get("NUVOLARIS_RENDER_CACHE_DIR"))
+
+@metrics.collector
+def _cache_metrics():
+    stats = cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    return [
+        "# HELP nuvolaris_render_cache_hits_total Kustomizations served by the render cache.",
+        "# TYPE nuvolaris_render_cache_hits_total counter",
+        f"nuvolaris_render_cache_hits_total {stats['hits']}",
+        "# HELP nuvolaris_render_cache_misses_total Kustomizations built because not in the render cache.",
+        "# TYPE nuvolaris_render_cache_misses_total counter",
+        f"nuvolaris_render_cache_misses_total {stats['misses']}",
+        "# HELP nuvolaris_render_cache_hit_ratio Ratio of the kustomizations served by the render cache.",
+        "# TYPE nuvolaris_render_cache_hit_ratio gauge",
+        f"nuvolaris_render_cache_hit_ratio {stats['hits'] / lookups if lookups else 0:g}",
+        "# HELP nuvolaris_render_cache_entries Kustomizations in the render cache.",
+        "# TYPE nuvolaris_render_cache_entries gauge",
+        f"nuvolaris_render_cache_entries {stats['entries']}",
+    ]
+
+def _prepare(where, what, templates, data, accept):
+    digests.note("deploy", where)
+    ws = _release(where)
+    kust = "apiVersion: kustomize.config.k8s.io/v1beta1\nkind: Kustomization\n"
+    for s in list(what):
+        kust += s
+    kust += "resources:\n"
+    for file in ws.listdir():
+        if file == "kustomization.yaml":
+          continue
+        if file.startswith("_"):
+          continue
+        if accept(file):
+          kust += f"- {file}\n"
+    # adding extra templatized resources
+    for template in templates:
+        kust += f"- {ws.spool(template, f'__{template}', data)}\n"
+    with _last_lock:
+        _last[where] = (ws, kust)
+    return ws, kust
+
+def _render(where, what, templates, data, accept):
+    with tracing.span(where, "kustomize"):
+        ws, kust = _prepare(where, what, templates, data, accept)
+        return ws.build(kust)
+
+# the kustomization output depends only on the deploy folder, the generated files
+# and the kustomization itself, so the parsed objects are cached by their digest
+def _render_list(where, what, templates, data, accept):
+    with tracing.span(where, "kustomize") as span:
+        ws, kust = _prepare(where, what, templates, data, accept)
+        key = rc.digest(engine, kust, ws.files, rc.tree_stat(ws.dir))
+        items = cache.get(key)
+        span.set(cached=items is not None)
+        if items is None:
+            items = ws.objects(kust)
+            cache.put(key, items)
+    return {"apiVersion": "v1", "kind": "List", "items": items }
+
 # execute the kustomization of a folder under "deploy"
 # specified with `where`
 # it generate a kustomization.yaml, adding the header 
@@ -52,28 +220,7 @@ def kustomize(where, *what, templates=[], data={}):
     name: test-pod
     name: test-svc
     """
-    # prepare the kustomization
-    dir = f"deploy/{where}"
-    tgt = f"{dir}/kustomization.yaml"
-    with open(tgt, "w") as f:
-        f.write("apiVersion: kustomize.config.k8s.io/v1beta1\nkind: Kustomization\n")
-        for s in list(what):
-            f.write(s)
-        f.write("resources:\n")
-        dirs = os.listdir(f"deploy/{where}")
-        dirs.sort()
-        for file in dirs:
-            if file == "kustomization.yaml":
-              continue
-            if file.startswith("_"):
-              continue
-            f.write(f"- {file}\n")
-        # adding extra temmplatized resources
-        for template in templates:
-            out = f"deploy/{where}/__{template}"
-            file = ntp.spool_template(template, out, data)
-            f.write(f"- __{template}\n")
-    return _build(dir)
+    return _render(where, what, templates, data, lambda file: True)
 
 # execute the kustomization of a folder under "deploy"
 # specified with `where` returning the expanded kustomization
@@ -81,8 +228,12 @@ def kustomize(where, *what, templates=[], data={}):
 # this methid will be used to extract the existing kustomization in case
 # the nuvolaris operator needs to delete a component
 def build(where):
-    dir = f"deploy/{where}"
-    return _build(dir)
+    with _last_lock:
+        last = _last.get(where)
+    if last:
+        ws, kust = last
+        return ws.build(kust)
+    return _build(f"deploy/{where}")
 
 # execute the kustomization of a folder under "deploy"
 # specified with `where`
@@ -108,29 +259,7 @@ def restricted_kustomize(where, *what, templates=[], templates_filter=[],data={}
     name: test-pod
     name: test-svc
     """
-    # prepare the kustomization
-    dir = f"deploy/{where}"
-    tgt = f"{dir}/kustomization.yaml"
-    with open(tgt, "w") as f:
-        f.write("apiVersion: kustomize.config.k8s.io/v1beta1\nkind: Kustomization\n")
-        for s in list(what):
-            f.write(s)
-        f.write("resources:\n")
-        dirs = os.listdir(f"deploy/{where}")
-        dirs.sort()
-        for file in dirs:
-            if file == "kustomization.yaml":
-              continue
-            if file.startswith("_"):
-              continue
-            if file in templates_filter:  
-              f.write(f"- {file}\n")
-        # adding extra templatized resources
-        for template in templates:
-            out = f"deploy/{where}/__{template}"
-            file = ntp.spool_template(template, out, data)
-            f.write(f"- __{template}\n")
-    return _build(dir)
+    return _render(where, what, templates, data, lambda file: file in templates_filter)
 
 # generate image kustomization
 def image(name, newName=None, newTag=None):
@@ -169,8 +298,7 @@ def configMapTemplate(name, where, template, data):
       files:
       - test.json=__test.json
     """
-    out = f"deploy/{where}/__{template}"
-    file = ntp.spool_template(template, out, data)
+    workspace(where).spool(template, f"__{template}", data)
     return f"""configMapGenerator:
 - name: {name}
   namespace: nuvolaris
@@ -187,11 +315,10 @@ def patchTemplate(where, template, data):
     >>> print(patchTemplate("test",  "set-attach.yaml", data), end='')
     patches:
     - path: __set-attach.yaml
-    >>> os.path.exists("deploy/test/__set-attach.yaml")
+    >>> "__set-attach.yaml" in workspace("test").files
     True
     """
-    out = f"deploy/{where}/__{template}"
-    file = ntp.spool_template(template, out, data)
+    workspace(where).spool(template, f"__{template}", data)
     return f"""patches:
 - path: __{template}
 """
@@ -206,13 +333,12 @@ def patchTemplates(where, templates=[], data={}):
     patches:
     - path: __set-attach.yaml
     - path: __cron-init.yaml
-    >>> os.path.exists("deploy/test/__set-attach.yaml")
+    >>> "__cron-init.yaml" in workspace("test").files
     True
     """
     paths = []
     for template in templates:
-      out = f"deploy/{where}/__{template}"
-      file = ntp.spool_template(template, out, data)
+      workspace(where).spool(template, f"__{template}", data)
       paths.append(f"- path: __{template}\n")
 
     patches = ""
@@ -250,11 +376,12 @@ def kustom_list(where, *what, templates=[], data={}):
   >>> out.sort()
   >>> print(out)
   ['Pod', 'Service']
+  >>> hits = nku.cache.stats()["hits"]
+  >>> res["items"].clear()
+  >>> len(nku.kustom_list(where, *what)["items"]), nku.cache.stats()["hits"] - hits
+  (2, 1)
   """
-  yml = nku.kustomize(where, *what, templates=templates, data=data)
-  stream = io.StringIO(yml)
-  res = list(yaml.load_all(stream, yaml.Loader))
-  return {"apiVersion": "v1", "kind": "List", "items": res }
+  return _render_list(where, what, templates, data, lambda file: True)
 
 
 # returns a list of kustomized objects restricting the deploy available templates to given ones
@@ -269,37 +396,36 @@ def restricted_kustom_list(where, *what, templates=[], templates_filter=[], data
   >>> print(out)
   ['Pod', 'Service']
   """
-  yml = nku.restricted_kustomize(where, *what, templates=templates, templates_filter=templates_filter,data=data)
-  stream = io.StringIO(yml)
-  res = list(yaml.load_all(stream, yaml.Loader))
-  return {"apiVersion": "v1", "kind": "List", "items": res }
+  return _render_list(where, what, templates, data, lambda file: file in templates_filter)
 
 # load the given yaml file under deploy/{where} folder
 def raw(where, yamlfile):
+  digests.note("deploy", where)
   with open(f"deploy/{where}/{yamlfile}", 'r') as f:
-    return list(yaml.load_all(f, yaml.Loader))
+    return load_all(f)
 
 def processTemplate(where,template,data,out_template=None):
     """
-    merges the given template and write it under the deploy/{where} folder returning a kind list items
-    """  
-    out = f"deploy/{where}/_{template}"
-
+    merges the given template returning a kind list items;
+    when out_template is given the result is also added to the deploy/{where} workspace,
+    so the next kustomization of the folder can include it
+    >>> [x["metadata"]["name"] for x in processTemplate("test", "testcm.yaml", {"name": "cm"}, "cm_generated.yaml")["items"]]
+    ['cm']
+    >>> "cm_generated.yaml" in workspace("test").listdir()
+    True
+    """
     if(out_template):
-      out = f"deploy/{where}/{out_template}"
-
-    ntp.spool_template(template, out, data)
-    with open(out, 'r') as f:
-      res = list(yaml.load_all(f, yaml.Loader))
-      return {"apiVersion": "v1", "kind": "List", "items": res }
+      text = workspace(where).files[workspace(where).spool(template, out_template, data)]
+    else:
+      text = ntp.expand_template(template, data)
+    res = load_all(text)
+    return {"apiVersion": "v1", "kind": "List", "items": res }
 
 def renderTemplate(where,template,data,out_template):
     """
-    merges the given template and write it under the deploy/{where} folder returning the relative generated file path
-    """  
-    out = f"deploy/{where}/{out_template}"
-    ntp.spool_template(template, out, data)
-    return out
+    merges the given template and adds it to the deploy/{where} workspace returning the generated file name
+    """
+    return workspace(where).spool(template, out_template, data)
 
 # generate a kustomization for a persistence volume claim using inline patchesJson6902 format
 def patchPersistentVolumeClaim(name, path, value):
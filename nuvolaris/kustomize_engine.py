@@ -0,0 +1,705 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module builds kustomizations in process
+# it implements the subset of `kustomize build` used by the operator:
+# resources, images, strategic merge and json 6902 patches,
+# configMapGenerator and secretGenerator (with the same hash suffixes)
+# and the legacy output order; anything else raises UnsupportedKustomization
+# so that the caller can fall back to the kustomize binary
+import os, re, json, copy, base64, hashlib
+import yaml
+
+class UnsupportedKustomization(Exception):
+    pass
+
+class KustomizeError(Exception):
+    pass
+
+_SUPPORTED_KEYS = {"apiVersion", "kind", "resources", "images", "patches", "patchesStrategicMerge",
+                   "patchesJson6902", "configMapGenerator", "secretGenerator", "generatorOptions"}
+
+# groups of the built in kinds, merged with the kubernetes patch strategies
+_BUILTIN_GROUPS = {"", "apps", "batch", "autoscaling", "policy", "networking.k8s.io", "storage.k8s.io",
+                   "rbac.authorization.k8s.io", "apiextensions.k8s.io", "admissionregistration.k8s.io",
+                   "scheduling.k8s.io", "coordination.k8s.io", "discovery.k8s.io", "node.k8s.io",
+                   "certificates.k8s.io"}
+
+# merge keys of the lists of the built in kinds, the other lists are replaced
+_MERGE_KEYS = {
+    "containers": "name", "initContainers": "name", "ephemeralContainers": "name",
+    "env": "name", "volumes": "name", "volumeMounts": "mountPath", "volumeDevices": "devicePath",
+    "imagePullSecrets": "name", "hostAliases": "ip", "topologySpreadConstraints": "topologyKey",
+    "conditions": "type",
+}
+
+# keys used to merge the lists of custom resources, in order of preference
+_ASSOCIATIVE_KEYS = ["mountPath", "devicePath", "ip", "type", "topologyKey", "name", "containerPort"]
+
+# output order of `kustomize build --reorder legacy`
+_ORDER_FIRST = ["Namespace", "ResourceQuota", "StorageClass", "CustomResourceDefinition",
+                "ServiceAccount", "PodSecurityPolicy", "Role", "ClusterRole", "RoleBinding",
+                "ClusterRoleBinding", "ConfigMap", "Secret", "Endpoints", "Service",
+                "LimitRange", "PriorityClass", "PersistentVolume", "PersistentVolumeClaim",
+                "Deployment", "StatefulSet", "CronJob", "PodDisruptionBudget"]
+_ORDER_LAST = ["MutatingWebhookConfiguration", "ValidatingWebhookConfiguration"]
+
+# where the pod spec is, for the kinds whose references to generated objects are renamed
+_POD_SPEC = {
+    "Pod": ["spec"],
+    "Deployment": ["spec", "template", "spec"],
+    "StatefulSet": ["spec", "template", "spec"],
+    "DaemonSet": ["spec", "template", "spec"],
+    "ReplicaSet": ["spec", "template", "spec"],
+    "Job": ["spec", "template", "spec"],
+    "CronJob": ["spec", "jobTemplate", "spec", "template", "spec"],
+}
+
+# the libyaml parser, when available, is several times faster
+_SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+class _StrictLoader(_SafeLoader):
+    pass
+
+def _construct_mapping(loader, node, deep=False):
+    seen = set()
+    for key_node, _ in node.value:
+        key = loader.construct_object(key_node, deep=deep)
+        if key in seen:
+            raise UnsupportedKustomization(f"mapping key {key!r} already defined at line {key_node.start_mark.line + 1}")
+        seen.add(key)
+    return loader.construct_mapping(node, deep)
+
+_StrictLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, _construct_mapping)
+
+class _Dumper(yaml.SafeDumper):
+    pass
+
+def _represent_str(dumper, value):
+    style = "|" if "\n" in value else None
+    return dumper.represent_scalar("tag:yaml.org,2002:str", value, style=style)
+
+_Dumper.add_representer(str, _represent_str)
+
+def _load_all(text, where):
+    try:
+        docs = list(yaml.load_all(text, _StrictLoader))
+    except yaml.YAMLError as e:
+        raise KustomizeError(f"cannot parse {where}: {e}")
+    res = []
+    for doc in docs:
+        if not doc:
+            continue
+        if not isinstance(doc, (dict, list)):
+            raise KustomizeError(f"cannot parse {where}: not a yaml object")
+        if isinstance(doc, dict) and doc.get("kind") == "List" and "items" in doc:
+            res.extend(i for i in doc["items"] if i)
+        else:
+            res.append(doc)
+    return res
+
+def _split_gv(api_version):
+    """
+    >>> _split_gv("apps/v1"), _split_gv("v1")
+    (('apps', 'v1'), ('', 'v1'))
+    """
+    if "/" in (api_version or ""):
+        return tuple(api_version.split("/", 1))
+    return "", api_version or ""
+
+def _namespace(obj):
+    return obj.get("metadata", {}).get("namespace") or "default"
+
+def _id(obj):
+    return (obj.get("apiVersion"), obj.get("kind"), obj.get("metadata", {}).get("name"), _namespace(obj))
+
+class Source:
+    """
+    The files of a kustomization: a folder on disk, optionally overlaid
+    with files kept in memory (by name relative to the folder)
+    """
+    def __init__(self, dir, files=None):
+        self.dir = dir
+        self.files = files or {}
+
+    def path(self, name):
+        return os.path.normpath(os.path.join(self.dir, name))
+
+    def exists(self, name):
+        return os.path.normpath(name) in self.files or os.path.exists(self.path(name))
+
+    def isdir(self, name):
+        prefix = os.path.normpath(name) + "/"
+        return any(f.startswith(prefix) for f in self.files) or os.path.isdir(self.path(name))
+
+    def sub(self, name):
+        prefix = os.path.normpath(name) + "/"
+        return Source(self.path(name), {f[len(prefix):]: v for f, v in self.files.items() if f.startswith(prefix)})
+
+    def read(self, name):
+        data = self.files.get(os.path.normpath(name))
+        if data is not None:
+            return data.encode("utf-8") if isinstance(data, str) else data
+        try:
+            with open(self.path(name), "rb") as f:
+                return f.read()
+        except OSError as e:
+            raise KustomizeError(f"cannot read {self.path(name)}: {e}")
+
+    def text(self, name):
+        return self.read(name).decode("utf-8")
+
+def load_kustomization(src: Source):
+    """
+    read the kustomization of a folder, checking only supported fields are used
+    >>> load_kustomization(Source("deploy/test", {"kustomization.yaml": "resources:\\n- pod.yaml\\n"}))
+    {'resources': ['pod.yaml']}
+    >>> try: load_kustomization(Source("deploy/test", {"kustomization.yaml": "namePrefix: x-\\n"}))
+    ... except UnsupportedKustomization as e: print(e)
+    unsupported kustomization fields: namePrefix
+    """
+    for name in ["kustomization.yaml", "kustomization.yml", "Kustomization"]:
+        if src.exists(name):
+            docs = _load_all(src.text(name), src.path(name))
+            kust = docs[0] if docs else {}
+            break
+    else:
+        raise KustomizeError(f"unable to find one of 'kustomization.yaml', 'kustomization.yml' or 'Kustomization' in directory '{src.dir}'")
+    unsupported = set(kust.keys()) - _SUPPORTED_KEYS
+    if unsupported:
+        raise UnsupportedKustomization(f"unsupported kustomization fields: {', '.join(sorted(unsupported))}")
+    return kust
+
+# images
+def _split_image(image):
+    """
+    split an image in name, tag and digest as kustomize does
+    >>> _split_image("nginx"), _split_image("registry:5000/nginx:1.2"), _split_image("nginx:1@sha256:ab")
+    (('nginx', '', ''), ('registry:5000/nginx', '1.2', ''), ('nginx', '1', 'sha256:ab'))
+    """
+    slash = image.find("/")
+    search = image[slash:] if slash > 0 else image
+    slash = max(slash, 0)
+    at, colon = search.find("@"), search.find(":")
+    if at < 0 and colon < 0:
+        return image, "", ""
+    if at >= 0 and (at < colon or colon < 0):
+        return image[:at + slash], "", image[at + slash + 1:]
+    if at >= 0 and colon >= 0:
+        return image[:colon + slash], image[colon + slash + 1:at + slash], image[at + slash + 1:]
+    return image[:colon + slash], image[colon + slash + 1:], ""
+
+def _update_image(value, spec):
+    """
+    >>> _update_image("nginx:1.2", {"name": "nginx", "newName": "busybox"})
+    'busybox:1.2'
+    >>> _update_image("nginx", {"name": "nginx", "newTag": 3})
+    'nginx:3'
+    >>> _update_image("nginx2", {"name": "nginx", "newTag": "3"})
+    'nginx2'
+    """
+    pattern = "^" + spec["name"] + r"(@sha256)?(:[a-zA-Z0-9_.{}-]*)?(@sha256:[a-zA-Z0-9_.{}-]*)?$"
+    if not re.match(pattern, value):
+        return value
+    name, tag, digest = _split_image(value)
+    new_tag = str(spec.get("newTag") or "")
+    new_digest = str(spec.get("digest") or "")
+    if spec.get("newName"):
+        name = spec["newName"]
+    if new_tag:
+        tag, digest = new_tag, new_digest
+    elif new_digest:
+        tag, digest = "", new_digest
+    if tag:
+        name += ":" + tag
+    if digest:
+        name += "@" + digest
+    return name
+
+def _set_images(node, spec):
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key in ["containers", "initContainers"] and isinstance(value, list):
+                for container in value:
+                    if isinstance(container, dict) and isinstance(container.get("image"), str):
+                        container["image"] = _update_image(container["image"], spec)
+            _set_images(value, spec)
+    elif isinstance(node, list):
+        for item in node:
+            _set_images(item, spec)
+
+# strategic merge patches
+def _merge_key(field, current, patch, builtin):
+    items = [i for i in current + patch if isinstance(i, dict)]
+    if not items or len(items) != len(current) + len(patch):
+        return None
+    if builtin:
+        key = _MERGE_KEYS.get(field)
+        if field == "ports":
+            key = "containerPort" if any("containerPort" in i for i in items) else "port"
+        return key if key and all(key in i or i.get("$patch") for i in items) else None
+    for key in _ASSOCIATIVE_KEYS:
+        if all(key in i for i in items):
+            return key
+    return None
+
+def _merge_list(field, current, patch, builtin):
+    key = _merge_key(field, current, patch, builtin)
+    if key is None:
+        return [p for p in patch if not (isinstance(p, dict) and p.get("$patch") == "delete")]
+    res = list(current)
+    for item in patch:
+        idx = next((n for n, c in enumerate(res) if c.get(key) == item.get(key)), None)
+        directive = item.get("$patch")
+        if directive == "delete":
+            if idx is not None:
+                res.pop(idx)
+        elif directive == "replace":
+            raise UnsupportedKustomization("$patch: replace in list items")
+        elif idx is None:
+            res.append(_merge({}, item, builtin))
+        else:
+            res[idx] = _merge(res[idx], item, builtin)
+    return res
+
+def _merge(current, patch, builtin):
+    """
+    strategic merge of a patch in an object
+    >>> cur = {"spec": {"containers": [{"name": "a", "image": "x", "args": ["1"]}, {"name": "b"}]}}
+    >>> patch = {"spec": {"containers": [{"name": "a", "args": ["2"], "env": [{"name": "E", "value": "v"}]}, {"name": "b", "$patch": "delete"}]}}
+    >>> _merge(cur, patch, True)
+    {'spec': {'containers': [{'name': 'a', 'image': 'x', 'args': ['2'], 'env': [{'name': 'E', 'value': 'v'}]}]}}
+    >>> _merge({"a": {"b": 1, "c": 2}}, {"a": {"b": None}}, True)
+    {'a': {'c': 2}}
+    >>> _merge({"a": {"b": 1}}, {"a": {"$patch": "replace", "c": 2}}, True)
+    {'a': {'c': 2}}
+    """
+    if not isinstance(current, dict) or not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    if patch.get("$patch") == "replace":
+        return {k: copy.deepcopy(v) for k, v in patch.items() if k != "$patch"}
+    res = dict(current)
+    for key, value in patch.items():
+        if key.startswith("$"):
+            if key == "$patch":
+                continue
+            raise UnsupportedKustomization(f"unsupported patch directive {key}")
+        if value is None:
+            res.pop(key, None)
+        elif isinstance(value, dict) and isinstance(res.get(key), dict):
+            res[key] = _merge(res[key], value, builtin)
+        elif isinstance(value, list) and isinstance(res.get(key), list):
+            res[key] = _merge_list(key, res[key], value, builtin)
+        elif isinstance(value, dict):
+            res[key] = _merge({}, value, builtin)
+        elif isinstance(value, list):
+            res[key] = _merge_list(key, [], value, builtin)
+        else:
+            res[key] = value
+    return res
+
+# json 6902 patches
+def _pointer(path):
+    if path == "":
+        return []
+    if not path.startswith("/"):
+        raise KustomizeError(f"invalid json pointer {path}")
+    return [p.replace("~1", "/").replace("~0", "~") for p in path[1:].split("/")]
+
+def _resolve(doc, tokens, path):
+    for token in tokens:
+        if isinstance(doc, dict) and token in doc:
+            doc = doc[token]
+        elif isinstance(doc, list) and token.isdigit() and int(token) < len(doc):
+            doc = doc[int(token)]
+        else:
+            raise KustomizeError(f"json patch: missing path {path}")
+    return doc
+
+def _index(container, token, path, adding=False):
+    if token == "-" and adding:
+        return len(container)
+    if not token.isdigit() or int(token) > len(container) - (0 if adding else 1):
+        raise KustomizeError(f"json patch: invalid index {token} in {path}")
+    return int(token)
+
+def _json_patch(doc, ops):
+    """
+    apply a list of json 6902 operations
+    >>> doc = {"spec": {"resources": {"requests": {"storage": "1Gi"}}, "args": ["a"]}}
+    >>> _json_patch(doc, [{"op": "replace", "path": "/spec/resources/requests/storage", "value": "10Gi"},
+    ...                   {"op": "add", "path": "/spec/args/-", "value": "b"}, {"op": "remove", "path": "/spec/args/0"}])
+    {'spec': {'resources': {'requests': {'storage': '10Gi'}}, 'args': ['b']}}
+    """
+    for op in ops:
+        kind, path = op.get("op"), op.get("path", "")
+        tokens = _pointer(path)
+        if kind in ["move", "copy"]:
+            source = _resolve(doc, _pointer(op["from"]), op["from"])
+            value = copy.deepcopy(source)
+            if kind == "move":
+                doc = _json_patch(doc, [{"op": "remove", "path": op["from"]}])
+            doc = _json_patch(doc, [{"op": "add", "path": path, "value": value}])
+            continue
+        if kind == "test":
+            if _resolve(doc, tokens, path) != op.get("value"):
+                raise KustomizeError(f"json patch: test failed for {path}")
+            continue
+        if not tokens:
+            if kind in ["add", "replace"]:
+                doc = copy.deepcopy(op.get("value"))
+                continue
+            raise KustomizeError(f"json patch: cannot {kind} the whole document")
+        parent = _resolve(doc, tokens[:-1], path)
+        last = tokens[-1]
+        if kind == "add":
+            if isinstance(parent, list):
+                parent.insert(_index(parent, last, path, adding=True), copy.deepcopy(op.get("value")))
+            else:
+                parent[last] = copy.deepcopy(op.get("value"))
+        elif kind == "replace":
+            if isinstance(parent, list):
+                parent[_index(parent, last, path)] = copy.deepcopy(op.get("value"))
+            elif last in parent:
+                parent[last] = copy.deepcopy(op.get("value"))
+            else:
+                raise KustomizeError(f"json patch: replace operation does not apply, missing path {path}")
+        elif kind == "remove":
+            if isinstance(parent, list):
+                parent.pop(_index(parent, last, path))
+            elif last in parent:
+                del parent[last]
+            else:
+                raise KustomizeError(f"json patch: remove operation does not apply, missing path {path}")
+        else:
+            raise KustomizeError(f"json patch: unknown operation {kind}")
+    return doc
+
+# patch selection
+def _selected(obj, target):
+    unsupported = set(target.keys()) - {"group", "version", "kind", "name", "namespace"}
+    if unsupported:
+        raise UnsupportedKustomization(f"unsupported patch target fields: {', '.join(sorted(unsupported))}")
+    group, version = _split_gv(obj.get("apiVersion"))
+    if target.get("group") and target["group"] != group:
+        return False
+    if target.get("version") and target["version"] != version:
+        return False
+    if target.get("kind") and target["kind"] != obj.get("kind"):
+        return False
+    if target.get("name") and not re.fullmatch(target["name"], obj.get("metadata", {}).get("name", "")):
+        return False
+    if target.get("namespace") and not re.fullmatch(target["namespace"], _namespace(obj)):
+        return False
+    return True
+
+def _builtin(obj):
+    return _split_gv(obj.get("apiVersion"))[0] in _BUILTIN_GROUPS
+
+def _parse_patch(content, where):
+    # a patch is either a list of json 6902 operations or strategic merge patches
+    if isinstance(content, list):
+        return content, []
+    if isinstance(content, dict):
+        return None, [content]
+    docs = _load_all(content, where)
+    if len(docs) == 1 and isinstance(docs[0], list):
+        return docs[0], []
+    if not all(isinstance(doc, dict) for doc in docs):
+        raise KustomizeError(f"invalid patch {where}")
+    return None, docs
+
+def _apply_patch(objs, content, target, where):
+    docs, patches = _parse_patch(content, where)
+    if docs is not None:
+        # json 6902
+        if not target:
+            raise KustomizeError(f"json patch {where} requires a target")
+        for n, obj in enumerate(objs):
+            if _selected(obj, target):
+                objs[n] = _json_patch(obj, copy.deepcopy(docs))
+        return
+
+    for patch in patches:
+        if target:
+            body = {k: v for k, v in patch.items() if k not in ["apiVersion", "kind"]}
+            meta = {k: v for k, v in body.get("metadata", {}).items() if k not in ["name", "namespace"]}
+            body["metadata"] = meta
+            if not meta:
+                body.pop("metadata")
+            for n, obj in enumerate(objs):
+                if _selected(obj, target):
+                    objs[n] = _merge(obj, body, _builtin(obj))
+            continue
+        matching = [n for n, obj in enumerate(objs) if _id(obj) == _id(patch)]
+        if len(matching) != 1:
+            api_version, kind, name, ns = _id(patch)
+            raise KustomizeError(f"no resource matches strategic merge patch \"{kind}.{api_version} {ns}/{name}\"")
+        n = matching[0]
+        body = {k: v for k, v in patch.items() if k not in ["apiVersion", "kind"]}
+        objs[n] = _merge(objs[n], body, _builtin(objs[n]))
+
+def _patches(objs, kust, src):
+    for path in kust.get("patchesStrategicMerge", []) or []:
+        if isinstance(path, str) and "\n" not in path and not path.strip().startswith("{"):
+            _apply_patch(objs, src.text(path), None, path)
+        else:
+            _apply_patch(objs, path, None, "inline patch")
+    for entry in kust.get("patches", []) or []:
+        unsupported = set(entry.keys()) - {"path", "patch", "target"}
+        if unsupported:
+            raise UnsupportedKustomization(f"unsupported patch fields: {', '.join(sorted(unsupported))}")
+        if "path" in entry:
+            _apply_patch(objs, src.text(entry["path"]), entry.get("target"), entry["path"])
+        elif "patch" in entry:
+            _apply_patch(objs, entry["patch"], entry.get("target"), "inline patch")
+    for entry in kust.get("patchesJson6902", []) or []:
+        content = src.text(entry["path"]) if "path" in entry else entry["patch"]
+        _apply_patch(objs, content, entry["target"], entry.get("path", "inline patch"))
+
+# generators
+def _go_json(value):
+    # encoding/json output: sorted keys, no spaces, html characters escaped
+    out = json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    for c, e in [("<", "\\u003c"), (">", "\\u003e"), ("&", "\\u0026"), ("\u2028", "\\u2028"), ("\u2029", "\\u2029")]:
+        out = out.replace(c, e)
+    return out
+
+def _encode_hash(hex):
+    """
+    >>> _encode_hash("0123456789abcdef")
+    'gh2k456789'
+    """
+    table = {"0": "g", "1": "h", "3": "k", "a": "m", "e": "t"}
+    return "".join(table.get(c, c) for c in hex[:10])
+
+def name_hash(obj):
+    """
+    the suffix kustomize adds to the name of generated config maps and secrets
+    >>> name_hash({"kind": "ConfigMap", "metadata": {"name": ""}, "data": {"two": "2", "one": "", "three": "3"}})
+    'f5h7t85m9b'
+    >>> name_hash({"kind": "Secret", "type": "my-type", "metadata": {"name": ""}, "data": {"one": ""}})
+    '74bd68bm66'
+    """
+    name = obj.get("metadata", {}).get("name", "")
+    if obj["kind"] == "ConfigMap":
+        m = {"kind": "ConfigMap", "name": name, "data": obj.get("data", "")}
+        if isinstance(obj.get("binaryData"), dict):
+            m["binaryData"] = obj["binaryData"]
+    else:
+        m = {"kind": "Secret", "type": obj.get("type", ""), "name": name, "data": obj.get("data", "")}
+        if isinstance(obj.get("stringData"), dict):
+            m["stringData"] = obj["stringData"]
+    return _encode_hash(hashlib.sha256(_go_json(m).encode("utf-8")).hexdigest())
+
+def _unquote(value):
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+        return value[1:-1]
+    return value
+
+def _generator_data(gen, src):
+    # returns a list of (key, bytes)
+    data = []
+    for literal in gen.get("literals", []) or []:
+        if "=" not in literal:
+            raise KustomizeError(f"invalid literal source {literal}, expected key=value")
+        k, v = literal.split("=", 1)
+        data.append((k.strip(), _unquote(v).encode("utf-8")))
+    for file in gen.get("files", []) or []:
+        k, path = file.split("=", 1) if "=" in file else (os.path.basename(file), file)
+        data.append((k.strip(), src.read(path.strip())))
+    for env in (gen.get("envs", []) or []) + ([gen["env"]] if gen.get("env") else []):
+        for line in src.text(env).splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if "=" not in line:
+                raise UnsupportedKustomization(f"env file {env}: values from the environment")
+            k, v = line.split("=", 1)
+            data.append((k.strip(), v.encode("utf-8")))
+    keys = [k for k, _ in data]
+    for k in keys:
+        if keys.count(k) > 1:
+            raise KustomizeError(f"cannot add key {k}, another key by that name already exists")
+    return data
+
+def _generate(kind, gen, options, src):
+    unsupported = set(gen.keys()) - {"name", "namespace", "literals", "files", "envs", "env", "options", "type", "behavior"}
+    if unsupported:
+        raise UnsupportedKustomization(f"unsupported generator fields: {', '.join(sorted(unsupported))}")
+    if gen.get("behavior", "create") != "create":
+        raise UnsupportedKustomization(f"generator behavior {gen['behavior']}")
+    opts = {**options, **(gen.get("options") or {})}
+    meta = {"name": gen["name"]}
+    if gen.get("namespace"):
+        meta["namespace"] = gen["namespace"]
+    for field in ["labels", "annotations"]:
+        values = {**(options.get(field) or {}), **((gen.get("options") or {}).get(field) or {})}
+        if values:
+            meta[field] = values
+    obj = {"apiVersion": "v1", "kind": kind, "metadata": meta}
+    if kind == "Secret":
+        obj["type"] = gen.get("type", "Opaque")
+    data, binary = {}, {}
+    for key, value in _generator_data(gen, src):
+        if kind == "Secret":
+            data[key] = base64.b64encode(value).decode("ascii")
+            continue
+        try:
+            data[key] = value.decode("utf-8")
+        except UnicodeDecodeError:
+            binary[key] = base64.b64encode(value).decode("ascii")
+    if data:
+        obj["data"] = data
+    if binary:
+        obj["binaryData"] = binary
+    if opts.get("immutable"):
+        obj["immutable"] = True
+    return obj, not opts.get("disableNameSuffixHash", False)
+
+# references to generated objects, relative to the pod spec
+def _references(spec, kind):
+    refs = []
+    def add(parent, field):
+        if isinstance(parent, dict) and isinstance(parent.get(field), str):
+            refs.append((parent, field))
+    containers = [c for f in ["containers", "initContainers", "ephemeralContainers"]
+                  for c in spec.get(f, []) or [] if isinstance(c, dict)]
+    for c in containers:
+        for env in c.get("env", []) or []:
+            add((env.get("valueFrom") or {}).get("configMapKeyRef" if kind == "ConfigMap" else "secretKeyRef"), "name")
+        for env in c.get("envFrom", []) or []:
+            add(env.get("configMapRef" if kind == "ConfigMap" else "secretRef"), "name")
+    for volume in spec.get("volumes", []) or []:
+        if kind == "ConfigMap":
+            add(volume.get("configMap"), "name")
+        else:
+            add(volume.get("secret"), "secretName")
+        for source in (volume.get("projected") or {}).get("sources", []) or []:
+            add(source.get("configMap" if kind == "ConfigMap" else "secret"), "name")
+    if kind == "Secret":
+        for secret in spec.get("imagePullSecrets", []) or []:
+            add(secret, "name")
+    return refs
+
+def _rename_references(objs, generated):
+    for obj in objs:
+        path = _POD_SPEC.get(obj.get("kind"))
+        spec = obj
+        for field in path or []:
+            spec = spec.get(field) if isinstance(spec, dict) else None
+        if not path or not isinstance(spec, dict):
+            continue
+        for (kind, name, ns), new_name in generated.items():
+            if ns != _namespace(obj):
+                continue
+            for parent, field in _references(spec, kind):
+                if parent[field] == name:
+                    parent[field] = new_name
+
+def _gvk_order(obj):
+    kind = obj.get("kind", "")
+    if kind in _ORDER_FIRST:
+        index = _ORDER_FIRST.index(kind) - len(_ORDER_FIRST)
+    elif kind in _ORDER_LAST:
+        index = 1 + _ORDER_LAST.index(kind)
+    else:
+        index = 0
+    group, version = _split_gv(obj.get("apiVersion"))
+    return (index, "_".join([group or "~G", version or "~V", kind or "~K"]))
+
+def sort_legacy(objs):
+    """
+    sort the objects in the order of `kustomize build --reorder legacy`
+    >>> objs = [{"apiVersion": "apps/v1", "kind": "StatefulSet", "metadata": {"name": "b"}},
+    ...         {"apiVersion": "v1", "kind": "Service", "metadata": {"name": "b"}},
+    ...         {"apiVersion": "nuvolaris.org/v1", "kind": "Whisk", "metadata": {"name": "a"}},
+    ...         {"apiVersion": "v1", "kind": "Service", "metadata": {"name": "a"}}]
+    >>> [(o["kind"], o["metadata"]["name"]) for o in sort_legacy(objs)]
+    [('Service', 'a'), ('Service', 'b'), ('StatefulSet', 'b'), ('Whisk', 'a')]
+    """
+    def key(obj):
+        meta = obj.get("metadata", {})
+        return (_gvk_order(obj), f"{meta.get('name') or '~N'}_{meta.get('namespace') or '~X'}")
+    return sorted(objs, key=key)
+
+def _resources(kust, src):
+    objs = []
+    for res in kust.get("resources", []) or []:
+        if "://" in res or res.startswith("github.com/"):
+            raise UnsupportedKustomization(f"remote resource {res}")
+        if src.isdir(res):
+            objs.extend(build(src.sub(res), sort=False))
+        else:
+            objs.extend(_load_all(src.text(res), src.path(res)))
+    return objs
+
+def build(src, sort=True):
+    """
+    build the kustomization in the given folder or Source, returning the list of objects
+    """
+    if not isinstance(src, Source):
+        src = Source(src)
+    kust = load_kustomization(src)
+    objs = _resources(kust, src)
+
+    options = kust.get("generatorOptions") or {}
+    hashed = []
+    for kind, field in [("ConfigMap", "configMapGenerator"), ("Secret", "secretGenerator")]:
+        for gen in kust.get(field, []) or []:
+            obj, suffix = _generate(kind, gen, options, src)
+            if any(_id(o) == _id(obj) for o in objs):
+                raise KustomizeError(f"may not add resource with an already registered id: {kind} {gen['name']}")
+            objs.append(obj)
+            if suffix:
+                hashed.append(obj)
+
+    _patches(objs, kust, src)
+
+    # like kustomize, the images are set after the patches, also on the containers they add
+    for image in kust.get("images", []) or []:
+        for obj in objs:
+            _set_images(obj, image)
+
+    # the hash is computed on the patched objects, then references are renamed
+    generated = {}
+    for obj in hashed:
+        current = next(o for o in objs if o.get("kind") == obj["kind"] and o["metadata"]["name"] == obj["metadata"]["name"]
+                       and _namespace(o) == _namespace(obj))
+        name = current["metadata"]["name"]
+        new_name = f"{name}-{name_hash(current)}"
+        generated[(current["kind"], name, _namespace(current))] = new_name
+        current["metadata"]["name"] = new_name
+    if generated:
+        _rename_references(objs, generated)
+
+    return sort_legacy(objs) if sort else objs
+
+def dump(objs):
+    """
+    serialize the objects as a multi document yaml, like kustomize prints them
+    >>> print(dump([{"kind": "ConfigMap", "data": {"a.json": "{\\n}\\n"}}, {"kind": "Pod"}]), end="")
+    data:
+      a.json: |
+        {
+        }
+    kind: ConfigMap
+    ---
+    kind: Pod
+    """
+    return "---\n".join(yaml.dump(obj, Dumper=_Dumper, default_flow_style=False, sort_keys=True, width=1 << 30)
+                        for obj in objs)
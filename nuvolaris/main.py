@@ -17,36 +17,48 @@
 #
 import kopf
 import logging
-import json, os, os.path
+import json, os, os.path, time
+from collections import namedtuple
+from contextlib import contextmanager
 import nuvolaris.config as cfg
 import nuvolaris.kube as kube
-import nuvolaris.redis as redis
-import nuvolaris.couchdb as couchdb
-import nuvolaris.bucket as bucket
-import nuvolaris.openwhisk as openwhisk
-import nuvolaris.cronjob as cron
-import nuvolaris.ferretdb as mongodb
-import nuvolaris.issuer as issuer
-import nuvolaris.endpoint as endpoint
-import nuvolaris.minio_deploy as minio
-import nuvolaris.zookeeper as zookeeper
-import nuvolaris.kafka as kafka
-import nuvolaris.invoker as invoker
-import nuvolaris.patcher as patcher
-import nuvolaris.storage_static as static
 import nuvolaris.operator_util as operator_util
-import nuvolaris.postgres_operator as postgres
-import nuvolaris.runtimes_preloader as preloader
-import nuvolaris.monitoring as monitoring
-import nuvolaris.quota_checker_job as quota
-import nuvolaris.etcd as etcd
-import nuvolaris.milvus_standalone as milvus
-import nuvolaris.registry_deploy as registry
-import nuvolaris.seaweedfs_deploy as seaweedfs
+from nuvolaris.component_registry import lazy, report as import_report
+import nuvolaris.component_digest as digests
+import nuvolaris.tracing as tracing
+import nuvolaris.metrics as metrics
+from nuvolaris.component_graph import run as graph_run, reverse, critical_path, summary, first_error
+from nuvolaris.update_coalescer import coalesce
+import nuvolaris.runtimes_diff as runtimes_diff
+
+# component modules are imported when first used, see component_registry
+redis = lazy("nuvolaris.redis", "redis")
+couchdb = lazy("nuvolaris.couchdb", "couchdb")
+bucket = lazy("nuvolaris.bucket", "bucket")
+openwhisk = lazy("nuvolaris.openwhisk", "openwhisk")
+cron = lazy("nuvolaris.cronjob", "cron")
+mongodb = lazy("nuvolaris.ferretdb", "mongodb")
+issuer = lazy("nuvolaris.issuer", "issuer")
+endpoint = lazy("nuvolaris.endpoint", "endpoint")
+minio = lazy("nuvolaris.minio_deploy", "minio")
+zookeeper = lazy("nuvolaris.zookeeper", "zookeeper")
+kafka = lazy("nuvolaris.kafka", "kafka")
+invoker = lazy("nuvolaris.invoker", "invoker")
+patcher = lazy("nuvolaris.patcher", "patcher")
+static = lazy("nuvolaris.storage_static", "static")
+postgres = lazy("nuvolaris.postgres_operator", "postgres")
+preloader = lazy("nuvolaris.runtimes_preloader", "preloader")
+monitoring = lazy("nuvolaris.monitoring", "monitoring")
+quota = lazy("nuvolaris.quota_checker_job", "quota")
+etcd = lazy("nuvolaris.etcd", "etcd")
+milvus = lazy("nuvolaris.milvus_standalone", "milvus")
+registry = lazy("nuvolaris.registry_deploy", "registry")
+seaweedfs = lazy("nuvolaris.seaweedfs_deploy", "seaweedfs")
 
 @kopf.on.startup()
 def configure(settings: kopf.OperatorSettings, **_):
   settings.watching.server_timeout = 210
+  metrics.start()
 
 # tested by an integration test
 @kopf.on.login()
@@ -65,14 +77,74 @@ def login(logger, **kwargs):
                 continue
             if credentials is not None:
                 logger.info("authenticated in-cluster via %s", method)
+                kube.configure_backend(credentials)
                 return credentials
             logger.warning("login via %s returned no credentials", method)
         raise kopf.LoginError("No in-cluster credentials were retrieved from service account, client, or pykube.")
     logger.debug("login via client")
-    return kopf.login_via_client(logger=logger, **kwargs)
+    credentials = kopf.login_via_client(logger=logger, **kwargs)
+    if credentials is not None:
+        kube.configure_backend(credentials)
+    return credentials
+
+def _create_openwhisk(owner):
+    logging.info(openwhisk.create(owner))
+    return endpoint.create(owner)
+
+def _delete_openwhisk():
+    logging.info(openwhisk.delete())
+    return endpoint.delete()
+
+# a component deployed by whisk_create and removed by whisk_delete:
+# enabled(runtime) tells if it is deployed, it is created after the enabled
+# components in `after` and deleted before them; the failure of a fatal
+# component stops the deployment and is raised to kopf
+Component = namedtuple("Component", ["name", "states", "enabled", "after", "create", "delete", "fatal"])
+
+# in the legacy sequential order
+COMPONENTS = [
+    Component("preloader", ["preloader"], lambda rt: cfg.get('components.openwhisk'), [], preloader.deferred("create"), preloader.deferred("delete"), False),
+    Component("couchdb", ["couchdb"], lambda rt: cfg.get('components.couchdb'), [], couchdb.deferred("create"), couchdb.deferred("delete"), False),
+    Component("redis", ["redis"], lambda rt: cfg.get('components.redis'), [], redis.deferred("create"), redis.deferred("delete"), False),
+    Component("registry", ["registry"], lambda rt: cfg.get('components.registry'), [], registry.deferred("create"), registry.deferred("delete"), False),
+    Component("issuer", ["issuer", "tls"], lambda rt: cfg.get('components.tls') and not rt in ["kind","openshift"], [], issuer.deferred("create"), issuer.deferred("delete"), False),
+    Component("cron", ["cron"], lambda rt: cfg.get('components.cron'), ["couchdb"], cron.deferred("create"), cron.deferred("delete"), False),
+    Component("minio", ["minio"], lambda rt: cfg.get('components.minio'), [], minio.deferred("create"), minio.deferred("delete"), True),
+    Component("seaweedfs", ["seaweedfs"], lambda rt: cfg.get('components.seaweedfs'), [], seaweedfs.deferred("create"), seaweedfs.deferred("delete"), True),
+    Component("static", ["static"], lambda rt: cfg.get('components.static'), ["minio", "seaweedfs"], static.deferred("create"), static.deferred("delete"), True),
+    Component("postgres", ["postgres"], lambda rt: cfg.get('components.postgres') or cfg.get('components.mongodb'), [], postgres.deferred("create"), postgres.deferred("delete"), True),
+    Component("mongodb", ["mongodb"], lambda rt: cfg.get('components.mongodb'), ["postgres"], mongodb.deferred("create"), mongodb.deferred("delete"), True),
+    Component("zookeeper", ["zookeeper"], lambda rt: cfg.get('components.zookeeper'), [], zookeeper.deferred("create"), zookeeper.deferred("delete"), False),
+    Component("kafka", ["kafka"], lambda rt: cfg.get('components.kafka'), ["zookeeper"], kafka.deferred("create"), kafka.deferred("delete"), False),
+    Component("invoker", ["invoker"], lambda rt: cfg.get('components.invoker'), ["couchdb", "kafka"], invoker.deferred("create"), invoker.deferred("delete"), False),
+    Component("openwhisk", ["openwhisk", "endpoint"], lambda rt: cfg.get('components.openwhisk'), ["couchdb", "kafka"], _create_openwhisk, _delete_openwhisk, False),
+    Component("monitoring", ["monitoring"], lambda rt: cfg.get('components.monitoring'), [], monitoring.deferred("create"), monitoring.deferred("delete"), False),
+    Component("quota", ["quota"], lambda rt: cfg.get('components.quota'), ["redis", "postgres"], quota.deferred("create"), quota.deferred("delete"), False),
+    Component("etcd", ["etcd"], lambda rt: cfg.get('components.etcd'), [], etcd.deferred("create"), etcd.deferred("delete"), False),
+    Component("milvus", ["milvus"], lambda rt: cfg.get('components.milvus'), ["etcd", "minio", "seaweedfs"], milvus.deferred("create"), milvus.deferred("delete"), False),
+]
+
+# a step on a component, traced and measured
+@contextmanager
+def _step(component, action):
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        with tracing.span(component, "component", action=action):
+            yield
+        outcome = "ok"
+    finally:
+        metrics.component_seconds.observe(time.perf_counter() - start, component, action, outcome)
+
+# the dependency graph of the components enabled in the given runtime
+def component_graph(runtime):
+    return {c.name: c.after for c in COMPONENTS if c.enabled(runtime)}
 
 # tested by an integration test
 @kopf.on.create('nuvolaris.org', 'v1', 'whisks')
+@cfg.isolated
+@metrics.handler("whisks", "create")
+@tracing.reconcile("whisk_create")
 def whisk_create(spec, name, **kwargs):
     logging.info(f"*** whisk_create {name}")
 
@@ -106,201 +178,41 @@ def whisk_create(spec, name, **kwargs):
     runtime = cfg.get('nuvolaris.kube')
     logging.info(f"kubernetes engine in use={runtime}")
 
-    if cfg.get('components.openwhisk'):
-        try:
-            msg = preloader.create(owner)
-            state['preloader']= "on"
-            logging.info(msg)
-        except:
-            logging.exception("could not create runtime preloader batch")
-            state['preloader']= "error"
-    else:
-        state['preloader']= "off"   
-
-    if cfg.get('components.couchdb'):
-        try:
-            msg = couchdb.create(owner)
-            state['couchdb']= "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot create couchdb")
-            state['couchdb']= "error"
-    else:
-        state['couchdb'] = "off"
-
-    if cfg.get('components.redis'):
-        try:
-            msg = redis.create(owner)
-            state['redis'] = "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot create redis")
-            state['redis']= "error"
-    else:
-        state['redis'] = "off"
-
-    if cfg.get('components.registry'):
-        try:
-            msg = registry.create(owner)
-            state['registry'] = "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot create registry")
-            state['registry']= "error"
-    else:
-        state['registry'] = "off"         
-
-    if cfg.get('components.tls') and not runtime in ["kind","openshift"]:
-        try:
-            msg = issuer.create(owner)
-            state['issuer'] = "on"
-            state['tls'] = "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot configure issuer")
-            state['issuer']= "error"
-            state['tls'] = "error"
-    else:
-        state['issuer'] = "off"
-        state['tls'] = "off"
-        if runtime == "kind" and cfg.get('components.tls'):
-            logging.info("*** cluster issuer will not be deployed with kind runtime")
-
-    if cfg.get('components.cron'):
-        try:
-            msg = cron.create(owner)
-            state['cron'] = "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot create cron")
-            state['cron']= "error"
-    else:
-        state['cron'] = "off" 
-
-    if cfg.get('components.minio'):
-        msg = minio.create(owner)
-        logging.info(msg)
-        state['minio'] = "on"
-    else:
-        state['minio'] = "off"
-
-    if cfg.get('components.seaweedfs'):
-        msg = seaweedfs.create(owner)
-        logging.info(msg)
-        state['seaweedfs'] = "on"
-    else:
-        state['seaweedfs'] = "off"         
-
-    if cfg.get('components.static'):
-        msg = static.create(owner)
-        logging.info(msg)
-        state['static'] = "on"
-    else:
-        state['static'] = "off"
-
-    if cfg.get('components.postgres') or cfg.get('components.mongodb'):
-        msg = postgres.create(owner)
-        logging.info(msg)
-        state['postgres'] = "on"
-    else:
-        state['postgres'] = "off"
-
-    if cfg.get('components.mongodb'):
-        msg = mongodb.create(owner)
-        logging.info(msg)
-        state['mongodb'] = "on"
-    else:
-        state['mongodb'] = "off"
-    
-    if(cfg.get('components.zookeeper')):
-        try:
-            msg = zookeeper.create(owner)
-            state['zookeeper'] = "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot create zookeeper")
-            state['zookeeper'] = "error"
-
-    if(cfg.get('components.kafka')):
-        try:
-            msg = kafka.create(owner)
-            state['kafka'] = "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot create kafka")
-            state['kafka'] = "error"            
-
-    if (cfg.get('components.invoker')):
-        try:
-            msg = invoker.create(owner)
-            state['invoker'] = "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot create openwhisk invoker")
-            state['invoker']= "error"
-
-    if cfg.get('components.openwhisk'):
-        try:
-            msg = openwhisk.create(owner)
-            state['openwhisk'] = "on"
-            logging.info(msg)
-
-            msg = endpoint.create(owner)
-            state['endpoint'] = "on"
-            logging.info(msg)
-
-        except:
-            logging.exception("cannot create openwhisk")
-            state['openwhisk']= "error"
-            state['endpoint'] = "error"
-    else:
-        state['openwhisk'] = "off"
-        state['endpoint'] = "off"
-
-    if (cfg.get('components.monitoring')):
-        try:
-            msg = monitoring.create(owner)
-            state['monitoring'] = "on"
-            logging.info(msg)
-
-        except:
-            logging.exception("cannot create monitoring")
-            state['monitoring']= "error"
-    else:
-        state['monitoring'] = "off"
-
-    if cfg.get('components.quota'):
-        try:
-            msg = quota.create(owner)
-            state['quota'] = "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot create quotaa checker")
-            state['quota']= "error"
-    else:
-        state['quota'] = "off"
-
-    if cfg.get('components.etcd'):
+    graph = component_graph(runtime)
+    for c in COMPONENTS:
+        if c.name not in graph:
+            for key in c.states:
+                state[key] = "off"
+    if runtime == "kind" and cfg.get('components.tls'):
+        logging.info("*** cluster issuer will not be deployed with kind runtime")
+
+    steps = {c.name: c for c in COMPONENTS}
+    fingerprints = {}
+    def deploy(component):
+        c = steps[component]
         try:
-            msg = etcd.create(owner)
-            state['etcd'] = "on"
+            with _step(component, "create"):
+                msg, fingerprints[component] = _fingerprinted(c.create, owner)
+            for key in c.states:
+                state[key] = "on"
             logging.info(msg)
         except:
-            logging.exception("cannot create etcd")
-            state['etcd']= "error"
-    else:
-        state['etcd'] = "off" 
-
-    if cfg.get('components.milvus'):
-        try:
-            msg = milvus.create(owner)
-            state['milvus'] = "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot create milvus")
-            state['milvus']= "error"
-    else:
-        state['milvus'] = "off"  
+            if c.fatal:
+                raise
+            logging.exception(f"cannot create {component}")
+            for key in c.states:
+                state[key] = "error"
+
+    start = time.monotonic()
+    base = cfg.getall()
+    results = graph_run(graph, deploy)
+    path, elapsed = critical_path(graph, results)
+    logging.info(f"components deployed in {time.monotonic() - start:.1f}s, critical path {' > '.join(path)} {elapsed:.1f}s")
+    _store_fingerprints(kwargs.get("patch"), {}, fingerprints, base)
+    logging.info(f"component modules imported:\n{import_report()}")
+    error = first_error(results)
+    if error:
+        raise error
 
     whisk_post_create(name,state)
     state['controller']= "Ready"
@@ -313,88 +225,98 @@ def whisk_post_create(name, state):
     else:                   
         state['whisk-system']="error"
 
+# redeploy the components whose inputs changed since they were deployed
+# when off, updates fall back to the kopf diff rules only
+incremental_reconcile = os.environ.get("NUVOLARIS_INCREMENTAL_RECONCILE", "on") != "off"
+
+# create a component recording what it uses, returns the create result and the recording
+def _fingerprinted(create, owner):
+    with digests.recording() as rec:
+        msg = create(owner)
+    return msg, rec
+
+# store in the status the fingerprints of the components, the configuration
+# keys written while deploying (not present or different in base) are not inputs
+def _store_fingerprints(patch, previous, recordings, base):
+    current = cfg.getall()
+    written = {k for k, v in current.items() if k not in base or base[k] != v}
+    fingerprints = dict(previous or {})
+    for name, rec in recordings.items():
+        fingerprints[name] = digests.fingerprint(rec, exclude=written)
+    if patch is not None:
+        patch.status['digests'] = fingerprints
+    return fingerprints
+
+def _redeploy_openwhisk(owner):
+    patcher.redeploy_controller(owner)
+    return endpoint.create(owner)
+
+# how the components are redeployed when their inputs changed, if not created again
+REDEPLOY = {
+    "openwhisk": _redeploy_openwhisk,
+    "invoker": patcher.deferred("redeploy_invoker"),
+}
+
+def reconcile(owner, status, patch, runtime, skip=()):
+    """
+    redeploy the enabled components whose fingerprint in the status changed,
+    except the skipped ones (just created or deleted); returns their names
+    """
+    previous = dict((status or {}).get('digests') or {})
+    if not incremental_reconcile or not previous:
+        return []
+    graph = component_graph(runtime)
+    for name in list(previous):
+        if name not in graph or name in skip:
+            previous.pop(name)
+    todo = digests.changed(previous, [n for n in graph if n not in skip])
+    if not todo:
+        logging.info("*** no component changed, nothing to redeploy")
+        _store_fingerprints(patch, previous, {}, cfg.getall())
+        return []
+    logging.info(f"*** redeploying changed components: {', '.join(todo)}")
+
+    steps = {c.name: c for c in COMPONENTS}
+    recordings = {}
+    def redeploy(component):
+        with _step(component, "redeploy"):
+            msg, recordings[component] = _fingerprinted(REDEPLOY.get(component, steps[component].create), owner)
+        logging.info(msg)
+
+    base = cfg.getall()
+    results = graph_run({n: graph[n] for n in todo}, redeploy, abort_on_error=False)
+    logging.info(f"reconcile summary:\n{summary(results)}")
+    _store_fingerprints(patch, previous, recordings, base)
+    return todo
+
+# how long, in seconds, the removal of a component can take
+teardown_deadline = int(os.environ.get("NUVOLARIS_TEARDOWN_DEADLINE", "300"))
+
 # tested by an integration test
 @kopf.on.delete('nuvolaris.org', 'v1', 'whisks')
+@cfg.isolated
+@metrics.handler("whisks", "delete")
+@tracing.reconcile("whisk_delete")
 def whisk_delete(spec, **kwargs):
     runtime = cfg.get('nuvolaris.kube')
     logging.info("whisk_delete")
-   
-    if cfg.get("components.openwhisk"):
-        msg = preloader.delete()
-        msg = openwhisk.delete()
-        logging.info(msg)
-        msg = endpoint.delete()
-        logging.info(msg)
-
-    if cfg.get("components.invoker"):       
-        msg = invoker.delete()
-        logging.info(msg)            
 
-    if cfg.get('components.tls') and not runtime == "kind":
-        msg = issuer.delete()
+    # components are removed before the ones they were created after
+    steps = {c.name: c for c in COMPONENTS}
+    def remove(component):
+        with _step(component, "delete"):
+            msg = steps[component].delete()
         logging.info(msg)
+        return msg
 
-    if cfg.get("components.redis"):
-        msg = redis.delete()
-        logging.info(msg)
+    results = graph_run(reverse(component_graph(runtime)), remove, abort_on_error=False, deadline=teardown_deadline)
+    logging.info(f"whisk_delete summary:\n{summary(results)}")
+    error = first_error(results)
+    if error and not isinstance(error, TimeoutError):
+        raise error
+    return {name: "removed" if res.ok else "timeout" if isinstance(res.error, TimeoutError) else "error"
+            for name, res in results.items()}
 
-    if cfg.get('components.couchdb'):
-        msg = couchdb.delete()
-        logging.info(msg)
-        
-    if cfg.get("components.mongodb"):
-        msg = mongodb.delete()
-        logging.info(msg)         
-
-    if cfg.get("components.cron"):
-        msg = cron.delete()
-        logging.info(msg)
-
-    if cfg.get('components.static'):
-        msg = static.delete()
-        logging.info(msg) 
-
-    if cfg.get("components.minio"):
-        msg = minio.delete()
-        logging.info(msg)
-
-    if cfg.get("components.seaweedfs"):
-        msg = seaweedfs.delete()
-        logging.info(msg)        
-
-    if cfg.get('components.postgres'):
-        msg = postgres.delete()
-        logging.info(msg)
-                 
-    if cfg.get("components.kafka"):
-        msg = kafka.delete()
-        logging.info(msg)  
-
-    if cfg.get("components.zookeeper"):
-        msg = zookeeper.delete()
-        logging.info(msg)
-    
-    if cfg.get("components.monitoring"):
-        msg = monitoring.delete()
-        logging.info(msg)
-
-    if cfg.get("components.quota"):
-        msg = quota.delete()
-        logging.info(msg) 
-
-    if cfg.get("components.etcd"):
-        msg = etcd.delete()
-        logging.info(msg) 
-
-    if cfg.get("components.milvus"):
-        msg = milvus.delete()
-        logging.info(msg) 
-
-    if cfg.get("components.registry"):
-        msg = registry.delete()
-        logging.info(msg)                                                           
-    
-                         
 # tested by integration test
 #@kopf.on.field("service", field='status.loadBalancer')
 def service_update(old, new, name, **kwargs):
@@ -411,27 +333,75 @@ def service_update(old, new, name, **kwargs):
     cfg.put("config.apihost", apihost)
 
 @kopf.on.update('nuvolaris.org', 'v1', 'whisks')
+@cfg.isolated
+@metrics.handler("whisks", "update")
+@tracing.reconcile("whisk_update")
 def whisk_update(spec, status, namespace, diff, name, **kwargs):
     logging.info(f"*** detected an update of wsk/{name} under namespace {namespace}")
-    
+    # edits in a burst are handled once, with their diffs merged
+    diff = coalesce(f"wsk/{name}", (kwargs.get("meta") or {}).get("generation"), diff)
+
     operator_util.config_from_spec(spec,handler_type="on_update")
     owner = kube.get(f"wsk/{name}")
 
-    patcher.patch(diff, status, owner, name)
+    incremental = incremental_reconcile and bool((status or {}).get('digests'))
+    what_to_do = patcher.patch(diff, status, owner, name, incremental=incremental, post_create=False) or {}
+    added_or_removed = {k for k, v in what_to_do.items() if v in ["create", "delete"]}
+    redeployed = incremental and reconcile(owner, status, kwargs.get("patch"), cfg.get('nuvolaris.kube'), skip=added_or_removed)
+    # the system actions are deployed again once, whatever changed
+    if redeployed or patcher.needs_post_create(what_to_do, incremental):
+        operator_util.whisk_post_create(name)
 
 @kopf.on.resume('nuvolaris.org', 'v1', 'whisks')
+@cfg.isolated
+@metrics.handler("whisks", "resume")
+@tracing.reconcile("whisk_resume")
 def whisk_resume(spec, status, name, **kwargs):   
     operator_util.config_from_spec(spec, handler_type="on_resume")
+    # what a resume reconciles is applied for real, correcting any drift
+    kube.force_apply()
+    owner = kube.get(f"wsk/{name}")
+    reconcile(owner, status, kwargs.get("patch"), cfg.get('nuvolaris.kube'))
     operator_util.whisk_post_resume(name)
 
+# the initial listing (type None) records the runtimes if not known yet
+# or applies the changes happened while the operator was down
 def runtimes_filter(name, type, **kwargs):
-    return name == 'openwhisk-runtimes' and type == 'MODIFIED'  
+    return name == 'openwhisk-runtimes' and type in [None, 'MODIFIED']
 
 @kopf.on.event("configmap", when=runtimes_filter)
+@cfg.isolated
 def runtimes_cm_event_watcher(event, **kwargs):    
-    logging.info("*** detected a change in cm/openwhisk-runtimes config map, restarting openwhisk related PODs")
-    owner = kube.get(f"wsk/controller") 
-    patcher.patch_preloader(owner)
+    owner = kube.get(f"wsk/controller")
+    if not owner:
+        logging.info("*** cm/openwhisk-runtimes changed with no wsk/controller, ignored")
+        return
+    try:
+        current = runtimes_diff.index(json.loads(event['object']['data']['runtimes.json']))
+    except Exception as e:
+        logging.warning(f"*** cannot parse the runtimes of cm/openwhisk-runtimes: {e}")
+        current = None
+    previous = runtimes_diff.stored(owner)
+
+    if not previous or not current:
+        if event.get('type') == 'MODIFIED':
+            logging.info("*** detected a change in cm/openwhisk-runtimes config map, restarting openwhisk related PODs")
+            patcher.patch_preloader(owner)
+            if cfg.get('components.openwhisk'):
+                patcher.restart_whisk(owner)
+        if current:
+            runtimes_diff.record("controller", current)
+        return
 
+    config = cfg.getall()
+    only_apache = config.get("nuvolaris.preload.only-apache", config.get("nuvolaris.preloader.only_apache", True))
+    plan = runtimes_diff.plan(previous, current, invoker=cfg.get('components.invoker') or False, only_apache=only_apache)
+    if not plan['changes']:
+        return
+    logging.info(f"*** detected a change in cm/openwhisk-runtimes config map: {json.dumps(plan)}")
+    if plan['prepull']:
+        patcher.patch_preloader(owner, plan['prepull'])
     if cfg.get('components.openwhisk'):
-        patcher.restart_whisk(owner)
+        for sts in plan['restart']:
+            patcher.rollout(sts)
+    runtimes_diff.record("controller", current, plan)
@@ -0,0 +1,248 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module exports the metrics of the operator in the prometheus text format
+# served on http://<operator>:NUVOLARIS_METRICS_PORT/metrics, "off" disables it;
+# the monitoring component scrapes the operator pod through its annotations
+import os, time, bisect, logging, threading, functools
+import kopf
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+port = os.environ.get("NUVOLARIS_METRICS_PORT", "9180")
+
+# latency buckets in seconds, from a kube call to a full deployment
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_lock = threading.Lock()
+_metrics = []
+_collectors = []
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in pairs) + "}"
+
+class Metric:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.values = {}
+        with _lock:
+            _metrics.append(self)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+class Counter(Metric):
+    """
+    A value only increasing, by label values.
+    >>> c = Counter("test_requests_total", "requests", ["verb"])
+    >>> c.inc("get"); c.inc("get"); c.inc("apply", amount=3)
+    >>> print("\\n".join(c.lines()))
+    # HELP test_requests_total requests
+    # TYPE test_requests_total counter
+    test_requests_total{verb="apply"} 3
+    test_requests_total{verb="get"} 2
+    """
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def lines(self):
+        with _lock:
+            values = sorted(self.values.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {v:g}" for k, v in values]
+
+class Gauge(Counter):
+    """
+    A value going up and down, by label values.
+    >>> g = Gauge("test_in_flight", "in flight", ["resource"])
+    >>> g.inc("whisks"); g.inc("whisks"); g.dec("whisks")
+    >>> g.lines()[-1]
+    'test_in_flight{resource="whisks"} 1'
+    """
+    type = "gauge"
+
+    def dec(self, *labels):
+        self.inc(*labels, amount=-1)
+
+    def set(self, *labels, value):
+        with _lock:
+            self.values[labels] = value
+
+class Histogram(Metric):
+    """
+    The distribution of observed values, by label values.
+    >>> h = Histogram("test_seconds", "latency", ["verb"], buckets=(0.1, 1))
+    >>> h.observe(0.05, "get"); h.observe(0.5, "get"); h.observe(5, "get")
+    >>> print("\\n".join(h.lines()[2:]))
+    test_seconds_bucket{verb="get",le="0.1"} 1
+    test_seconds_bucket{verb="get",le="1"} 2
+    test_seconds_bucket{verb="get",le="+Inf"} 3
+    test_seconds_sum{verb="get"} 5.55
+    test_seconds_count{verb="get"} 3
+    """
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with _lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # per bucket counts, then the sum
+                counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def lines(self):
+        with _lock:
+            values = sorted((k, list(v)) for k, v in self.values.items())
+        res = self.header()
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts[:-1]):
+                total += count
+                res.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', f'{bound:g}' if bound != '+Inf' else bound)])} {total}")
+            res.append(f"{self.name}_sum{_labels(self.labelnames, key)} {counts[-1]:g}")
+            res.append(f"{self.name}_count{_labels(self.labelnames, key)} {total}")
+        return res
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+        return False
+
+def collector(fn):
+    """
+    register a function returning lines computed when the metrics are scraped
+    """
+    with _lock:
+        _collectors.append(fn)
+    return fn
+
+handler_seconds = Histogram("nuvolaris_handler_duration_seconds", "Duration of the kopf handlers.", ["resource", "handler", "outcome"])
+handlers_in_flight = Gauge("nuvolaris_handlers_in_flight", "Kopf handlers running now.", ["resource"])
+kube_seconds = Histogram("nuvolaris_kube_request_duration_seconds", "Duration of the kube calls by verb.", ["verb", "backend"])
+kube_errors = Counter("nuvolaris_kube_request_errors_total", "Kube calls failed by verb.", ["verb", "backend"])
+component_seconds = Histogram("nuvolaris_component_duration_seconds", "Duration of the create, redeploy and delete of each component.", ["component", "action", "outcome"])
+
+def handler(resource, name):
+    """
+    a decorator measuring a kopf handler of the given resource;
+    a handler asking kopf to retry it later is not an error
+    >>> @handler("whisks", "test")
+    ... def waiting():
+    ...     raise kopf.TemporaryError("waiting", delay=1)
+    >>> try: waiting()
+    ... except kopf.TemporaryError: pass
+    >>> [k for k in handler_seconds.values if k[1] == "test"]
+    [('whisks', 'test', 'retry')]
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            handlers_in_flight.inc(resource)
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                res = fn(*args, **kwargs)
+                outcome = "ok"
+                return res
+            except kopf.TemporaryError:
+                outcome = "retry"
+                raise
+            finally:
+                handlers_in_flight.dec(resource)
+                handler_seconds.observe(time.perf_counter() - start, resource, name, outcome)
+        return wrapper
+    return decorator
+
+def observe_kube(verb, backend, elapsed, ok):
+    kube_seconds.observe(elapsed, verb, backend)
+    if not ok:
+        kube_errors.inc(verb, backend)
+
+def render():
+    """
+    all the metrics in the prometheus text format
+    """
+    with _lock:
+        metrics, collectors = list(_metrics), list(_collectors)
+    lines = []
+    for m in metrics:
+        lines += m.lines()
+    for fn in collectors:
+        try:
+            lines += fn()
+        except Exception as e:
+            logging.warning(f"metrics collector {fn.__name__} failed: {e}")
+    return "\n".join(lines) + "\n"
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+_server = None
+
+def start():
+    """
+    serve the metrics in a background thread, once
+    """
+    global _server
+    if port == "off" or _server:
+        return _server
+    try:
+        _server = ThreadingHTTPServer(("", int(port)), _Handler)
+    except OSError as e:
+        logging.warning(f"cannot serve the metrics on port {port}: {e}")
+        return None
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"serving the metrics on port {port}")
+    return _server
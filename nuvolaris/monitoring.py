@@ -31,6 +31,7 @@ import logging
 def create(owner=None):
     """
     Configuring the operator monitoring via prometheus.
+    Prometheus also scrapes the /metrics of the operator pod, annotated with prometheus.io/port.
     """
     logging.info("*** creating prometheus based monitoring")
     alert_manager = cfg.get("monitoring.alert-manager.enabled") or False
@@ -20,11 +20,14 @@ import nuvolaris.config as cfg
 import nuvolaris.openwhisk_standalone as standalone
 import nuvolaris.openwhisk_enterprise as enterprise
 import nuvolaris.kube as kube
+import nuvolaris.cluster_facts as facts
 from nuvolaris.util import nuv_retry
 
 @nuv_retry()
 def annotate(keyval):
     kube.kubectl("annotate", "cm/config",  keyval, "--overwrite")
+    if keyval.startswith("apihost="):
+        facts.invalidate("apihost")
 
 def create(owner=None):
     useInvoker = cfg.get('components.invoker') or False
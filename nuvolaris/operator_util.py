@@ -16,15 +16,18 @@
 # under the License.
 #
 import logging
-import nuvolaris.openwhisk as openwhisk
 import nuvolaris.kube as kube
 import nuvolaris.userdb_util as userdb
 import nuvolaris.config as cfg
 import nuvolaris.util as ut
-import nuvolaris.whisk_actions_deployer as system
-import nuvolaris.redis as redis
+import nuvolaris.cluster_facts as facts
 
 from nuvolaris.nuvolaris_metadata import NuvolarisMetadata
+from nuvolaris.component_registry import lazy
+
+openwhisk = lazy("nuvolaris.openwhisk", "openwhisk")
+system = lazy("nuvolaris.whisk_actions_deployer", "system")
+redis = lazy("nuvolaris.redis", "redis")
 
 def annotate_operator_components_version():
     """
@@ -106,23 +109,26 @@ def config_from_spec(spec, handler_type = "on_create"):
     :param spec 
     :param on_resume boolean flag telling if this method is called from the on_resume handler
     """
-    cfg.clean()
-    cfg.configure(spec)
-    cfg.detect()
+    # the spec and what is detected become a single new snapshot
+    with cfg.batch():
+        cfg.clean()
+        cfg.configure(spec)
+        cfg.detect()
 
-    if "on_create" in handler_type:       
-        cfg.put("config.apihost", "https://pending")
-        logging.debug("**** dumping initial configuration")
+        if "on_create" in handler_type:       
+            cfg.put("config.apihost", "https://pending")
+            logging.debug("**** dumping initial configuration")
 
-    if "on_update" in handler_type:               
-        logging.debug("**** dumping updated configuration")        
+        if "on_update" in handler_type:               
+            logging.debug("**** dumping updated configuration")        
 
-    if "on_resume" in handler_type:
-        apihost = ut.get_apihost_from_config_map()
-        cfg.put("config.apihost", apihost)
-        logging.debug("**** dumping resumed configuration")        
+        if "on_resume" in handler_type:
+            apihost = facts.get("apihost")
+            cfg.put("config.apihost", apihost)
+            logging.debug("**** dumping resumed configuration")        
 
     cfg.dump_config()
+    cfg.publish()
 
 def patch_operator_status(status,component, status_code):
     """
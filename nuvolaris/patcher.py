@@ -15,38 +15,41 @@
 # specific language governing permissions and limitations
 # under the License.
 #
-import logging, time
-import nuvolaris.openwhisk as openwhisk
-import nuvolaris.ferretdb as mongodb
-import nuvolaris.redis as redis
-import nuvolaris.cronjob as cron
-import nuvolaris.minio_deploy as minio
-import nuvolaris.storage_static as static
+import logging
 import nuvolaris.config as cfg
 import nuvolaris.kube as kube
 import nuvolaris.util as util
 import nuvolaris.kopf_util as kopf_util
-import nuvolaris.postgres_operator as postgres
-import nuvolaris.endpoint as endpoint
-import nuvolaris.issuer as issuer
 import nuvolaris.operator_util as operator_util
-import nuvolaris.runtimes_preloader as preloader
-import nuvolaris.invoker as invoker
-import nuvolaris.quota_checker_job as quota
-import nuvolaris.etcd as etcd
-import nuvolaris.milvus_standalone as milvus
-import nuvolaris.registry_deploy as registry
-import nuvolaris.seaweedfs_deploy as seaweedfs
-
-def patch_preloader(owner: None):
+import nuvolaris.tracing as tracing
+import nuvolaris.rolling_restart as rolling_restart
+from nuvolaris.component_registry import lazy
+
+openwhisk = lazy("nuvolaris.openwhisk", "openwhisk")
+mongodb = lazy("nuvolaris.ferretdb", "mongodb")
+redis = lazy("nuvolaris.redis", "redis")
+cron = lazy("nuvolaris.cronjob", "cron")
+minio = lazy("nuvolaris.minio_deploy", "minio")
+static = lazy("nuvolaris.storage_static", "static")
+postgres = lazy("nuvolaris.postgres_operator", "postgres")
+endpoint = lazy("nuvolaris.endpoint", "endpoint")
+issuer = lazy("nuvolaris.issuer", "issuer")
+preloader = lazy("nuvolaris.runtimes_preloader", "preloader")
+invoker = lazy("nuvolaris.invoker", "invoker")
+quota = lazy("nuvolaris.quota_checker_job", "quota")
+etcd = lazy("nuvolaris.etcd", "etcd")
+milvus = lazy("nuvolaris.milvus_standalone", "milvus")
+registry = lazy("nuvolaris.registry_deploy", "registry")
+seaweedfs = lazy("nuvolaris.seaweedfs_deploy", "seaweedfs")
+
+def patch_preloader(owner: None, images=None):
     try:
         logging.info("*** handling request to patch openwhisk runtime preloader")
         preloader.delete(owner)
-        preloader.create(owner)
+        preloader.create(owner, images)
         logging.info("*** handled request to patch openwhisk runtime preloader")
     except Exception as e:
         logging.error("*** failed to patch openwhisk runtime preloader",e)
-import nuvolaris.invoker as invoker
 
 def redeploy_invoker(owner=None):
     try:
@@ -58,29 +61,19 @@ def redeploy_invoker(owner=None):
     except Exception as e:
         logging.error('*** failed to redeploy whisk invoker: %s' % e) 
 
+# restart the pods one at a time, each after the previous one is ready again
 def rollout(kube_name):
     try:
         logging.info(f"*** handling request to rollout {kube_name}")
-        kube.rollout(kube_name)
-        logging.info(f"*** handled request to rollout {kube_name}")
+        report = rolling_restart.restart(kube_name)
+        logging.info(f"*** handled request to rollout {kube_name}: {report}")
+        return report
     except Exception as e:
-        logging.error('*** failed to rollout %s: %s' % kube_name,e)
+        logging.error('*** failed to rollout %s: %s' % (kube_name, e))
 
+# formerly scaled down to zero and up again, now a readiness gated rolling restart
 def restart_sts(sts_name):
-    try:
-        logging.info(f"*** handling request to redeploy {sts_name} using scaledown/scaleup")
-        replicas =  1
-        current_rep = kube.kubectl("get",sts_name,jsonpath="{.spec.replicas}")
-        if current_rep:
-            replicas = current_rep[0]
-        
-        kube.scale_sts(sts_name,0)
-        time.sleep(5)
-        logging.info(f"scaling {sts_name} to {replicas}")
-        kube.scale_sts(sts_name,replicas)
-        logging.info(f"*** handling request to redeploy {sts_name} using scaledown/scaleup")
-    except Exception as e:
-        logging.error('*** failed to scale up/down %s: %s' % sts_name,e)
+    return rollout(sts_name)
 
 def redeploy_controller(owner=None):
     try:
@@ -107,10 +100,30 @@ def redeploy_whisk(owner=None):
     redeploy_controller(owner)
     
 
-def patch(diff, status, owner=None, name=None):
+# the components patched by patch(), after them the system actions are deployed again
+PATCHED_COMPONENTS = ["postgres", "mongodb", "redis", "cron", "minio", "static", "quota", "etcd", "milvus", "registry"]
+
+def needs_post_create(what_to_do, incremental=False):
+    """
+    True if the changes patch components needing the post create steps
+    >>> needs_post_create({"redis": "update", "endpoint": "update"}), needs_post_create({"endpoint": "update"})
+    (True, False)
+    >>> needs_post_create({"openwhisk": "update"}), needs_post_create({"openwhisk": "update"}, incremental=True)
+    (True, False)
+    """
+    if any(c in what_to_do for c in PATCHED_COMPONENTS):
+        return True
+    return what_to_do.get("openwhisk") == "update" and not incremental
+
+@tracing.traced("patch")
+def patch(diff, status, owner=None, name=None, incremental=False, post_create=True):
     """
     Implements the patching logic of the nuvolaris operator by analyzing the kopf
     provided diff object to identify which components needs to be added/removed.
+    With incremental set, the redeploy of openwhisk on configuration changes is left
+    to main.reconcile, which redeploys only the components whose inputs changed.
+    With post_create unset the caller runs operator_util.whisk_post_create, once.
+    Returns the detected changes.
     """
     logging.info(status)
     what_to_do = kopf_util.detect_component_changes(diff)
@@ -122,53 +135,40 @@ def patch(diff, status, owner=None, name=None):
     for key in what_to_do.keys():
         logging.info(f"{key}={what_to_do[key]}")
 
-    components_updated = False    
-
     # components 1st
     if "postgres" in what_to_do:
         postgres.patch(status,what_to_do['postgres'], owner)
-        components_updated = True
 
     if "mongodb" in what_to_do:
         mongodb.patch(status,what_to_do['mongodb'], owner)
-        components_updated = True
 
     if "redis" in what_to_do:
         redis.patch(status,what_to_do['redis'], owner)
-        components_updated = True 
 
     if "cron" in what_to_do:
         cron.patch(status,what_to_do['cron'], owner)
-        components_updated = True 
 
     if "minio" in what_to_do:
         minio.patch(status,what_to_do['minio'], owner)
-        components_updated = True 
 
     if "static" in what_to_do:
         static.patch(status,what_to_do['static'], owner)
-        components_updated = True
 
     if "quota" in what_to_do:
         quota.patch(status,what_to_do['quota'], owner)
-        components_updated = True 
 
     if "etcd" in what_to_do:
         etcd.patch(status,what_to_do['etcd'], owner)
-        components_updated = True 
 
     if "milvus" in what_to_do:
         milvus.patch(status,what_to_do['milvus'], owner)
-        components_updated = True 
 
     if "registry" in what_to_do:
         registry.patch(status,what_to_do['milvus'], owner)
-        components_updated = True                                      
 
     # handle update action on openwhisk
-    if "openwhisk" in what_to_do and what_to_do['openwhisk'] == "update":        
+    if "openwhisk" in what_to_do and what_to_do['openwhisk'] == "update" and not incremental:
         redeploy_whisk(owner)
-        components_updated = True
 
     # handle update action on endpoint
     if "endpoint" in what_to_do and what_to_do['endpoint'] == "update":
@@ -181,6 +181,8 @@ def patch(diff, status, owner=None, name=None):
     if "seaweedfs-ingresses" in what_to_do and what_to_do['seaweedfs-ingresses'] == "update":
         seaweedfs.patch_ingresses(status,what_to_do['seaweedfs-ingresses'], owner)        
 
-    if components_updated:
-        operator_util.whisk_post_create(name)        
+    if post_create and needs_post_create(what_to_do, incremental):
+        operator_util.whisk_post_create(name)
+
+    return what_to_do        
     
@@ -0,0 +1,342 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module waits for pods and statefulsets to become ready
+# waits are futures resolved by the informer cache watch events,
+# so many callers can wait for many resources at the same time;
+# without the cache it falls back to polling with kubectl wait
+import os, re, time, logging, threading
+from concurrent.futures import Future, ThreadPoolExecutor, InvalidStateError, wait as wait_futures
+
+import nuvolaris.kube as kube
+import nuvolaris.kube_cache as kube_cache
+import nuvolaris.jsonpath_util as jpu
+
+_lock = threading.Lock()
+_pending = []
+_timings = {}
+_listening = set()
+_poller = None
+
+# seconds to wait for an informer to sync before polling with kubectl instead
+sync_wait = float(os.environ.get("NUVOLARIS_READINESS_SYNC_WAIT", "2"))
+
+def parse_timeout(timeout):
+    """
+    convert a kubectl style timeout in seconds
+    >>> parse_timeout("600s"), parse_timeout("2m"), parse_timeout(30), parse_timeout("1h")
+    (600, 120, 30, 3600)
+    """
+    if isinstance(timeout, (int, float)):
+        return timeout
+    units = {"s": 1, "m": 60, "h": 3600}
+    if timeout and timeout[-1] in units:
+        return int(float(timeout[:-1]) * units[timeout[-1]])
+    return int(timeout)
+
+def pod_ready(pod):
+    """
+    >>> pod_ready({"status": {"conditions": [{"type": "Ready", "status": "True"}]}})
+    True
+    >>> pod_ready({"metadata": {"deletionTimestamp": "now"}, "status": {"conditions": [{"type": "Ready", "status": "True"}]}})
+    False
+    >>> pod_ready({"status": {"phase": "Pending"}})
+    False
+    """
+    if pod.get("metadata", {}).get("deletionTimestamp"):
+        return False
+    for c in pod.get("status", {}).get("conditions", []) or []:
+        if c.get("type") == "Ready":
+            return c.get("status") == "True"
+    return False
+
+def statefulset_ready(sts):
+    """
+    >>> sts = {"metadata": {"generation": 2}, "spec": {"replicas": 2},
+    ...        "status": {"observedGeneration": 2, "readyReplicas": 2, "updatedReplicas": 2,
+    ...                   "currentRevision": "r2", "updateRevision": "r2"}}
+    >>> statefulset_ready(sts)
+    True
+    >>> sts["status"]["readyReplicas"] = 1
+    >>> statefulset_ready(sts)
+    False
+    """
+    spec, status = sts.get("spec", {}), sts.get("status", {})
+    replicas = spec.get("replicas", 1)
+    if status.get("observedGeneration", 0) < sts.get("metadata", {}).get("generation", 0):
+        return False
+    if status.get("readyReplicas", 0) < replicas or status.get("updatedReplicas", 0) < replicas:
+        return False
+    return status.get("currentRevision") == status.get("updateRevision")
+
+def deployment_ready(dep):
+    """
+    >>> dep = {"metadata": {"generation": 3}, "spec": {"replicas": 2},
+    ...        "status": {"observedGeneration": 3, "replicas": 2, "updatedReplicas": 2, "availableReplicas": 2}}
+    >>> deployment_ready(dep)
+    True
+    >>> dep["status"]["replicas"] = 3
+    >>> deployment_ready(dep)
+    False
+    """
+    spec, status = dep.get("spec", {}), dep.get("status", {})
+    replicas = spec.get("replicas", 1)
+    if status.get("observedGeneration", 0) < dep.get("metadata", {}).get("generation", 0):
+        return False
+    # the old replicas are gone when the surge is over
+    if status.get("updatedReplicas", 0) < replicas or status.get("replicas", 0) > replicas:
+        return False
+    return status.get("availableReplicas", 0) >= replicas
+
+class ReadyWait:
+    """
+    A pending wait for a resource to become ready, exposing a Future.
+    """
+    def __init__(self, label, resource, check, namespace, deadline):
+        self.label = label
+        self.resource = resource
+        self.check = check
+        self.namespace = namespace
+        self.start = time.monotonic()
+        self.deadline = self.start + deadline
+        self.future = Future()
+
+    def resolve(self, value):
+        if self.future.done():
+            return
+        elapsed = time.monotonic() - self.start
+        with _lock:
+            _timings[self.label] = round(elapsed, 3)
+            if self in _pending:
+                _pending.remove(self)
+        logging.info(f"{self.label} ready after {elapsed:.1f}s")
+        try:
+            self.future.set_result(value)
+        except InvalidStateError:
+            pass
+
+    def expire(self):
+        if self.future.done():
+            return
+        with _lock:
+            if self in _pending:
+                _pending.remove(self)
+        try:
+            self.future.set_exception(TimeoutError(f"{self.label} not ready after {self.deadline - self.start:.0f}s"))
+        except InvalidStateError:
+            pass
+
+    def evaluate(self, objs):
+        try:
+            value = self.check(objs)
+        except Exception as e:
+            logging.warning(f"readiness check for {self.label} failed: {e}")
+            return
+        if value:
+            self.resolve(value)
+
+def _on_event(resource):
+    def listener(event, obj):
+        inf = kube_cache.informer(resource)
+        with _lock:
+            waits = [w for w in _pending if w.resource == resource]
+        lists = {}
+        for w in waits:
+            if w.namespace not in lists:
+                lists[w.namespace] = inf.list(w.namespace)
+            w.evaluate(lists[w.namespace])
+    return listener
+
+def _sweep():
+    # expire the waits past their deadline
+    while True:
+        time.sleep(1)
+        now = time.monotonic()
+        with _lock:
+            expired = [w for w in _pending if w.deadline <= now]
+        for w in expired:
+            w.expire()
+
+def _register(w: ReadyWait):
+    global _poller
+    inf = kube_cache.informer(w.resource) or kube_cache.ensure(w.resource, wait=sync_wait)
+    if not inf or not inf.covers(w.namespace):
+        return False
+    # an informer not synced (starting, or relisting after a failed watch) may never deliver the events
+    if not inf.synced.wait(sync_wait):
+        logging.info(f"informer {w.resource} not synced, polling {w.label}")
+        return False
+    with _lock:
+        if w.resource not in _listening:
+            kube_cache.watch(w.resource, _on_event(w.resource))
+            _listening.add(w.resource)
+        if _poller is None:
+            _poller = threading.Thread(target=_sweep, name="readiness-sweeper", daemon=True)
+            _poller.start()
+        _pending.append(w)
+    w.evaluate(inf.list(w.namespace))
+    return True
+
+_fallback_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="readiness")
+
+def _poll_pod(w: ReadyWait, jsonpath):
+    # legacy behaviour: find the pod with kubectl, then kubectl wait for it
+    import nuvolaris.util as util
+    pod_name = util.get_pod_name(jsonpath, w.namespace)
+    while time.monotonic() < w.deadline:
+        remaining = max(1, int(w.deadline - time.monotonic()))
+        if kube.wait(f"pod/{pod_name}", "condition=ready", f"{remaining}s", w.namespace):
+            w.resolve(pod_name)
+            return
+        logging.info(f"waiting for {pod_name} to be ready...")
+        time.sleep(1)
+    w.expire()
+
+def _poll_sts(w: ReadyWait, name):
+    while time.monotonic() < w.deadline:
+        sts = kube.get(f"sts/{name}", namespace=w.namespace)
+        if sts and statefulset_ready(sts):
+            w.resolve(name)
+            return
+        time.sleep(2)
+    w.expire()
+
+def _run_fallback(w, fn, *args):
+    def run():
+        try:
+            fn(w, *args)
+        except Exception as e:
+            if not w.future.done():
+                w.future.set_exception(e)
+    _fallback_pool.submit(run)
+
+def _pod_label(jsonpath):
+    """
+    >>> _pod_label("{.items[?(@.metadata.labels.name == 'redis')].metadata.name}")
+    "pod[labels.name == 'redis']"
+    """
+    m = re.search(r"\?\(@\.(?:metadata\.)?(.*?)\)\]", jsonpath)
+    return f"pod[{m.group(1)}]" if m else f"pod {jsonpath}"
+
+def await_pod(jsonpath, namespace="nuvolaris", timeout="600s", label=None) -> Future:
+    """
+    wait for the first pod selected by the jsonpath (the same expressions
+    used with util.get_pod_name) to be ready; the future resolves to the pod name
+    """
+    label = label or _pod_label(jsonpath)
+    def check(pods):
+        names = jpu.evaluate(pods, jsonpath)
+        if not names:
+            return None
+        for pod in pods["items"]:
+            if pod["metadata"]["name"] == names[0]:
+                return pod_ready(pod) and names[0]
+        return None
+    w = ReadyWait(label, "pods", check, namespace, parse_timeout(timeout))
+    if not _register(w):
+        _run_fallback(w, _poll_pod, jsonpath)
+    return w.future
+
+def await_statefulset(name, namespace="nuvolaris", timeout="600s") -> Future:
+    """
+    wait for all the replicas of a statefulset to be updated and ready
+    """
+    def check(sets):
+        for sts in sets["items"]:
+            if sts["metadata"]["name"] == name:
+                return statefulset_ready(sts) and name
+        return None
+    w = ReadyWait(f"sts/{name}", "statefulsets", check, namespace, parse_timeout(timeout))
+    if not _register(w):
+        _run_fallback(w, _poll_sts, name)
+    return w.future
+
+def _poll_deployment(w: ReadyWait, name):
+    while time.monotonic() < w.deadline:
+        dep = kube.get(f"deploy/{name}", namespace=w.namespace)
+        if dep and deployment_ready(dep):
+            w.resolve(name)
+            return
+        time.sleep(2)
+    w.expire()
+
+def await_deployment(name, namespace="nuvolaris", timeout="600s") -> Future:
+    """
+    wait for all the replicas of a deployment to be updated and available
+    """
+    def check(deps):
+        for dep in deps["items"]:
+            if dep["metadata"]["name"] == name:
+                return deployment_ready(dep) and name
+        return None
+    w = ReadyWait(f"deploy/{name}", "deployments", check, namespace, parse_timeout(timeout))
+    if not _register(w):
+        _run_fallback(w, _poll_deployment, name)
+    return w.future
+
+def pod_updated(pod, revision):
+    """
+    the pod is ready and runs the given revision of its statefulset
+    >>> pod = {"metadata": {"labels": {"controller-revision-hash": "sts-2"}}, "status": {"conditions": [{"type": "Ready", "status": "True"}]}}
+    >>> pod_updated(pod, "sts-2"), pod_updated(pod, "sts-3")
+    (True, False)
+    """
+    labels = pod.get("metadata", {}).get("labels", {}) or {}
+    return labels.get("controller-revision-hash") == revision and pod_ready(pod)
+
+def _poll_pod_revision(w: ReadyWait, name, revision):
+    while time.monotonic() < w.deadline:
+        pod = kube.get(f"pod/{name}", namespace=w.namespace)
+        if pod and pod_updated(pod, revision):
+            w.resolve(name)
+            return
+        time.sleep(1)
+    w.expire()
+
+def await_pod_revision(name, revision, namespace="nuvolaris", timeout="600s") -> Future:
+    """
+    wait for a pod of a statefulset to be recreated with the given revision and be ready
+    """
+    def check(pods):
+        for pod in pods["items"]:
+            if pod["metadata"]["name"] == name:
+                return pod_updated(pod, revision) and name
+        return None
+    w = ReadyWait(f"pod/{name}@{revision}", "pods", check, namespace, parse_timeout(timeout))
+    if not _register(w):
+        _run_fallback(w, _poll_pod_revision, name, revision)
+    return w.future
+
+def wait_all(futures, timeout=None):
+    """
+    wait for many readiness futures, returns (ready, failed) lists of results and exceptions
+    """
+    done, not_done = wait_futures(futures, timeout=timeout)
+    ready, failed = [], [TimeoutError("still waiting") for _ in not_done]
+    for f in done:
+        if f.exception():
+            failed.append(f.exception())
+        else:
+            ready.append(f.result())
+    return ready, failed
+
+def timings():
+    """
+    the time to ready, in seconds, of every resource waited so far
+    """
+    with _lock:
+        return dict(_timings)
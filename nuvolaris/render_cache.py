@@ -0,0 +1,158 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module memoizes rendered manifests by a digest of their inputs
+# entries are evicted least recently used first and, when a folder is
+# configured, persisted on disk to survive operator restarts
+import os, copy, pickle, hashlib, logging, threading
+from collections import OrderedDict
+
+def digest(*parts):
+    """
+    a stable digest of strings, bytes and (nested) lists, tuples and dicts
+    >>> digest("a", {"x": 1, "y": [2, 3]}) == digest("a", {"y": [2, 3], "x": 1})
+    True
+    >>> digest("a", "b") == digest("ab")
+    False
+    """
+    h = hashlib.sha256()
+    def feed(value):
+        if isinstance(value, dict):
+            h.update(b"{")
+            for k in sorted(value, key=str):
+                feed(str(k))
+                feed(value[k])
+            h.update(b"}")
+        elif isinstance(value, (list, tuple)):
+            h.update(b"[")
+            for v in value:
+                feed(v)
+            h.update(b"]")
+        else:
+            data = value if isinstance(value, bytes) else repr(value).encode("utf-8")
+            h.update(len(data).to_bytes(8, "big"))
+            h.update(data)
+    for part in parts:
+        feed(part)
+    return h.hexdigest()
+
+def tree_stat(dir):
+    """
+    the name, size and modification time of the files in a folder, recursively;
+    used instead of the content to detect changes of the deploy tree cheaply
+    """
+    res = []
+    for root, dirs, files in os.walk(dir):
+        dirs.sort()
+        for name in sorted(files):
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            res.append((os.path.relpath(os.path.join(root, name), dir), st.st_size, st.st_mtime_ns))
+    return res
+
+class RenderCache:
+    """
+    A thread safe LRU cache of rendered values; values are deep copied
+    in and out, so callers can modify what they get.
+    >>> c = RenderCache(size=2)
+    >>> c.put("a", [1]); c.put("b", [2]); c.get("a").append(3); c.put("c", [4])
+    >>> c.get("a"), c.get("b"), c.get("c")
+    ([1], None, [4])
+    >>> c.stats()
+    {'hits': 3, 'misses': 1, 'entries': 2}
+    """
+    def __init__(self, size=64, dir=None):
+        self.size = size
+        self.dir = dir
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _file(self, key):
+        return os.path.join(self.dir, f"{key}.pickle")
+
+    def _load(self, key):
+        if not self.dir:
+            return None
+        try:
+            with open(self._file(key), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"cannot load cached render {key}: {e}")
+            return None
+
+    def _store(self, key, value):
+        if not self.dir:
+            return
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            tmp = f"{self._file(key)}.{threading.get_ident()}"
+            with open(tmp, "wb") as f:
+                pickle.dump(value, f)
+            os.replace(tmp, self._file(key))
+            self._prune()
+        except Exception as e:
+            logging.warning(f"cannot persist cached render {key}: {e}")
+
+    def _prune(self):
+        # keep on disk a few times the entries kept in memory, dropping the oldest
+        files = [os.path.join(self.dir, f) for f in os.listdir(self.dir) if f.endswith(".pickle")]
+        if len(files) > self.size * 4:
+            files.sort(key=os.path.getmtime)
+            for f in files[:len(files) - self.size * 4]:
+                os.remove(f)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+        if value is None:
+            value = self._load(key)
+            if value is not None:
+                self._insert(key, value)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return copy.deepcopy(value)
+
+    def _insert(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def put(self, key, value):
+        value = copy.deepcopy(value)
+        self._insert(key, value)
+        self._store(key, value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
@@ -0,0 +1,188 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module restarts statefulsets and deployments without an outage
+# statefulsets are restarted a pod at a time, from the highest ordinal, lowering
+# the partition of the rolling update only when the pod before is ready again;
+# deployments surge new pods before removing the old ones; both stop at a deadline
+import os, json, time, logging
+from datetime import datetime, timezone
+
+import nuvolaris.kube as kube
+import nuvolaris.readiness as readiness
+import nuvolaris.metrics as metrics
+
+# how long, in seconds, a restart can take
+deadline = int(os.environ.get("NUVOLARIS_RESTART_DEADLINE", "900"))
+
+# how many pods a deployment can add during a restart
+surge = int(os.environ.get("NUVOLARIS_RESTART_SURGE", "1"))
+
+RESTARTED_AT = "kubectl.kubernetes.io/restartedAt"
+# the partition of a statefulset before a restart that did not complete
+ORIGINAL_PARTITION = "nuvolaris.org/original-partition"
+
+restart_seconds = metrics.Histogram("nuvolaris_restart_duration_seconds", "Time to healthy of the rolling restarts.", ["kind", "outcome"])
+
+class RestartReport:
+    """
+    The outcome of a restart: the pods restarted with the seconds each took
+    to be ready, and the time until the whole resource was healthy.
+    >>> r = RestartReport("sts/controller"); r.steps = [("controller-1", 12.5), ("controller-0", 10.25)]
+    >>> r.seconds, r.completed = 23, True
+    >>> r
+    RestartReport(sts/controller, healthy in 23.0s, controller-1 12.5s, controller-0 10.2s)
+    >>> r.completed, r.error, r.partition = False, "timeout", 1
+    >>> r
+    RestartReport(sts/controller, stopped after 23.0s: timeout, partition left at 1, controller-1 12.5s, controller-0 10.2s)
+    """
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+        self.seconds = 0.0
+        self.completed = False
+        self.error = None
+        # the partition an incomplete restart of a statefulset left
+        self.partition = None
+
+    def __repr__(self):
+        outcome = [f"healthy in {self.seconds:.1f}s" if self.completed else f"stopped after {self.seconds:.1f}s: {self.error}"]
+        if self.partition is not None:
+            outcome.append(f"partition left at {self.partition}")
+        return f"RestartReport({', '.join([self.name] + outcome + [f'{pod} {s:.1f}s' for pod, s in self.steps])})"
+
+def partition_plan(replicas):
+    """
+    the partitions of a restart, one pod at a time from the highest ordinal
+    >>> partition_plan(3), partition_plan(1)
+    ([2, 1, 0], [0])
+    """
+    return list(range(replicas - 1, -1, -1))
+
+def _patch(name, data, namespace):
+    kube.kubectl("patch", name, "--type", "merge", "-p", json.dumps(data), namespace=namespace)
+
+def _restarted_at():
+    return {"metadata": {"annotations": {RESTARTED_AT: datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}}}
+
+def _observed(name, namespace, end):
+    # the object once its controller observed the last change
+    while time.monotonic() < end:
+        obj = kube.get(name, namespace=namespace)
+        if obj and obj.get("status", {}).get("observedGeneration", 0) >= obj["metadata"].get("generation", 0):
+            return obj
+        time.sleep(0.5)
+    raise TimeoutError(f"{name} change not observed")
+
+def _remaining(end):
+    return max(1, int(end - time.monotonic()))
+
+def restart_statefulset(name, namespace="nuvolaris", timeout=None) -> RestartReport:
+    """
+    restart the pods of a statefulset one at a time, each after the one before is ready
+    with the new revision; on timeout the pods not restarted are left running with the
+    old revision: the partition is left where the restart stopped, restoring it would
+    replace them all at once
+    """
+    report = RestartReport(f"sts/{name}")
+    start = time.monotonic()
+    end = start + (timeout or deadline)
+    sts = kube.get(f"sts/{name}", namespace=namespace)
+    if not sts:
+        raise Exception(f"sts/{name} not found")
+    replicas = sts.get("spec", {}).get("replicas", 1)
+    strategy = sts.get("spec", {}).get("updateStrategy") or {}
+    on_delete = strategy.get("type") == "OnDelete"
+    saved = (sts.get("metadata", {}).get("annotations") or {}).get(ORIGINAL_PARTITION)
+    original = int(saved) if saved else (strategy.get("rollingUpdate") or {}).get("partition", 0)
+
+    spec = {"template": _restarted_at()}
+    if not on_delete:
+        # no pod is replaced until the partition is lowered
+        spec["updateStrategy"] = {"type": "RollingUpdate", "rollingUpdate": {"partition": replicas}}
+    partition = None
+    try:
+        _patch(f"sts/{name}", {"spec": spec}, namespace)
+        partition = None if on_delete else replicas
+        revision = _observed(f"sts/{name}", namespace, end)["status"]["updateRevision"]
+        for ordinal in partition_plan(replicas):
+            pod = f"{name}-{ordinal}"
+            step = time.monotonic()
+            if on_delete:
+                kube.kubectl("delete", "pod", pod, "--wait=false", namespace=namespace)
+            else:
+                _patch(f"sts/{name}", {"spec": {"updateStrategy": {"rollingUpdate": {"partition": ordinal}}}}, namespace)
+                partition = ordinal
+            readiness.await_pod_revision(pod, revision, namespace, _remaining(end)).result()
+            report.steps.append((pod, time.monotonic() - step))
+            logging.info(f"restart of sts/{name}: {pod} ready in {time.monotonic() - step:.1f}s")
+        report.completed = True
+    except Exception as e:
+        report.error = e
+    if report.completed and not on_delete:
+        try:
+            _patch(f"sts/{name}", {"metadata": {"annotations": {ORIGINAL_PARTITION: None}},
+                                   "spec": {"updateStrategy": {"rollingUpdate": {"partition": original}}}}, namespace)
+        except Exception as e:
+            logging.warning(f"cannot restore the partition of sts/{name}: {e}")
+    elif partition is not None:
+        # the pods from the partition up have the new revision, the others keep the old one;
+        # the original partition is kept for the next restart to restore it
+        report.partition = partition
+        logging.warning(f"sts/{name} left with partition {partition}, restart it again or set the partition to {original}")
+        try:
+            _patch(f"sts/{name}", {"metadata": {"annotations": {ORIGINAL_PARTITION: str(original)}}}, namespace)
+        except Exception as e:
+            logging.warning(f"cannot save the original partition of sts/{name}: {e}")
+    return _done(report, start, "statefulset")
+
+def restart_deployment(name, namespace="nuvolaris", timeout=None, max_surge=None) -> RestartReport:
+    """
+    restart a deployment adding the new pods before removing the old ones
+    """
+    report = RestartReport(f"deploy/{name}")
+    start = time.monotonic()
+    end = start + (timeout or deadline)
+    rolling = {"maxSurge": max_surge or surge, "maxUnavailable": 0}
+    try:
+        _patch(f"deploy/{name}", {"spec": {"strategy": {"type": "RollingUpdate", "rollingUpdate": rolling}, "template": _restarted_at()}}, namespace)
+        _observed(f"deploy/{name}", namespace, end)
+        readiness.await_deployment(name, namespace, _remaining(end)).result()
+        report.completed = True
+    except Exception as e:
+        report.error = e
+    return _done(report, start, "deployment")
+
+def _done(report, start, kind):
+    report.seconds = time.monotonic() - start
+    restart_seconds.observe(report.seconds, kind, "ok" if report.completed else "error")
+    if report.completed:
+        logging.info(f"restarted {report}")
+    else:
+        logging.warning(f"restart incomplete {report}")
+    return report
+
+def restart(kube_name, namespace="nuvolaris", timeout=None) -> RestartReport:
+    """
+    restart a statefulset (sts/name) or a deployment (deploy/name) without an outage
+    """
+    kind, name = kube_name.split("/", 1)
+    if kind in ["sts", "statefulset", "statefulsets"]:
+        return restart_statefulset(name, namespace, timeout)
+    if kind in ["deploy", "deployment", "deployments"]:
+        return restart_deployment(name, namespace, timeout)
+    raise Exception(f"cannot restart {kube_name}")
@@ -0,0 +1,144 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module compares two versions of the runtimes.json of cm/openwhisk-runtimes
+# and computes what to do: the images to pre-pull and the statefulsets to restart;
+# the controller resolves kinds, defaults and images from the manifest, the invoker
+# only uses it for the prewarmed containers (stemCells), so a change of a kind
+# without stemCells does not restart it
+import json, hashlib, logging
+from datetime import datetime, timezone
+
+import nuvolaris.kube as kube
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+def _image(img):
+    img = img or {}
+    res = f"{img.get('prefix')}/{img.get('name')}" if img.get('prefix') else str(img.get('name'))
+    return f"{res}:{img['tag']}" if img.get('tag') else res
+
+def index(manifest):
+    """
+    a compact view of a runtimes manifest, by kind, to be stored and compared
+    >>> import nuvolaris.testutil as tutil
+    >>> idx = index(tutil.load_sample_runtimes())
+    >>> len(idx["kinds"]), idx["kinds"]["nodejs:21"]["image"], idx["kinds"]["nodejs:21"]["default"]
+    (26, 'apache/openserverless-runtime-nodejs:v21-2506091954', True)
+    >>> idx["kinds"]["go:1.22"]["stemCells"] is None
+    True
+    """
+    kinds = {}
+    for family, runtimes in (manifest.get("runtimes") or {}).items():
+        for runtime in runtimes:
+            rest = {k: v for k, v in runtime.items() if k not in ("kind", "image", "default", "stemCells")}
+            kinds[runtime["kind"]] = {
+                "family": family,
+                "image": _image(runtime.get("image")),
+                "default": bool(runtime.get("default")),
+                "stemCells": _digest(runtime["stemCells"]) if runtime.get("stemCells") else None,
+                "other": _digest(rest)
+            }
+    return {"kinds": kinds, "blackboxes": _digest(manifest.get("blackboxes") or [])}
+
+def diff(old, new):
+    """
+    the kinds added, removed, and changed in image, default, stemCells or other fields
+    >>> import copy, nuvolaris.testutil as tutil
+    >>> m1 = tutil.load_sample_runtimes(); m2 = copy.deepcopy(m1)
+    >>> diff(index(m1), index(m2))
+    {}
+    >>> m2["runtimes"]["go"].append({"kind": "go:1.23", "default": False, "image": {"prefix": "apache", "name": "go", "tag": "v1.23"}})
+    >>> m2["runtimes"]["go"][0]["stemCells"] = [{"initialCount": 1, "memory": "256 MB"}]
+    >>> m2["runtimes"]["java"][0]["image"]["tag"] = "v8-new"
+    >>> del m2["runtimes"]["rust"]
+    >>> diff(index(m1), index(m2))
+    {'added': ['go:1.23'], 'removed': ['rust:1.34'], 'images': ['java:8'], 'stemCells': ['go:1.22']}
+    """
+    before, after = old["kinds"], new["kinds"]
+    changes = {
+        "added": sorted(set(after) - set(before)),
+        "removed": sorted(set(before) - set(after)),
+    }
+    common = sorted(set(before) & set(after))
+    changes["images"] = [k for k in common if before[k]["image"] != after[k]["image"]]
+    changes["defaults"] = [k for k in common if before[k]["default"] != after[k]["default"]]
+    changes["stemCells"] = [k for k in common if before[k]["stemCells"] != after[k]["stemCells"]]
+    changes["other"] = [k for k in common if before[k]["other"] != after[k]["other"]]
+    if old.get("blackboxes") != new.get("blackboxes"):
+        changes["other"].append("blackboxes")
+    return {k: v for k, v in changes.items() if v}
+
+def plan(old, new, invoker=True, only_apache=True):
+    """
+    the images to pre-pull and the statefulsets to restart going from the old to the new index;
+    without the invoker the controller runs the containers and restarts also for the stemCells
+    >>> import copy, nuvolaris.testutil as tutil
+    >>> m1 = tutil.load_sample_runtimes(); m2 = copy.deepcopy(m1)
+    >>> plan(index(m1), index(m2))["restart"]
+    []
+    >>> m2["runtimes"]["go"].append({"kind": "go:1.23", "default": False, "image": {"prefix": "apache", "name": "go", "tag": "v1.23"}})
+    >>> p = plan(index(m1), index(m2)); p["restart"], p["prepull"]
+    (['sts/controller'], ['apache/go:v1.23'])
+    >>> m3 = copy.deepcopy(m1); m3["runtimes"]["nodejs"][0]["stemCells"][0]["initialCount"] = 2
+    >>> plan(index(m1), index(m3))["restart"], plan(index(m1), index(m3), invoker=False)["restart"]
+    (['sts/invoker'], ['sts/controller'])
+    >>> m3["runtimes"]["nodejs"][0]["image"]["tag"] = "v21-new"
+    >>> p = plan(index(m1), index(m3)); p["restart"], p["prepull"]
+    (['sts/invoker', 'sts/controller'], ['apache/openserverless-runtime-nodejs:v21-new'])
+    """
+    changes = diff(old, new)
+    before, after = old["kinds"], new["kinds"]
+
+    # the images not already in use by another kind are the only ones to pull
+    known = {r["image"] for r in before.values()}
+    changed = changes.get("added", []) + changes.get("images", [])
+    prepull = sorted({after[k]["image"] for k in changed if after[k]["image"] not in known})
+    if only_apache:
+        prepull = [img for img in prepull if img.startswith("apache/")]
+
+    controller = any(changes.get(k) for k in ("added", "removed", "images", "defaults", "other"))
+    touched = set(changes.get("removed", []) + changes.get("images", []) + changes.get("added", []) + changes.get("other", []))
+    prewarmed = any((before.get(k) or {}).get("stemCells") or (after.get(k) or {}).get("stemCells") for k in touched)
+    containers = bool(changes.get("stemCells")) or prewarmed or "blackboxes" in touched
+
+    restart = []
+    if containers and invoker:
+        restart.append("sts/invoker")
+    if controller or (containers and not invoker):
+        restart.append("sts/controller")
+    return {"changes": changes, "prepull": prepull, "restart": restart}
+
+def stored(owner):
+    """
+    the index of the runtimes stored in the status of the whisk resource
+    """
+    return ((owner or {}).get("status") or {}).get("runtimes", {}).get("index")
+
+def record(name, idx, applied=None, namespace="nuvolaris"):
+    """
+    store the index of the runtimes, and the plan applied, in the status of wsk/<name>
+    """
+    data = {"index": idx}
+    if applied is not None:
+        data["plan"] = dict(applied, at=datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"))
+    try:
+        kube.kubectl("patch", f"wsk/{name}", "--subresource", "status", "--type", "merge",
+                     "-p", json.dumps({"status": {"runtimes": data}}), namespace=namespace)
+    except Exception as e:
+        logging.warning(f"cannot record the runtimes in wsk/{name}: {e}")
@@ -23,7 +23,8 @@ import nuvolaris.util as util
 import nuvolaris.runtimes_util as rutil
 import json
 
-def create(owner=None):
+# images, when given, are the only ones pulled
+def create(owner=None, images=None):
     logging.info(f"*** configuring runtime preloader")
     config = cfg.getall()
     only_apache = config.get(
@@ -33,6 +34,8 @@ def create(owner=None):
 
     runtimes_as_json = util.get_runtimes_json_from_config_map()
     data=rutil.parse_runtimes(json.loads(runtimes_as_json), only_apache)
+    if images is not None:
+        data['containers'] = [{"name": f"preload-{i}", "image": image} for i, image in enumerate(sorted(images))]
     if not data['containers']:
         logging.info("*** skipped runtime preloader: no valid runtime images found")
         return "skipped runtime preloader"
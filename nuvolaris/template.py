@@ -15,7 +15,8 @@
 # specific language governing permissions and limitations
 # under the License.
 #
-import os, re
+import os, re, tempfile
+import nuvolaris.component_digest as digests
 
 from jinja2 import Environment, FileSystemLoader
 loader = FileSystemLoader(["./nuvolaris/templates", "./nuvolaris/files", "./nuvolaris/policies"])
@@ -28,6 +29,7 @@ def expand_template(template, data):
     >>> json.loads(expand_template("test.json", {"item": "hello"}))
     {'_id': 'test', 'value': 'hello'}
     """
+    digests.note("template", template)
     tpl = env.get_template(template)
     return tpl.render(data)
     #doc = json.loads(tpl.render(data))
@@ -44,6 +46,23 @@ def spool_template(template, file, data):
         f.write(expand_template(template, data))
     return file
 
+# expand template in a new temporary file, unique even when the same
+# template is rendered for the same name by steps running concurrently
+def spool_temp_template(template, name, data):
+    """
+    >>> import nuvolaris.testutil as tu
+    >>> a, b = spool_temp_template("test.json", "demo", {"item": "a"}), spool_temp_template("test.json", "demo", {"item": "b"})
+    >>> a != b, os.path.basename(b).startswith("__demo_")
+    (True, True)
+    >>> tu.grep(tu.fread(a), r"value")
+    "value": "a"
+    >>> os.remove(a); os.remove(b)
+    """
+    fd, file = tempfile.mkstemp(prefix=f"__{name}_", suffix=f"_{template}")
+    with os.fdopen(fd, "w") as f:
+        f.write(expand_template(template, data))
+    return file
+
 
 # expand a line of a .tpl.yml interpreting '#' comments as follows:
 # if there is #!, the entire line will be removed
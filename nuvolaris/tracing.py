@@ -0,0 +1,205 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module times what a reconcile spends in each step
+# a handler decorated with @reconcile collects the spans opened while it runs,
+# also in the threads started in its context (contextvars.copy_context); at the end a summary is stored
+# in the status of the resource and the spans are written to a file in the
+# chrome trace format (load it in chrome://tracing or https://ui.perfetto.dev)
+#
+#   NUVOLARIS_TRACE=on                    enables the spans, off by default
+#   NUVOLARIS_TRACE_DIR=/tmp/traces       where the trace files are written
+#
+# when disabled span() returns a shared no-op and nothing is collected
+import os, json, time, logging, threading, functools, contextvars
+
+enabled = os.environ.get("NUVOLARIS_TRACE", "off") == "on"
+trace_dir = os.environ.get("NUVOLARIS_TRACE_DIR", "/tmp/nuvolaris-traces")
+
+_current = contextvars.ContextVar("nuvolaris_trace", default=None)
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+_NOSPAN = _NoSpan()
+
+class Span:
+    """
+    A timed step of a trace, with its category and arguments.
+    """
+    __slots__ = ("trace", "name", "cat", "args", "start", "elapsed", "tid")
+
+    def __init__(self, trace, name, cat, args):
+        self.trace = trace
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = 0.0
+        self.elapsed = 0.0
+        self.tid = 0
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.tid = threading.get_ident()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, tpe, value, tb):
+        self.elapsed = time.perf_counter() - self.start
+        if tpe is not None:
+            self.args["error"] = repr(value)
+        self.trace.add(self)
+        return False
+
+class Trace:
+    """
+    The spans of a reconcile.
+    >>> tr = Trace("whisk_create")
+    >>> with Span(tr, "couchdb", "component", {}): pass
+    >>> with Span(tr, "apply", "kube", {"args": "apply -f -"}): pass
+    >>> with Span(tr, "apply", "kube", {}): pass
+    >>> s = tr.summary()
+    >>> s["spans"], sorted(s["categories"]), s["categories"]["kube"]["count"]
+    (3, ['component', 'kube'], 2)
+    >>> [e["ph"] for e in tr.chrome()["traceEvents"]]
+    ['M', 'M', 'X', 'X', 'X']
+    """
+    def __init__(self, name):
+        self.name = name
+        self.origin = time.perf_counter()
+        self.wall = time.time()
+        self.spans = []
+        self.threads = {}
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+            self.threads.setdefault(span.tid, threading.current_thread().name)
+
+    def summary(self, slowest=5):
+        """
+        the time spent by category, with the slowest components and calls
+        """
+        categories = {}
+        with self._lock:
+            spans = list(self.spans)
+        for s in spans:
+            c = categories.setdefault(s.cat, {"count": 0, "seconds": 0.0})
+            c["count"] += 1
+            c["seconds"] += s.elapsed
+        for c in categories.values():
+            c["seconds"] = round(c["seconds"], 3)
+        top = sorted(spans, key=lambda s: -s.elapsed)[:slowest]
+        return {
+            "name": self.name,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.wall)),
+            "seconds": round(time.perf_counter() - self.origin, 3),
+            "spans": len(spans),
+            "categories": categories,
+            "slowest": [f"{s.cat}/{s.name} {s.elapsed:.3f}s" for s in top],
+        }
+
+    def chrome(self):
+        """
+        the spans as complete events of the chrome trace format, in microseconds
+        """
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+            threads = dict(self.threads)
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": self.name}}]
+        events += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                   for tid, name in threads.items()]
+        for s in sorted(spans, key=lambda s: s.start):
+            events.append({"name": s.name, "cat": s.cat, "ph": "X", "pid": pid, "tid": s.tid,
+                           "ts": round((s.start - self.origin) * 1e6, 1), "dur": round(s.elapsed * 1e6, 1),
+                           "args": {k: str(v) for k, v in s.args.items()}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, dir):
+        os.makedirs(dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime(self.wall))
+        path = f"{dir}/{stamp}-{self.name.replace('/', '_')}.json"
+        with open(path, "w") as f:
+            json.dump(self.chrome(), f)
+        return path
+
+def span(name, cat="operator", **args):
+    """
+    a span of the current trace, used as a context manager
+    >>> with span("nothing traced") as s: s.set(ignored=True)
+    """
+    if not enabled:
+        return _NOSPAN
+    trace = _current.get()
+    if trace is None:
+        return _NOSPAN
+    return Span(trace, name, cat, args)
+
+def traced(cat, name=None):
+    """
+    a decorator timing each call of a function as a span
+    """
+    def decorator(fn):
+        label = name or fn.__name__
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(label, cat):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def reconcile(name):
+    """
+    a decorator collecting the spans of a kopf handler; the summary
+    is stored under status.trace and the file is written in trace_dir
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return handler(*args, **kwargs)
+            trace = Trace(f"{name}-{kwargs.get('name', '')}")
+            token = _current.set(trace)
+            try:
+                with Span(trace, name, "handler", {}):
+                    return handler(*args, **kwargs)
+            finally:
+                _current.reset(token)
+                _finish(trace, kwargs.get("patch"))
+        return wrapper
+    return decorator
+
+def _finish(trace, patch):
+    summary = trace.summary()
+    try:
+        summary["file"] = trace.write(trace_dir)
+    except Exception as e:
+        logging.warning(f"cannot write the trace of {trace.name}: {e}")
+    logging.info(f"trace of {trace.name}: {json.dumps(summary)}")
+    if patch is not None:
+        patch.status['trace'] = summary
@@ -0,0 +1,120 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module coalesces the updates of a resource arriving in a burst
+# an update is handled only after NUVOLARIS_UPDATE_QUIET_WINDOW seconds without
+# changes; until then the handler is retried by kopf, and the diff of the newest
+# generation seen in the meantime is handled, so a burst of edits gets a single plan
+import os, time, threading
+import kopf
+
+quiet_window = float(os.environ.get("NUVOLARIS_UPDATE_QUIET_WINDOW", "5"))
+
+def merge_diffs(diffs):
+    """
+    the change of a burst from the kopf diffs of its generations; until the handler
+    succeeds kopf computes each diff against the last handled state, not against the
+    previous generation, so the newest diff holds the whole change and a field changed
+    back to its value is no longer in it; the older diffs only give the first old values
+    >>> d1 = (('change', ('spec', 'redis', 'size'), 1, 2), ('add', ('spec', 'tls'), None, True))
+    >>> d2 = (('change', ('spec', 'redis', 'size'), 1, 3),)
+    >>> merge_diffs([d1, d2])
+    (('change', ('spec', 'redis', 'size'), 1, 3),)
+    >>> merge_diffs([d1, (('add', ('spec', 'tls'), None, True),)])
+    (('add', ('spec', 'tls'), None, True),)
+    >>> merge_diffs([d1, ()]), merge_diffs([])
+    ((), ())
+    """
+    diffs = [tuple(diff) for diff in diffs]
+    if not diffs:
+        return ()
+    first = {}
+    for diff in diffs:
+        for op, path, old, new in diff:
+            first.setdefault(tuple(path), old)
+    res = []
+    for op, path, old, new in diffs[-1]:
+        path = tuple(path)
+        old = first.get(path, old)
+        if old == new:
+            continue
+        if old is None:
+            op = "add"
+        elif new is None:
+            op = "remove"
+        else:
+            op = "change"
+        res.append((op, path, old, new))
+    return tuple(res)
+
+class Coalescer:
+    """
+    The pending diffs of each resource, with the time of their last change.
+    >>> now = [0]; c = Coalescer(10, clock=lambda: now[0])
+    >>> c.add("wsk/controller", 1, (('change', ('spec', 'a'), 1, 2),))
+    10
+    >>> now[0] = 4; c.add("wsk/controller", 2, (('change', ('spec', 'a'), 1, 3),))
+    10
+    >>> now[0] = 9; c.add("wsk/controller", 2, (('change', ('spec', 'a'), 1, 3),))
+    5
+    >>> now[0] = 14; c.add("wsk/controller", 2, ())
+    0
+    >>> c.take("wsk/controller"), c.take("wsk/controller")
+    ((('change', ('spec', 'a'), 1, 3),), ())
+    """
+    def __init__(self, window, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, generation, diff):
+        """
+        record the diff of a generation of the resource, returns
+        how many seconds are left before it should be handled
+        """
+        now = self.clock()
+        with self._lock:
+            entry = self.pending.setdefault(key, {"generations": {}, "changed": now})
+            if generation not in entry["generations"]:
+                entry["generations"][generation] = tuple(diff)
+                entry["changed"] = now
+            return max(0, self.window - (now - entry["changed"]))
+
+    def take(self, key):
+        """
+        the merged diff of the pending generations, forgetting them
+        """
+        with self._lock:
+            entry = self.pending.pop(key, None)
+        if not entry:
+            return ()
+        return merge_diffs(diff for _, diff in sorted(entry["generations"].items(), key=lambda kv: kv[0] or 0))
+
+updates = Coalescer(quiet_window)
+
+def coalesce(key, generation, diff):
+    """
+    the diff to handle, merged with the ones of the burst it belongs to;
+    raises a kopf.TemporaryError to be retried while the resource keeps changing
+    """
+    if quiet_window <= 0:
+        return diff
+    wait = updates.add(key, generation, diff)
+    if wait > 0:
+        raise kopf.TemporaryError(f"{key} changed, waiting {wait:.1f}s for more changes", delay=wait)
+    return updates.take(key)
@@ -0,0 +1,120 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module groups the users created in a burst in batches
+# a user waits until NUVOLARIS_USER_BATCH_WINDOW seconds pass without new users,
+# or NUVOLARIS_USER_BATCH_SIZE users are waiting; then the first handler retried
+# onboards the whole batch and the others pick their result; until then the
+# handlers are retried by kopf; a window of 0 (the default) disables the batches
+import os, time, logging, threading
+import kopf
+
+import nuvolaris.metrics as metrics
+
+window = float(os.environ.get("NUVOLARIS_USER_BATCH_WINDOW", "0"))
+size = int(os.environ.get("NUVOLARIS_USER_BATCH_SIZE", "100"))
+
+users_total = metrics.Counter("nuvolaris_user_batch_users_total", "Users onboarded in batches by outcome.", ["outcome"])
+users_per_minute = metrics.Gauge("nuvolaris_user_batch_users_per_minute", "Users per minute onboarded by the last batch.")
+
+def enabled():
+    return window > 0
+
+class Batcher:
+    """
+    The jobs waiting for a batch, and the results of the batches done.
+    >>> now = [0]; b = Batcher(10, 3, clock=lambda: now[0])
+    >>> run = lambda jobs: {key: job * 2 for key, job in jobs.items()}
+    >>> b.submit("u1", lambda: 1, run), b.submit("u2", lambda: 2, run)
+    ((False, 10), (False, 10))
+    >>> now[0] = 10; b.submit("u1", lambda: 1, run), b.submit("u2", lambda: 2, run)
+    ((True, 2), (True, 4))
+    >>> [b.submit(u, lambda: 3, run) for u in ["u3", "u4", "u5"]], b.submit("u3", lambda: 3, run)
+    ([(False, 10), (False, 10), (True, 6)], (True, 6))
+    """
+    def __init__(self, window, size, clock=time.monotonic):
+        self.window = window
+        self.size = size
+        self.clock = clock
+        self.pending = {}
+        self.results = {}
+        self.changed = 0
+        self.running = False
+        self._lock = threading.Lock()
+
+    def submit(self, key, job, run):
+        """
+        queue the job of key, built calling job() once; returns (True, result) when
+        its batch is done, (False, seconds) to retry after, and runs a batch when due
+        calling run({key: job}) returning the results by key
+        """
+        now = self.clock()
+        with self._lock:
+            if key in self.results:
+                return True, self.results.pop(key)
+            if key not in self.pending:
+                self.pending[key] = job()
+                self.changed = now
+            if self.running:
+                return False, self.window
+            wait = self.window - (now - self.changed)
+            if wait > 0 and len(self.pending) < self.size:
+                return False, wait
+            keys = list(self.pending)[:self.size]
+            batch = {k: self.pending.pop(k) for k in keys}
+            self.running = True
+        try:
+            results = run(batch)
+        except Exception as e:
+            logging.warning(f"batch of {len(batch)} failed: {e}")
+            results = {k: e for k in batch}
+        finally:
+            with self._lock:
+                self.running = False
+        with self._lock:
+            self.results.update(results)
+            if key in self.results:
+                return True, self.results.pop(key)
+        return False, 0.1
+
+batches = Batcher(window, size)
+
+def submit(key, job, run, batcher=None):
+    """
+    the result of the job of key once its batch is done; raises a kopf.TemporaryError
+    to be retried while waiting and the exception of the job if it failed
+    """
+    done, res = (batcher or batches).submit(key, job, run)
+    if not done:
+        raise kopf.TemporaryError(f"{key} waiting {res:.1f}s for its batch", delay=res)
+    if isinstance(res, Exception):
+        raise res
+    return res
+
+def report(count, failed, seconds):
+    """
+    log and export the throughput of a batch
+    >>> report(120, 0, 30)
+    240.0
+    """
+    rate = count * 60 / seconds if seconds > 0 else 0.0
+    users_total.inc("ok", amount=count - failed)
+    if failed:
+        users_total.inc("error", amount=failed)
+    users_per_minute.set(value=rate)
+    logging.info(f"*** onboarded {count} users, {failed} failed, in {seconds:.1f}s: {rate:.1f} users per minute")
+    return round(rate, 1)
@@ -16,94 +16,247 @@
 # under the License.
 #
 # Provides extra kopf handlers to manage nuvolaris users
+import os
+import time
 import logging
 from datetime import datetime
 
 import kopf
 
+import nuvolaris.metrics as metrics
 import nuvolaris.config as cfg
-import nuvolaris.couchdb as cdb
-import nuvolaris.endpoint as endpoint
-import nuvolaris.ferretdb as mdb
 import nuvolaris.kube as kube
-import nuvolaris.milvus_standalone as milvus
-import nuvolaris.minio_deploy as minio_deploy
-import nuvolaris.postgres_operator as postgres
-import nuvolaris.redis as redis
-import nuvolaris.storage_static as static
 import nuvolaris.user_patcher as user_patcher
 import nuvolaris.userdb_util as userdb
-import nuvolaris.seaweedfs_deploy as seaweedfs
-from nuvolaris.quota_checker import REDIS_DB_QUOTA_ANNOTATION
+import nuvolaris.couchdb_util as couchdb_util
+import nuvolaris.util as util
+import nuvolaris.user_batch as user_batch
+import nuvolaris.user_resume as user_resume
+import nuvolaris.component_graph as graph
+from nuvolaris.component_registry import lazy
 from nuvolaris.user_config import UserConfig
 from nuvolaris.user_metadata import UserMetadata
 
+# component modules are imported when first used, see component_registry
+cdb = lazy("nuvolaris.couchdb", "couchdb")
+endpoint = lazy("nuvolaris.endpoint", "endpoint")
+mdb = lazy("nuvolaris.ferretdb", "mongodb")
+milvus = lazy("nuvolaris.milvus_standalone", "milvus")
+minio_deploy = lazy("nuvolaris.minio_deploy", "minio")
+postgres = lazy("nuvolaris.postgres_operator", "postgres")
+redis = lazy("nuvolaris.redis", "redis")
+static = lazy("nuvolaris.storage_static", "static")
+seaweedfs = lazy("nuvolaris.seaweedfs_deploy", "seaweedfs")
+quota_checker = lazy("nuvolaris.quota_checker", "quota")
+
+# how many services of a user are provisioned at the same time
+parallelism = int(os.environ.get("NUVOLARIS_USER_PARALLELISM", "4"))
+
 
 def get_ucfg(spec):
     ucfg = UserConfig(spec)
     ucfg.dump_config()
     return ucfg
 
-@kopf.on.create('nuvolaris.org', 'v1', 'whisksusers')
-def whisk_user_create(spec, name, patch, **kwargs):
-    logging.info(f"*** whisk_user_create {name}")
-    conditions = []
-    state = {
-    }
+def _storage_enabled(ucfg):
+    return ucfg.get('object-storage.data.enabled') or ucfg.get('object-storage.route.enabled')
 
-    conditions.append({        
-        "lastTransitionTime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "status": "True",
-        "type": "Initialized"})
+def _create_steps(ucfg, owner):
+    """
+    the provisioning steps enabled for a user, as a dict from the name of a step to
+    the steps it comes after and a function(state, user_metadata) executing it
+    """
+    steps = {}
 
-    ucfg = get_ucfg(spec)
-    user_metadata = UserMetadata(ucfg)
-    owner = kube.get(f"wsku/{name}")
-    
-    if(ucfg.get("namespace") and ucfg.get("auth")):
-        res = cdb.create_ow_user(ucfg,user_metadata)       
-        logging.info(f"OpenWhisk subject {ucfg.get('namespace')} added = {res}")
-        state['couchdb']= res
+    def step(name, after, fn, label):
+        def execute(state, user_metadata):
+            res = fn(user_metadata)
+            logging.info(f"{label} for {ucfg.get('namespace')} added = {res}")
+            state[name] = res
+        steps[name] = (after, execute)
 
-        res = endpoint.create_ow_api_endpoint(ucfg,user_metadata)
-        logging.info(f"OpenWhisk api endpoints {ucfg.get('namespace')} added = {res}")
-        state['api']= res
+    if(ucfg.get("namespace") and ucfg.get("auth")):
+        step("couchdb", [], lambda md: cdb.create_ow_user(ucfg, md), "OpenWhisk subject")
+        step("api", [], lambda md: endpoint.create_ow_api_endpoint(ucfg, md), "OpenWhisk api endpoints")
 
-    if(cfg.get('components.minio') and (ucfg.get('object-storage.data.enabled') or ucfg.get('object-storage.route.enabled'))):        
-        minio_deploy.create_ow_storage(state, ucfg, user_metadata, owner)
+    if(cfg.get('components.minio') and _storage_enabled(ucfg)):
+        steps["minio"] = ([], lambda state, md: minio_deploy.create_ow_storage(state, ucfg, md, owner))
 
-    if(cfg.get('components.seaweedfs') and (ucfg.get('object-storage.data.enabled') or ucfg.get('object-storage.route.enabled'))):        
-        seaweedfs.create_ow_storage(state, ucfg, user_metadata, owner)        
+    if(cfg.get('components.seaweedfs') and _storage_enabled(ucfg)):
+        steps["seaweedfs"] = ([], lambda state, md: seaweedfs.create_ow_storage(state, ucfg, md, owner))
 
+    # the static endpoint serves the route bucket created by the storage
     if((cfg.get('components.minio') or cfg.get('components.seaweedfs')) and ucfg.get('object-storage.route.enabled') and cfg.get('components.static')):
-        res = static.create_ow_static_endpoint(ucfg,user_metadata, owner)
-        logging.info("OpenWhisk static endpoint for %s added = %s", ucfg.get('namespace'), res)
-        state['static']= res
+        step("static", ["minio", "seaweedfs"], lambda md: static.create_ow_static_endpoint(ucfg, md, owner), "OpenWhisk static endpoint")
 
     if(cfg.get('components.mongodb') and ucfg.get('mongodb.enabled')):
-        res = mdb.create_db_user(ucfg,user_metadata)
-        logging.info(f"Mongodb setup for {ucfg.get('namespace')} added = {res}")
-        state['mongodb']= res
+        step("mongodb", [], lambda md: mdb.create_db_user(ucfg, md), "Mongodb setup")
 
     if(cfg.get('components.redis') and ucfg.get('redis.enabled')):
-        res = redis.create_db_user(ucfg, user_metadata)
-        logging.info(f"Redis setup for {ucfg.get('namespace')} added = {res}")
-        state['redis']= res
+        step("redis", [], lambda md: redis.create_db_user(ucfg, md), "Redis setup")
 
     if(cfg.get('components.postgres') and ucfg.get('postgres.enabled')):
-        res = postgres.create_db_user(ucfg, user_metadata)
-        logging.info(f"Postgres setup for {ucfg.get('namespace')} added = {res}")
-        state['postgres']= res 
+        step("postgres", [], lambda md: postgres.create_db_user(ucfg, md), "Postgres setup")
 
     if(cfg.get('components.milvus') and ucfg.get('milvus.enabled')):
-        res = milvus.create_ow_milvus(ucfg, user_metadata)
-        logging.info(f"Milvus setup for {ucfg.get('namespace')} added = {res}")
-        state['milvus']= res
+        step("milvus", [], lambda md: milvus.create_ow_milvus(ucfg, md), "Milvus setup")
+
+    return steps
+
+def provision(steps, user_metadata, workers=None):
+    """
+    run the steps concurrently, at most `workers` at a time, each one with its own
+    state and a fork of the metadata merged back in the order of the steps;
+    returns the state, the status of each service and the first error
+    >>> class Metadata:
+    ...     def __init__(self): self.entries = []
+    ...     def fork(self): return Metadata()
+    ...     def merge(self, child): self.entries += child.entries
+    >>> def add(key):
+    ...     def fn(state, md):
+    ...         md.entries.append(key); state[key] = True
+    ...     return fn
+    >>> def fail(state, md): raise Exception("no redis")
+    >>> md = Metadata()
+    >>> steps = {"couchdb": ([], add("couchdb")), "minio": ([], add("minio")), "static": (["minio"], add("static")), "redis": ([], fail)}
+    >>> state, services, error = provision(steps, md, workers=2)
+    >>> state, md.entries, error
+    ({'couchdb': True, 'minio': True, 'static': True}, ['couchdb', 'minio', 'static'], Exception('no redis'))
+    >>> {name: s["ok"] for name, s in services.items()}
+    {'couchdb': True, 'minio': True, 'static': True, 'redis': False}
+    """
+    forks = {name: (dict(), user_metadata.fork()) for name in steps}
+    results = graph.run({name: after for name, (after, _) in steps.items()},
+                        lambda name: steps[name][1](*forks[name]),
+                        workers=workers or parallelism, abort_on_error=False)
+    state, services = {}, {}
+    for name in steps:
+        res = results[name]
+        step_state, step_metadata = forks[name]
+        state.update(step_state)
+        user_metadata.merge(step_metadata)
+        services[name] = {"ok": res.ok, "seconds": round(res.elapsed, 3)}
+        if res.error is not None:
+            services[name]["error"] = str(res.error)
+        elif res.skipped:
+            services[name]["error"] = "skipped"
+    return state, services, graph.first_error(results)
+
+def onboard(users):
+    """
+    onboard a batch of users, given as a dict from name to (ucfg, user_metadata, owner):
+    the couchdb subjects and the metadata are written with bulk requests of a single
+    client, the api endpoints applied in one pass, the redis users created with a single
+    redis-cli script and the other services provisioned for `parallelism` users at a time;
+    returns (state, services, error) by name.
+    Postgres and mongodb (ferretdb) stay per user: their scripts run in the database of
+    the user, with a pgpass of its own; minio creates the buckets and the policies of the
+    user with the calls of its client, one per object, that a batch would not reduce.
+    """
+    start = time.monotonic()
+    states = {name: {} for name in users}
+    services = {name: {} for name in users}
+    db = couchdb_util.CouchDB()
+    ready = db.wait_db_ready(60)
+
+    subjects = {}
+    for name, (ucfg, user_metadata, owner) in users.items():
+        auth = ucfg.get("auth")
+        if ucfg.get("namespace") and auth and util.validate_ow_auth(auth):
+            [uuid, key] = auth.split(":")
+            subjects[name] = cdb.render_templated_doc("subject.json", {"name": ucfg.get("namespace"), "key": key, "uuid": uuid})
+    saved = db.bulk_update_docs("subjects", list(subjects.values())) if ready and subjects else {}
+    for name, doc in subjects.items():
+        res = saved.get(doc["_id"], False)
+        states[name]["couchdb"] = res
+        services[name]["couchdb"] = {"ok": res}
+        if res:
+            users[name][1].add_metadata("AUTH", users[name][0].get("auth"))
+
+    manifests = {}
+    for name, (ucfg, user_metadata, owner) in users.items():
+        if ucfg.get("namespace") and ucfg.get("auth"):
+            try:
+                manifests[name] = endpoint.api_endpoint_manifests(ucfg, user_metadata)
+            except Exception as e:
+                logging.warning(f"cannot render the api endpoint of {name}: {e}")
+                manifests[name] = None
+    if any(manifests.values()):
+        applied = kube.kubectl("apply", "-f", "-", input="\n---\n".join(m for ms in manifests.values() if ms for m in ms))
+        logging.info(f"OpenWhisk api endpoints of {len(manifests)} users added = {applied}")
+    for name, ms in manifests.items():
+        states[name]["api"] = bool(ms)
+        services[name]["api"] = {"ok": bool(ms)}
+
+    with_redis = [name for name, (ucfg, _, owner) in users.items() if "redis" in _create_steps(ucfg, owner)]
+    if with_redis:
+        step = time.monotonic()
+        created = redis.create_db_users([(users[name][0], users[name][1]) for name in with_redis])
+        elapsed = round(time.monotonic() - step, 3)
+        logging.info(f"Redis setup of {len(with_redis)} users added = {created}")
+        for name in with_redis:
+            res = created.get(users[name][0].get("namespace"))
+            states[name]["redis"] = res
+            services[name]["redis"] = {"ok": bool(res), "seconds": elapsed}
+            if not res:
+                services[name]["redis"]["error"] = "redis user not created"
+
+    def provision_user(name):
+        ucfg, user_metadata, owner = users[name]
+        steps = {step: v for step, v in _create_steps(ucfg, owner).items() if step not in ("couchdb", "api", "redis")}
+        return provision(steps, user_metadata, workers=1)
+
+    results = graph.run({name: [] for name in users}, provision_user, workers=parallelism, abort_on_error=False)
+    errors = {}
+    for name, res in results.items():
+        if res.ok:
+            state, step_services, errors[name] = res.value
+            states[name].update(state)
+            services[name].update(step_services)
+        else:
+            errors[name] = res.error
+
+    # finally persists the metadata of the users provisioned into the internal couchdb database
+    done = [name for name in users if not errors.get(name)]
+    saved = userdb.save_users_metadata(db, [users[name][1] for name in done]) if done else {}
+    for name in done:
+        states[name]["user_metadata"] = saved.get(users[name][1].get_metadata()["login"], False)
+
+    user_batch.report(len(users), len(users) - len(done), time.monotonic() - start)
+    return {name: (states[name], services[name], errors.get(name)) for name in users}
+
+@kopf.on.create('nuvolaris.org', 'v1', 'whisksusers')
+@cfg.isolated
+@metrics.handler("whisksusers", "create")
+def whisk_user_create(spec, name, patch, **kwargs):
+    logging.info(f"*** whisk_user_create {name}")
+    conditions = []
 
-    # finally persists user metadata into the internal couchdb database
-    user_metadata.dump()
-    res = userdb.save_user_metadata(user_metadata)
-    state['user_metadata']= res
+    conditions.append({        
+        "lastTransitionTime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "status": "True",
+        "type": "Initialized"})
+
+    ucfg = get_ucfg(spec)
+
+    if user_batch.enabled():
+        state, services, error = user_batch.submit(name, lambda: (ucfg, UserMetadata(ucfg), kube.get(f"wsku/{name}")), onboard)
+    else:
+        user_metadata = UserMetadata(ucfg)
+        owner = kube.get(f"wsku/{name}")
+        state, services, error = provision(_create_steps(ucfg, owner), user_metadata)
+
+    logging.info(f"*** provisioned wsku/{name}: {services}")
+    patch.status['services'] = services
+    if error:
+        # retried by kopf, the steps are idempotent
+        raise error
+
+    if not user_batch.enabled():
+        # finally persists user metadata into the internal couchdb database
+        user_metadata.dump()
+        res = userdb.save_user_metadata(user_metadata)
+        state['user_metadata']= res
 
     conditions.append({        
         "lastTransitionTime": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
@@ -114,6 +267,8 @@ def whisk_user_create(spec, name, patch, **kwargs):
     return state
 
 @kopf.on.delete('nuvolaris.org', 'v1', 'whisksusers')
+@cfg.isolated
+@metrics.handler("whisksusers", "delete")
 def whisk_user_delete(spec, name, **kwargs):
     logging.info(f"*** whisk_user_delete {name}")
 
@@ -158,6 +313,8 @@ def whisk_user_delete(spec, name, **kwargs):
 
 
 @kopf.on.update('nuvolaris.org', 'v1', 'whisksusers')
+@cfg.isolated
+@metrics.handler("whisksusers", "update")
 def whisk_user_update(spec, status, namespace, diff, name, **kwargs):
     logging.info(f"*** detected an update of wsku/{name} under namespace {namespace}")
     
@@ -169,19 +326,27 @@ def whisk_user_update(spec, status, namespace, diff, name, **kwargs):
     user_patcher.patch(ucfg,user_metadata,diff, status, owner, name)
 
 @kopf.on.resume('nuvolaris.org', 'v1', 'whisksusers')
-def whisk_user_resume(spec, name, namespace,annotations, **kwargs):
+@cfg.isolated
+@metrics.handler("whisksusers", "resume")
+def whisk_user_resume(spec, name, namespace,annotations, status, patch, **kwargs):
     logging.info(f"*** detected an update of wsku/{name} under namespace {namespace}")
     ucfg = get_ucfg(spec)
-    user_metadata = UserMetadata(ucfg)
     state = {}
     
     if(cfg.get('components.redis') and ucfg.get('redis.enabled')):
         read_only_mode = False
 
-        if annotations and REDIS_DB_QUOTA_ANNOTATION in annotations:
-            read_only_mode = annotations[REDIS_DB_QUOTA_ANNOTATION] in ["true"]
-            
-        res = redis.create_db_user(ucfg,user_metadata,read_only_mode)
+        if annotations and quota_checker.REDIS_DB_QUOTA_ANNOTATION in annotations:
+            read_only_mode = annotations[quota_checker.REDIS_DB_QUOTA_ANNOTATION] in ["true"]
+
+        if user_resume.enabled():
+            # batched with the other users resumed, skipped if already in place
+            applied = (status or {}).get('redis_acl')
+            res = user_resume.refresh_redis(name, ucfg, read_only_mode, applied)
+            if res:
+                patch.status['redis_acl'] = res
+        else:
+            res = redis.create_db_user(ucfg,UserMetadata(ucfg),read_only_mode)
         logging.info(f"Redis setup for {ucfg.get('namespace')} resumed = {res}")
         state['redis']= res
 
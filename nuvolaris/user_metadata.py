@@ -72,6 +72,21 @@ class UserMetadata:
 
     def get_metadata(self):
         return self._data
+
+    def fork(self):
+        """
+        an empty copy of the metadata, to be filled by a concurrent step and merged back
+        """
+        child = object.__new__(UserMetadata)
+        child._data = dict(self._data, metadata=[], quota=[])
+        return child
+
+    def merge(self, child):
+        """
+        append the metadata and the quota collected by a fork
+        """
+        self._data['metadata'].extend(child._data['metadata'])
+        self._data['quota'].extend(child._data['quota'])
     
     def add_safely_from_cm(self,metadata_key,json_path):
         try: 
@@ -0,0 +1,144 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module makes the resume of the users on operator restart cheap:
+# the redis users to refresh are grouped in batches of NUVOLARIS_RESUME_BATCH_SIZE,
+# applied with one redis-cli script each, at most NUVOLARIS_RESUME_RATE users
+# per second (0 for no limit); a user whose redis acl exists and was last applied
+# with the same settings, recorded in its status, is skipped;
+# NUVOLARIS_RESUME_WINDOW of 0 resumes each user on its own as before
+import os, time, hmac, hashlib, logging, secrets, threading
+
+import nuvolaris.metrics as metrics
+import nuvolaris.user_batch as user_batch
+
+window = float(os.environ.get("NUVOLARIS_RESUME_WINDOW", "2"))
+size = int(os.environ.get("NUVOLARIS_RESUME_BATCH_SIZE", "200"))
+rate = float(os.environ.get("NUVOLARIS_RESUME_RATE", "50"))
+# the key of the digests stored in the status, defaults to the redis admin password
+resume_key = os.environ.get("NUVOLARIS_RESUME_KEY")
+# without a key the digests last as the process, every user is refreshed after a restart
+_process_key = secrets.token_bytes(32)
+
+resumed_total = metrics.Counter("nuvolaris_user_resume_total", "Users resumed by operation and outcome.", ["operation", "outcome"])
+
+def enabled():
+    return window > 0
+
+class RateLimiter:
+    """
+    A token bucket allowing `rate` operations per second, with bursts up to a second of them.
+    >>> now = [0]; slept = []
+    >>> def sleep(s): slept.append(s); now[0] += s
+    >>> limiter = RateLimiter(10, clock=lambda: now[0], sleep=sleep)
+    >>> limiter.acquire(10), limiter.acquire(5), limiter.acquire(20)
+    (0, 0.5, 2.0)
+    >>> RateLimiter(0).acquire(1000)
+    0
+    """
+    def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = rate
+        self.last = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, n=1):
+        """
+        wait until n operations are allowed, returns the seconds waited
+        """
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+limiter = RateLimiter(rate)
+redis_refreshes = user_batch.Batcher(window, size)
+
+def _key():
+    import nuvolaris.config as cfg
+    key = resume_key or cfg.peek("redis.default.password")
+    return key.encode("utf-8") if key else _process_key
+
+def redis_digest(ucfg, read_only_mode, key=None):
+    """
+    the fingerprint of the redis settings of a user, keyed with an operator secret
+    so that the password cannot be guessed from the digest stored in the status
+    >>> from nuvolaris.user_config import UserConfig
+    >>> u = UserConfig({"namespace": "demo", "redis": {"password": "secret"}})
+    >>> redis_digest(u, False) == redis_digest(u, False), redis_digest(u, False) == redis_digest(u, True)
+    (True, False)
+    >>> redis_digest(u, False, key=b"k1") == redis_digest(u, False, key=b"k2")
+    False
+    """
+    settings = [ucfg.get('namespace'), ucfg.get('redis.prefix'), ucfg.get('redis.password'), read_only_mode]
+    return hmac.new(key or _key(), repr(settings).encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+def _refresh(jobs):
+    """
+    refresh a batch of resumed redis users, the unchanged ones already in redis are skipped;
+    a creation batch running at the same time uses a script of its own, so it cannot
+    overwrite the users a resume reports as refreshed
+    >>> import re, nuvolaris.redis as r
+    >>> from nuvolaris.user_config import UserConfig
+    >>> saved = r.exec_redis_command, r.wait_for_redis_ready, r.util.get_pod_name, r.util.get_redis_config_data
+    >>> both, users = threading.Barrier(2), {}
+    >>> def run(pod_name, path_to_script):
+    ...     if "acl_users" in path_to_script: os.remove(path_to_script); return "d\\n"
+    ...     both.wait(); text = open(path_to_script).read()
+    ...     both.wait(); os.remove(path_to_script)
+    ...     users[threading.current_thread().name] = sorted(re.findall(r"SETUSER (\\w+) ON", text))
+    ...     return "OK"
+    >>> r.exec_redis_command, r.wait_for_redis_ready = run, lambda: None
+    >>> r.util.get_pod_name, r.util.get_redis_config_data = lambda jsonpath: "redis-0", lambda: {"redis_password": "p"}
+    >>> ucfg = lambda n: UserConfig({"namespace": n, "redis": {"password": "p"}})
+    >>> results = {}
+    >>> create = threading.Thread(name="create", target=lambda: results.update(create=r.refresh_db_users([(ucfg("a"), False)])))
+    >>> resume = threading.Thread(name="resume", target=lambda: results.update(resume=_refresh({"c": (ucfg("c"), False, "new", "old"), "d": (ucfg("d"), False, "same", "same")})))
+    >>> for t in (create, resume): t.start()
+    >>> for t in (create, resume): t.join()
+    >>> r.exec_redis_command, r.wait_for_redis_ready, r.util.get_pod_name, r.util.get_redis_config_data = saved
+    >>> users["create"], users["resume"], results["create"], results["resume"]
+    (['a'], ['c'], {'a': True}, {'c': 'new', 'd': 'same'})
+    """
+    import nuvolaris.redis as redis
+    limiter.acquire(len(jobs))
+    unchanged = {ucfg.get('namespace') for ucfg, _, digest, applied in jobs.values() if digest == applied}
+    res = redis.refresh_db_users([(ucfg, read_only_mode) for ucfg, read_only_mode, _, _ in jobs.values()],
+                                 skip=lambda namespace, existing: existing and namespace in unchanged)
+    results = {}
+    for name, (ucfg, _, digest, _) in jobs.items():
+        outcome = res.get(ucfg.get('namespace'))
+        resumed_total.inc("redis", "skipped" if outcome == "skipped" else "ok" if outcome else "error")
+        results[name] = digest if outcome else None
+    return results
+
+def refresh_redis(name, ucfg, read_only_mode, applied=None):
+    """
+    refresh the redis user of wsku/name together with the others resumed at the same time,
+    applied is the digest recorded the last time; returns the digest now in place or None
+    """
+    digest = redis_digest(ucfg, read_only_mode)
+    return user_batch.submit(name, lambda: (ucfg, read_only_mode, digest, applied), _refresh, redis_refreshes)
@@ -36,6 +36,16 @@ def _add_metadata(db, metadata):
                       f"add_metadata {metadata['login']}", res)
 
 
+def save_users_metadata(db, users_metadata):
+    """
+    Add the metadata of many users into the internal CouchDB with a bulk request,
+    returns the outcome by login
+    """
+    docs = [cdb.render_templated_doc("user_metadata.json", md.get_metadata()) for md in users_metadata]
+    logging.info(f"Storing Nuvolaris metadata for {len(docs)} users")
+    return db.bulk_update_docs(USER_META_DBN, docs)
+
+
 def save_user_metadata(user_metadata: UserMetadata):
     """
     Add a generic user metadata into the internal CouchDB 
@@ -32,6 +32,7 @@ from urllib3.exceptions import NewConnectionError, MaxRetryError, ProtocolError
 import nuvolaris.apihost_util as apihost_util
 import nuvolaris.config as cfg
 import nuvolaris.kube as kube
+import nuvolaris.readiness as readiness
 import nuvolaris.template as template
 
 # Implements truncated exponential backoff from
@@ -167,14 +168,8 @@ def get_ingress_class(runtime):
 
     # Prefer the ingress class that actually exists in the current cluster.
     try:
-        detected = kube.kubectl(
-            "get",
-            "ingressclass",
-            namespace=None,
-            jsonpath=r"{.items[*].metadata.name}",
-            debugresult=False,
-        )
-        detected = [item for item in detected if item]
+        import nuvolaris.cluster_facts as facts
+        detected = facts.get("ingress_classes")
         if detected:
             logging.info(f"auto-detected ingress classes: {detected}")
             if "nginx" in detected:
@@ -190,6 +185,13 @@ def get_ingress_class(runtime):
     return ingress_class
 
 def get_traefik_middleware_api_version():
+    """
+    The Traefik Middleware apiVersion supported by the current cluster, detected once.
+    """
+    import nuvolaris.cluster_facts as facts
+    return facts.get("traefik_middleware_api_version")
+
+def detect_traefik_middleware_api_version():
     """
     Detect the Traefik Middleware apiVersion supported by the current cluster.
     Prefer the new group `traefik.io`, while keeping compatibility with the
@@ -201,7 +203,7 @@ def get_traefik_middleware_api_version():
     ]
     for crd_name, api_version in candidates:
         try:
-            kube.kubectl("get", "crd", crd_name, namespace=None, debugresult=False)
+            kube.kubectl("get", "crd", crd_name, namespace=None, jsonpath="{.metadata.name}", debugresult=False)
             logging.info(f"detected Traefik middleware apiVersion {api_version} via CRD {crd_name}")
             return api_version
         except Exception:
@@ -233,13 +235,11 @@ def get_pod_name(jsonpath,namespace="nuvolaris"):
     raise Exception(f"could not find any pod matching jsonpath={jsonpath}")
 
 # helper method waiting for a pod ready using the given jsonpath to retrieve the pod name
+# use readiness.await_pod directly to wait for many pods at the same time
 def wait_for_pod_ready(pod_name_jsonpath, timeout="600s", namespace="nuvolaris"):
     try:
-        pod_name = get_pod_name(pod_name_jsonpath, namespace)
-        logging.info(f"checking pod {pod_name}")
-        while not kube.wait(f"pod/{pod_name}", "condition=ready", timeout, namespace):
-            logging.info(f"waiting for {pod_name} to be ready...")
-            time.sleep(1)
+        pod_name = readiness.await_pod(pod_name_jsonpath, namespace, timeout).result()
+        logging.info(f"pod {pod_name} is ready")
     except Exception as e:
         logging.error(e)
 
@@ -209,7 +209,7 @@ def deploy_whisk_system_action():
     try:
         auth = cfg.get('openwhisk.namespaces.whisk-system')
         data = prepare_system_actions()
-        tplres = kust.processTemplate("whisk-system","whisk-system-manifest-tpl.yaml",data,"manifest.yaml")
+        ntp.spool_template("whisk-system-manifest-tpl.yaml", "deploy/whisk-system/manifest.yaml", data)
 
         wskClient = WhiskSystemClient(auth)
         result = safe_deploy(wskClient)
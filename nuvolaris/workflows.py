@@ -17,6 +17,7 @@
 #
 import kopf
 import logging, time, yaml, json, flatdict, os, os.path, random, string
+import nuvolaris.metrics as metrics
 import nuvolaris.config as cfg
 import nuvolaris.kube as kube
 import nuvolaris.template as tpl
@@ -75,6 +76,8 @@ def generate_job(name, spec, action):
     
 # tested by an integration test
 @kopf.on.create('nuvolaris.org', 'v1', 'workflows')
+@cfg.isolated
+@metrics.handler("workflows", "create")
 def workflows_create(spec, name, **kwargs):
     logging.info(f"*** workflows_create {name}")
     try:
@@ -85,6 +88,8 @@ def workflows_create(spec, name, **kwargs):
     return status()
 
 @kopf.on.delete('nuvolaris.org', 'v1', 'workflows')
+@cfg.isolated
+@metrics.handler("workflows", "delete")
 def workflows_delete(spec, name, **kwargs):
     logging.info(f"*** workflows_delete {name}")
     job_name = f"{name}-create"
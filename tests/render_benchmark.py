@@ -0,0 +1,79 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# compares, for every component under deploy, the text pipeline
+# (render to yaml, parse it, serialize to json for kubectl, parse it again)
+# with the object pipeline (render to objects, handed as they are to the api)
+# reporting the bytes serialized and the time spent in each
+#
+#   python3 tests/render_benchmark.py [component...]
+import os, sys, json, time, yaml
+sys.path.insert(0, os.getcwd())
+import nuvolaris.kustomize as kus
+import nuvolaris.kustomize_engine as kze
+
+def kustomization(dir):
+    kust = "apiVersion: kustomize.config.k8s.io/v1beta1\nkind: Kustomization\nresources:\n"
+    for file in sorted(os.listdir(dir)):
+        if file.endswith((".yaml", ".yml")) and not file.startswith("_") and file != "kustomization.yaml":
+            kust += f"- {file}\n"
+    return kust
+
+def text_pipeline(dir, files):
+    start = time.perf_counter()
+    text = kze.dump(kze.build(kze.Source(dir, files)))
+    render = time.perf_counter()
+    items = list(yaml.load_all(text, yaml.Loader))
+    parse = time.perf_counter()
+    data = json.dumps({"apiVersion": "v1", "kind": "List", "items": items})
+    json.loads(data)
+    end = time.perf_counter()
+    return len(text) + len(data), render - start, end - render, parse - render
+
+def object_pipeline(dir, files):
+    start = time.perf_counter()
+    kus._build_objects(dir, files)
+    return 0, time.perf_counter() - start, 0.0, 0.0
+
+def measure(fn, dir, files, repeat):
+    runs = [fn(dir, files) for _ in range(repeat)]
+    return runs[0][0], min(r[1] for r in runs), min(r[2] for r in runs), min(r[3] for r in runs)
+
+def main(names, repeat=5):
+    names = names or sorted(d for d in os.listdir("deploy") if os.path.isdir(f"deploy/{d}"))
+    print(f"{'component':28} {'bytes':>9} {'yaml parse':>11} {'text ms':>9} {'object ms':>10}")
+    total_bytes, total_text, total_object = 0, 0.0, 0.0
+    for name in names:
+        dir = f"deploy/{name}"
+        files = {"kustomization.yaml": kustomization(dir)}
+        try:
+            text = measure(text_pipeline, dir, files, repeat)
+            obj = measure(object_pipeline, dir, files, repeat)
+        except (kze.UnsupportedKustomization, kze.KustomizeError) as e:
+            print(f"{name:28} skipped: {e}")
+            continue
+        text_ms = (text[1] + text[2]) * 1000
+        object_ms = obj[1] * 1000
+        print(f"{name:28} {text[0]:9d} {text[3] * 1000:9.2f}ms {text_ms:9.2f} {object_ms:10.2f}")
+        total_bytes += text[0]
+        total_text += text_ms
+        total_object += object_ms
+    print(f"{'total':28} {total_bytes:9d} {'':11} {total_text:9.2f} {total_object:10.2f}")
+    print(f"libyaml: {yaml.__with_libyaml__}, bytes not serialized by the object pipeline: {total_bytes}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
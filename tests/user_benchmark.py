@@ -0,0 +1,348 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# measures what creating, updating and deleting tenants costs, without a cluster:
+# the whisksusers handlers run against in-process fakes of the kube (through
+# the MockKube of testutil), couchdb (a local http server), redis and postgres
+# (the scripts executed in their pods) and the mc cli; for each phase it reports
+# the wall time, the processes forked (mc and kubectl cp/exec, that no backend
+# serves without forking), the kube calls and the couchdb http requests per user,
+# and fails when they are worse than the stored baseline
+#
+#   python3 tests/user_benchmark.py [users...]       e.g. 1 100 1000, default 1 100
+#   python3 tests/user_benchmark.py --update 1 100   store the results as the baseline
+import os, re, sys, json, time, logging, threading, subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+sys.path.insert(0, os.getcwd())
+import kopf
+import nuvolaris.config as cfg
+import nuvolaris.kube as kube
+import nuvolaris.testutil as tu
+import nuvolaris.minio_util as minio_util
+import nuvolaris.user_handlers as uh
+
+BASELINE = "tests/user_benchmark_baseline.json"
+# how much worse than the baseline a count can be, and the wall time per user
+COUNT_TOLERANCE = 0.05
+TIME_TOLERANCE = 1.0
+
+class Counters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = {"forks": 0, "kube": 0, "http": 0}
+
+    def inc(self, key):
+        with self._lock:
+            self.values[key] += 1
+
+    def take(self):
+        with self._lock:
+            res = dict(self.values)
+            self.values = {k: 0 for k in self.values}
+        return res
+
+counters = Counters()
+
+class FakeCouchDB(BaseHTTPRequestHandler):
+    """
+    the couchdb requests used by the operator: databases, documents, _find, _all_docs and _bulk_docs
+    """
+    dbs = {}
+    lock = threading.Lock()
+
+    def _reply(self, code, body=None):
+        data = json.dumps(body if body is not None else {"ok": code < 300}).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+    def _save(self, db, doc):
+        cur = db.get(doc["_id"])
+        if cur and cur["_rev"] != doc.get("_rev"):
+            return None
+        rev = int((cur or {"_rev": "0-"})["_rev"].split("-")[0]) + 1
+        db[doc["_id"]] = dict(doc, _rev=f"{rev}-fake")
+        return db[doc["_id"]]["_rev"]
+
+    def handle_one_request(self):
+        counters.inc("http")
+        super().handle_one_request()
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if parts == ["_utils"]:
+            return self._reply(200, {})
+        if not parts:
+            return self._reply(404)
+        body = self._body() if self.command in ["POST", "PUT"] else None
+        with self.lock:
+            db = self.dbs.get(parts[0])
+            if len(parts) == 1:
+                if self.command == "PUT":
+                    self.dbs.setdefault(parts[0], {})
+                    return self._reply(201)
+                if self.command == "DELETE":
+                    return self._reply(200 if self.dbs.pop(parts[0], None) is not None else 404)
+                return self._reply(200 if db is not None else 404)
+            db = self.dbs.setdefault(parts[0], {})
+            if parts[1] == "_find":
+                selector = body.get("selector", {})
+                docs = [d for d in db.values() if all(d.get(k) == v.get("$eq") for k, v in selector.items())]
+                return self._reply(200, {"docs": docs})
+            if parts[1] == "_all_docs":
+                rows = [{"key": k, "id": k, "value": {"rev": db[k]["_rev"]}} if k in db else {"key": k, "error": "not_found"} for k in body.get("keys", [])]
+                return self._reply(200, {"rows": rows})
+            if parts[1] == "_bulk_docs":
+                res = []
+                for doc in body.get("docs", []):
+                    rev = self._save(db, doc)
+                    res.append({"id": doc["_id"], "rev": rev} if rev else {"id": doc["_id"], "error": "conflict"})
+                return self._reply(201, res)
+            id = parts[1]
+            if self.command == "GET":
+                return self._reply(200, db[id]) if id in db else self._reply(404, {"error": "not_found"})
+            if self.command == "PUT":
+                rev = self._save(db, dict(body, _id=id))
+                return self._reply(201, {"ok": True, "id": id, "rev": rev}) if rev else self._reply(409)
+            if self.command == "DELETE":
+                return self._reply(200 if db.pop(id, None) else 404)
+        return self._reply(405)
+
+    do_GET = do_PUT = do_POST = do_DELETE = do_HEAD = _dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeRedis:
+    """
+    the acl commands of the redis-cli scripts
+    """
+    def __init__(self):
+        self.users = {"default"}
+
+    def run(self, script):
+        out = []
+        for line in script.splitlines():
+            words = line.split()
+            if words[:2] == ["ACL", "SETUSER"]:
+                self.users.add(words[2])
+                out.append("OK")
+            elif words[:2] == ["ACL", "DELUSER"]:
+                self.users.discard(words[2])
+                out.append("1")
+            elif words[:2] == ["ACL", "USERS"]:
+                out += sorted(self.users)
+            elif words[:1] == ["AUTH"]:
+                out.append("OK")
+        return "\n".join(out)
+
+class FakePostgres:
+    """
+    the databases and the users created and dropped by the psql scripts
+    """
+    def __init__(self):
+        self.databases, self.users = set(), set()
+
+    def run(self, script):
+        self.databases |= set(re.findall(r"CREATE DATABASE (\w+)", script))
+        self.users |= set(re.findall(r"CREATE USER (\w+)", script))
+        self.databases -= set(re.findall(r"DROP DATABASE IF EXISTS (\w+)", script))
+        self.users -= set(re.findall(r"DROP USER (\w+)", script))
+        return "DO\nGRANT"
+
+class FakeMc:
+    """
+    the mc commands of the minio client, run in process
+    """
+    def __init__(self):
+        self.users, self.buckets = set(), set()
+
+    def run(self, cmd, capture_output=True, **kwargs):
+        counters.inc("forks")
+        args = cmd[1:]
+        if args[:3] == ["admin", "user", "add"]:
+            self.users.add(args[4])
+        elif args[:3] == ["admin", "user", "remove"]:
+            self.users.discard(args[4])
+        elif args[:1] == ["mb"]:
+            self.buckets.add(args[-1])
+        elif args[:1] == ["rb"]:
+            self.buckets.discard(args[-1])
+        return subprocess.CompletedProcess(cmd, 0, b"", b"")
+
+class FakeCluster(tu.MockKube):
+    """
+    answers the kube calls, running the scripts copied in the pods with the fakes
+    """
+    def __init__(self, redis, postgres):
+        super().__init__()
+        self.enabled = True
+        self.redis = redis
+        self.postgres = postgres
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def save(self, data, index=-1):
+        pass
+
+    def invoke(self, *args):
+        counters.inc("kube")
+        args = list(args)
+        verb = args[0] if args else ""
+        if verb == "get" and len(args) > 1 and args[1].startswith("wsku/"):
+            name = args[1].split("/", 1)[1]
+            return json.dumps({"apiVersion": "nuvolaris.org/v1", "kind": "WhiskUser",
+                               "metadata": {"name": name, "namespace": "nuvolaris", "uid": f"uid-{name}"}})
+        if verb == "get" and "svc" in args:
+            return [{"metadata": {"name": "fake-svc", "namespace": "nuvolaris"}, "spec": {"ports": [{"port": 1234}]}}]
+        if verb == "get":
+            return ["fake-0"]
+        if verb == "cp":
+            counters.inc("forks")
+            with open(args[1]) as f, self._lock:
+                self.files[args[2].split(":", 1)[1]] = f.read()
+            return "copied"
+        if verb == "exec":
+            counters.inc("forks")
+            cmd = args[-1]
+            with self._lock:
+                if "redis-cli" in cmd:
+                    return self.redis.run(self.files.get(cmd.split()[1], "")) or "OK"
+                if "psql" in cmd:
+                    return self.postgres.run(self.files.get(cmd.split()[-1], ""))
+            return "done"
+        return "ok"
+
+def no_fork(*args, **kwargs):
+    raise Exception(f"unexpected process {args[0] if args else ''}")
+
+def setup():
+    """
+    start the fakes and configure the operator to use them
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeCouchDB)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-couchdb", daemon=True).start()
+    redis, postgres, mc = FakeRedis(), FakePostgres(), FakeMc()
+    kube.mocker = FakeCluster(redis, postgres)
+    minio_util.subprocess = type("subprocess", (), {"run": staticmethod(mc.run)})
+    # any other process is an error, the benchmark never leaves the process
+    kube.subprocess.Popen = no_fork
+    cfg.configure({
+        "nuvolaris": {"kube": "kind", "apihost": "localhost"},
+        "couchdb": {"host": "127.0.0.1", "port": str(server.server_address[1]), "admin": {"user": "admin", "password": "admin"}},
+        "components": {"couchdb": True, "redis": True, "minio": True, "static": True, "mongodb": True, "postgres": True},
+    })
+    return server, redis, postgres, mc
+
+def user_spec(i):
+    name = f"bench{i:05d}"
+    return name, {
+        "email": f"{name}@example.com",
+        "password": f"{name}-passw0rd",
+        "namespace": name,
+        "auth": f"6b9b4ab2-1a8c-4c0e-9c2f-{i:012d}:{'k' * 64}",
+        "redis": {"enabled": True, "prefix": name, "password": f"{name}-redis"},
+        "object-storage": {"password": f"{name}-storage", "quota": "1G",
+                           "data": {"enabled": True, "bucket": f"{name}-data"},
+                           "route": {"enabled": True, "bucket": f"{name}-web"}},
+        "mongodb": {"enabled": True, "database": name, "password": f"{name}-mongo"},
+        "postgres": {"enabled": True, "database": name, "password": f"{name}-postgres"},
+    }
+
+def phase(users, fn):
+    counters.take()
+    start = time.perf_counter()
+    for name, spec in users:
+        fn(name, spec)
+    seconds = time.perf_counter() - start
+    counts = counters.take()
+    n = len(users)
+    return {"seconds": round(seconds, 3), "seconds_per_user": round(seconds / n, 4),
+            **{f"{k}_per_user": round(v / n, 2) for k, v in counts.items()}}
+
+def create(name, spec):
+    uh.whisk_user_create(spec=spec, name=name, patch=kopf.Patch())
+
+def update(name, spec):
+    changed = dict(spec, password=spec["password"] + "-new")
+    diff = (("change", ("spec", "password"), spec["password"], changed["password"]),)
+    uh.whisk_user_update(spec=changed, status={}, namespace="nuvolaris", diff=diff, name=name, patch=kopf.Patch())
+
+def delete(name, spec):
+    uh.whisk_user_delete(spec=spec, name=name)
+
+def run(count):
+    users = [user_spec(i) for i in range(count)]
+    return {"create": phase(users, create), "update": phase(users, update), "delete": phase(users, delete)}
+
+def check(size, results, baseline):
+    failures = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for key in ["forks_per_user", "kube_per_user", "http_per_user"]:
+            if res[key] > base[key] * (1 + COUNT_TOLERANCE) + 0.01:
+                failures.append(f"{size} users {name}: {key} {res[key]} > {base[key]}")
+        if res["seconds_per_user"] > base["seconds_per_user"] * (1 + TIME_TOLERANCE) + 0.01:
+            failures.append(f"{size} users {name}: seconds_per_user {res['seconds_per_user']} > {base['seconds_per_user']}")
+    return failures
+
+def main(args):
+    update_baseline = "--update" in args
+    sizes = [int(a) for a in args if a != "--update"] or [1, 100]
+    logging.disable(logging.ERROR)
+    server, redis, postgres, mc = setup()
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    print(f"{'users':>6} {'phase':8} {'seconds':>9} {'s/user':>8} {'forks/user':>11} {'kube/user':>10} {'http/user':>10}")
+    failures, results = [], {}
+    for size in sizes:
+        results[str(size)] = res = run(size)
+        for name, r in res.items():
+            print(f"{size:6d} {name:8} {r['seconds']:9.3f} {r['seconds_per_user']:8.4f} {r['forks_per_user']:11.2f} {r['kube_per_user']:10.2f} {r['http_per_user']:10.2f}")
+        failures += check(size, res, baseline.get(str(size), {}))
+    leftovers = len(redis.users - {"default"}) + len(postgres.databases) + len(mc.users) + len(mc.buckets)
+    print(f"left after delete: {leftovers} (redis users, postgres databases, minio users and buckets)")
+    server.shutdown()
+
+    if update_baseline:
+        baseline.update(results)
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline stored in {BASELINE}")
+        return 0
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))